@@ -1,16 +1,280 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, current_app, render_template, request, redirect, url_for, flash, session, jsonify, g, has_app_context, has_request_context, make_response, send_from_directory, abort, Response, stream_with_context
+from flask.cli import AppGroup
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import bindparam, create_engine, event, inspect, text, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DataError, DBAPIError, IntegrityError, OperationalError
+from sqlalchemy.orm import joinedload, selectinload, sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from werkzeug.utils import safe_join
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta
+from functools import wraps
+from jinja2 import FileSystemBytecodeCache, Template
+import atexit
+import click
+import csv
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import json
+import math
+import mimetypes
 import os
+import pickle
+import queue
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
 import uuid
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key-here'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///ecommerce.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
-db = SQLAlchemy(app)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = ImageOps = None
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///ecommerce.db').replace('postgres://', 'postgresql://', 1)
+
+class DefaultConfig:
+    # Settings every app starts from; create_app(config) overrides any of them
+    SECRET_KEY = 'your-secret-key-here'
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Database profile. DATABASE_URL selects a PostgreSQL server; without it the
+    # store runs on a local SQLite file in WAL mode. DATABASE_REPLICA_URL adds a
+    # read replica for the read-only GET routes in READ_REPLICA_ENDPOINTS.
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL
+    if DATABASE_URL.startswith('sqlite'):
+        # One pooled connection per thread keeps the page cache and mmap warm;
+        # the busy timeout lets writers queue instead of failing with "locked"
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'poolclass': QueuePool,
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 5)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+            'connect_args': {'check_same_thread': False, 'timeout': 30},
+        }
+    else:
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+            'pool_pre_ping': True,
+            'pool_recycle': 1800,
+        }
+    if os.environ.get('DATABASE_REPLICA_URL'):
+        SQLALCHEMY_BINDS = {'replica': os.environ['DATABASE_REPLICA_URL'].replace('postgres://', 'postgresql://', 1)}
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 30000,
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+    }
+    READ_REPLICA_ENDPOINTS = {'index', 'products', 'product_detail', 'blog', 'blog_post', 'search', 'autocomplete', 'api_list', 'api_detail'}
+    # How long stock stays held for a cart between starting checkout and placing the order
+    RESERVATION_TTL_MINUTES = 15
+    # Guest carts untouched for this long are deleted by 'flask purge-carts'
+    GUEST_CART_DAYS = 30
+    # Page and fragment cache. 'memory' is a per-process LRU; 'sqlite' stores
+    # entries in CACHE_PATH so every worker process sees the same invalidations.
+    CACHE_ENABLED = True
+    CACHE_BACKEND = 'memory'
+    CACHE_PATH = 'cache.db'
+    CACHE_MAX_ENTRIES = 1024
+    CACHE_DEFAULT_TTL = 60
+    # Bulk catalog import: rows written per transaction, and row errors kept for
+    # the report (later errors are only counted)
+    IMPORT_BATCH_SIZE = 500
+    IMPORT_MAX_ERRORS = 100
+    # Typeahead suggestions per response, and the least time between background
+    # rebuilds of a worker's index after changes made by other workers. An index
+    # older than AUTOCOMPLETE_MAX_AGE is rebuilt even when no change was seen,
+    # since the memory cache does not share invalidations between workers.
+    # AUTOCOMPLETE_WARMUP starts each worker's first build in create_app().
+    AUTOCOMPLETE_LIMIT = 8
+    AUTOCOMPLETE_REFRESH_SECONDS = 60
+    AUTOCOMPLETE_MAX_AGE = 600
+    AUTOCOMPLETE_WARMUP = False
+    # Uploaded product images, stored under IMAGE_STORE_DIR by content hash with
+    # resized copies at each of IMAGE_WIDTHS in WebP and JPEG. Resizing runs on
+    # IMAGE_WORKERS background threads and needs Pillow; without it pages use
+    # the original upload.
+    IMAGE_STORE_DIR = 'product_images'
+    IMAGE_WIDTHS = (240, 480, 960)
+    IMAGE_QUALITY = 80
+    IMAGE_MAX_BYTES = 10 * 1024 * 1024
+    IMAGE_WORKERS = 2
+    # Rows fetched per round trip by the streaming exports
+    EXPORT_BATCH_SIZE = 1000
+    # Newsletter, contact and review submissions are acknowledged at once and
+    # written by a background thread in batches of up to WRITE_BATCH_SIZE, waiting
+    # at most WRITE_FLUSH_INTERVAL seconds to fill one. Every accepted submission
+    # is journalled under WRITE_JOURNAL_DIR until committed and replayed after a
+    # restart. With WRITE_QUEUE_MAX submissions pending, new ones wait up to
+    # WRITE_QUEUE_TIMEOUT seconds and are then refused.
+    WRITE_BEHIND_ENABLED = True
+    WRITE_QUEUE_MAX = 10000
+    WRITE_QUEUE_TIMEOUT = 2
+    WRITE_BATCH_SIZE = 500
+    WRITE_FLUSH_INTERVAL = 0.2
+    WRITE_JOURNAL_DIR = 'write_journal'
+    # fsync the journal on every submission. Off, a submission survives a process
+    # crash but not a power cut.
+    WRITE_JOURNAL_FSYNC = False
+    # A batch is retried WRITE_RETRY_LIMIT times while the database is locked or
+    # unreachable. Each committed submission's id is kept WRITE_RECEIPT_DAYS days
+    # so a replayed journal does not write it twice.
+    WRITE_RETRY_LIMIT = 8
+    WRITE_RECEIPT_DAYS = 7
+    # Password hashing. Hashes made with any other method are upgraded on the
+    # next successful login. Checks run on LOGIN_WORKERS threads; once
+    # LOGIN_QUEUE_LIMIT more are waiting, further logins are turned away with a 503.
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:260000'
+    LOGIN_WORKERS = max(1, (os.cpu_count() or 2) // 2)
+    LOGIN_QUEUE_LIMIT = 16
+    LOGIN_TIMEOUT = 10
+    # Login token buckets per client IP and per username. 'memory' is per
+    # process; 'sqlite' keeps the buckets in RATE_LIMIT_PATH, shared by every
+    # worker on the host. Behind reverse proxies, set TRUSTED_PROXIES to how
+    # many of them add to X-Forwarded-For, or every client shares the proxy's
+    # IP bucket. Leave it at 0 when clients reach the app directly, since they
+    # could otherwise pick their own IP with the header.
+    TRUSTED_PROXIES = 0
+    RATE_LIMIT_BACKEND = 'memory'
+    RATE_LIMIT_PATH = 'ratelimit.db'
+    LOGIN_RATE_LIMITS = {
+        'ip': {'burst': 10, 'per_minute': 20},
+        'username': {'burst': 5, 'per_minute': 5},
+    }
+    # Dynamic responses smaller than this are sent uncompressed
+    COMPRESS_MIN_SIZE = 500
+    COMPRESS_LEVEL = 6
+    COMPRESS_MIMETYPES = {
+        'text/html', 'text/css', 'text/plain', 'text/csv', 'text/javascript',
+        'application/json', 'application/javascript', 'application/x-ndjson', 'image/svg+xml',
+    }
+    # Compiled templates are written to TEMPLATE_CACHE_DIR and shared by every
+    # worker (None keeps them in memory only). TEMPLATE_WARMUP makes create_app()
+    # load every template before returning, so a worker started with
+    # create_app({'TEMPLATE_WARMUP': True}) compiles nothing while serving.
+    TEMPLATE_CACHE_DIR = 'template_cache'
+    TEMPLATE_WARMUP = False
+    # Per-endpoint latency, SQL and template timings, served in the Prometheus
+    # text format at /admin/metrics. Scrapers send "Authorization: Bearer
+    # <METRICS_TOKEN>"; otherwise only admin sessions can read them. Requests
+    # taking SLOW_REQUEST_SECONDS or longer are logged with their
+    # SLOW_REQUEST_QUERIES slowest statements; None turns that log off.
+    METRICS_ENABLED = True
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+    SLOW_REQUEST_SECONDS = None
+    SLOW_REQUEST_QUERIES = 5
+    # Maximum SQL statements per request, keyed by endpoint. Exceeding a budget
+    # raises when TESTING is on and logs a warning otherwise.
+    QUERY_BUDGETS = {
+        'orders': 4,
+        'admin_orders': 4,
+        'admin_order_detail': 3,
+        'product_detail': 4,
+    }
+
+# Application setup
+# create_app() builds a new app on every call. Routes, request hooks and
+# template globals declared below are collected as the module is imported
+# and attached to each app it builds; CLI commands are gathered on `cli`.
+setup_functions = []
+cli = AppGroup('store')
+
+def setup(function):
+    # Registers function(app) to run on every app create_app() builds
+    setup_functions.append(function)
+    return function
+
+def route(rule, **options):
+    # Like app.route(): the endpoint is the view function's name
+    def decorator(view):
+        setup(lambda app: app.add_url_rule(rule, view_func=view, **options))
+        return view
+    return decorator
+
+def request_hook(kind):
+    # kind is 'before_request', 'after_request' or 'teardown_request'
+    def decorator(function):
+        setup(lambda app: getattr(app, kind)(function))
+        return function
+    return decorator
+
+def template_global(function):
+    setup(lambda app: app.add_template_global(function))
+    return function
+
+def sqlite_pragmas(pragmas):
+    # A connect listener; the pragmas are bound when the engine is made, as
+    # connections can be opened outside an app context
+    def apply_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+    return apply_sqlite_pragmas
+
+class RoutingSession(SignallingSession):
+    # Reads for the listed endpoints go to the replica; flushes and
+    # INSERT/UPDATE/DELETE statements always go to the primary
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.use_replica(clause):
+            return db.get_engine(self.app, bind='replica')
+        return super().get_bind(mapper, clause)
+
+    def use_replica(self, clause):
+        return (
+            'replica' in (self.app.config.get('SQLALCHEMY_BINDS') or {})
+            and has_request_context()
+            and request.endpoint in self.app.config['READ_REPLICA_ENDPOINTS']
+            and not self._flushing
+            and not isinstance(clause, UpdateBase)
+        )
+
+class StoreSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', sqlite_pragmas(current_app.config['SQLITE_PRAGMAS']))
+        return engine
+
+db = StoreSQLAlchemy()
+
+def upsert_insert(table):
+    # Both dialects offer INSERT ... ON CONFLICT DO UPDATE with the same API
+    if db.engine.dialect.name == 'postgresql':
+        return postgresql_insert(table)
+    return sqlite_insert(table)
 
 # Database Models
 class User(db.Model):
@@ -36,7 +300,14 @@ class Category(db.Model):
     products = db.relationship('Product', backref='category', lazy=True)
 
 class Product(db.Model):
+    __table_args__ = (
+        db.Index('ix_product_category', 'category_id', 'id'),
+        db.Index('ix_product_sku', 'sku', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
+    # Supplier SKU, the key bulk imports upsert on. Optional for hand-added products.
+    sku = db.Column(db.String(64))
     name = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text)
     price = db.Column(db.Float, nullable=False)
@@ -47,8 +318,30 @@ class Product(db.Model):
     
     order_items = db.relationship('OrderItem', backref='product', lazy=True)
     reviews = db.relationship('Review', backref='product', lazy=True)
+    rating_summary = db.relationship('ProductRating', uselist=False, lazy='joined')
+    
+    @property
+    def rating_count(self):
+        return self.rating_summary.rating_count if self.rating_summary else 0
+    
+    @property
+    def average_rating(self):
+        return self.rating_summary.rating_avg if self.rating_summary else None
+
+class ProductRating(db.Model):
+    __table_args__ = (db.Index('ix_product_rating_rank', 'rating_avg', 'rating_count', 'product_id'),)
+
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0)
+    rating_avg = db.Column(db.Float, nullable=False, default=0)
 
 class Order(db.Model):
+    __table_args__ = (
+        db.Index('ix_order_user_created', 'user_id', 'created_at', 'id'),
+        db.Index('ix_order_created', 'created_at', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
@@ -61,12 +354,50 @@ class Order(db.Model):
 
 class OrderItem(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    order_id = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Float, nullable=False)
 
+class CartItem(db.Model):
+    __table_args__ = (
+        db.UniqueConstraint('cart_id', 'product_id'),
+        db.Index('ix_cart_item_updated', 'updated_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    cart_id = db.Column(db.String(40), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class StockReservation(db.Model):
+    __table_args__ = (db.Index('ix_stock_reservation_product_expires', 'product_id', 'expires_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    cart_id = db.Column(db.String(40), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+class StoreCounter(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.Float, nullable=False, default=0)
+
+class ProductFacet(db.Model):
+    # Products per combination of facet values, kept current by triggers
+    category_id = db.Column(db.Integer, primary_key=True)
+    price_bucket = db.Column(db.Integer, primary_key=True)
+    in_stock = db.Column(db.Boolean, primary_key=True)
+    rating_bucket = db.Column(db.Integer, primary_key=True)
+    product_count = db.Column(db.Integer, nullable=False, default=0)
+
 class Review(db.Model):
+    __table_args__ = (
+        db.Index('ix_review_product_created', 'product_id', 'created_at', 'id'),
+        db.Index('ix_review_created', 'created_at', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
@@ -75,13 +406,17 @@ class Review(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Newsletter(db.Model):
+    __table_args__ = (db.Index('ix_newsletter_created', 'created_at', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
-    email = db.Column(db.String(120), nullable=False)
+    email = db.Column(db.String(120), nullable=False, index=True)
     name = db.Column(db.String(100), nullable=True)
     preferences = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Contact(db.Model):
+    __table_args__ = (db.Index('ix_contact_created', 'created_at', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
     email = db.Column(db.String(120), nullable=False)
@@ -90,6 +425,8 @@ class Contact(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 class Blog(db.Model):
+    __table_args__ = (db.Index('ix_blog_created', 'created_at', 'id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
@@ -97,42 +434,2552 @@ class Blog(db.Model):
     tags = db.Column(db.String(200), nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+class WriteReceipt(db.Model):
+    # Ids of committed write-behind submissions
+    __table_args__ = (db.Index('ix_write_receipt_committed', 'committed_at'),)
+
+    id = db.Column(db.String(32), primary_key=True)
+    committed_at = db.Column(db.DateTime, nullable=False)
+
+class SchemaMigration(db.Model):
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Schema migrations
+# db.create_all() only creates missing tables, so changes to existing tables
+# are numbered steps applied once per database. A shipped step is never
+# edited; later changes get a new version. Indexes declared on the models
+# use the same names, so fresh databases end up identical.
+def add_column(table, column, ddl):
+    # A step for MIGRATIONS. db.create_all() already gives fresh databases the
+    # column, so it is only added where it is missing.
+    def step():
+        columns = {c['name'] for c in inspect(db.session.connection()).get_columns(table)}
+        if column not in columns:
+            db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+    return step
+
+MIGRATIONS = [
+    (1, 'Index filtered and sorted columns', [
+        'CREATE INDEX IF NOT EXISTS ix_order_user_created ON "order" (user_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_order_created ON "order" (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_order_item_order_id ON order_item (order_id)',
+        'CREATE INDEX IF NOT EXISTS ix_order_item_product_id ON order_item (product_id)',
+        'CREATE INDEX IF NOT EXISTS ix_product_category ON product (category_id, id)',
+        'DROP INDEX IF EXISTS ix_product_rating_rating_avg',
+        'CREATE INDEX IF NOT EXISTS ix_product_rating_rank ON product_rating (rating_avg, rating_count, product_id)',
+        'CREATE INDEX IF NOT EXISTS ix_review_product_created ON review (product_id, created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_review_created ON review (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_newsletter_email ON newsletter (email)',
+        'CREATE INDEX IF NOT EXISTS ix_newsletter_created ON newsletter (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_contact_created ON contact (created_at, id)',
+        'CREATE INDEX IF NOT EXISTS ix_blog_created ON blog (created_at, id)',
+    ]),
+    (2, 'Add product SKUs for bulk import', [
+        add_column('product', 'sku', 'VARCHAR(64)'),
+        'CREATE UNIQUE INDEX IF NOT EXISTS ix_product_sku ON product (sku)',
+    ]),
+    (3, 'Reindex search only when indexed columns change', [
+        lambda: recreate_search_update_triggers(),
+    ]),
+    (4, 'Index cart items by last update for purging guest carts', [
+        'CREATE INDEX IF NOT EXISTS ix_cart_item_updated ON cart_item (updated_at)',
+    ]),
+    (5, 'Index stock reservations by product for releasing expired holds', [
+        'CREATE INDEX IF NOT EXISTS ix_stock_reservation_product_expires ON stock_reservation (product_id, expires_at)',
+    ]),
+]
+
+def migrate():
+    applied = {version for (version,) in db.session.query(SchemaMigration.version)}
+    for version, description, statements in MIGRATIONS:
+        if version in applied:
+            continue
+        for statement in statements:
+            if callable(statement):
+                statement()
+            else:
+                db.session.execute(text(statement))
+        db.session.add(SchemaMigration(version=version, description=description))
+        db.session.commit()
+        click.echo(f'Applied migration {version}: {description}')
+
+@cli.command('migrate')
+def migrate_command():
+    """Apply pending schema migrations."""
+    db.create_all()
+    migrate()
+
+# Database benchmark
+# 'flask bench-db' runs the same mixed read/write load against a scratch
+# SQLite file twice: once with SQLAlchemy's defaults (rollback journal, no
+# pool) and once with the WAL profile above.
+def run_db_benchmark(path, tuned, threads, seconds, write_ratio):
+    if tuned:
+        engine = create_engine('sqlite:///' + path, **current_app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        event.listen(engine, 'connect', sqlite_pragmas(current_app.config['SQLITE_PRAGMAS']))
+    else:
+        engine = create_engine('sqlite:///' + path)
+    with engine.begin() as conn:
+        conn.exec_driver_sql('CREATE TABLE bench_item (id INTEGER PRIMARY KEY, name TEXT, price REAL)')
+        conn.exec_driver_sql(
+            'INSERT INTO bench_item (name, price) VALUES (?, ?)',
+            [(f'Item {i}', i * 0.5) for i in range(10000)]
+        )
+
+    counts = {'reads': 0, 'writes': 0, 'locked': 0}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker(seed):
+        rng = random.Random(seed)
+        done = {'reads': 0, 'writes': 0, 'locked': 0}
+        while time.perf_counter() < deadline:
+            try:
+                if rng.random() < write_ratio:
+                    with engine.begin() as conn:
+                        conn.exec_driver_sql(
+                            'INSERT INTO bench_item (name, price) VALUES (?, ?)', ('New item', rng.random() * 100)
+                        )
+                    done['writes'] += 1
+                else:
+                    start = rng.randint(1, 9900)
+                    with engine.connect() as conn:
+                        conn.exec_driver_sql(
+                            'SELECT id, name, price FROM bench_item WHERE id BETWEEN ? AND ?', (start, start + 24)
+                        ).fetchall()
+                    done['reads'] += 1
+            except OperationalError:
+                done['locked'] += 1
+        with lock:
+            for key, value in done.items():
+                counts[key] += value
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    engine.dispose()
+    return {key: value / seconds for key, value in counts.items()}
+
+@cli.command('bench-db')
+@click.option('--threads', default=8, help='Concurrent worker threads.')
+@click.option('--seconds', default=5.0, help='Duration of each run.')
+@click.option('--write-ratio', default=0.2, help='Fraction of operations that write.')
+def bench_db_command(threads, seconds, write_ratio):
+    """Compare concurrent throughput of the default and tuned SQLite profiles."""
+    with tempfile.TemporaryDirectory() as workdir:
+        for label, tuned in (('default', False), ('tuned', True)):
+            path = os.path.join(workdir, label + '.db')
+            result = run_db_benchmark(path, tuned, threads, seconds, write_ratio)
+            click.echo(
+                f"{label:<8} reads/s {result['reads']:>9.0f}  writes/s {result['writes']:>8.0f}  "
+                f"locked errors/s {result['locked']:>6.1f}"
+            )
+
+# Query plan checks
+# 'flask check-query-plans' requests each route as an admin, records every
+# SELECT it runs and fails if SQLite plans a table scan or a temporary sort
+# for any of them.
+QUERY_PLAN_ROUTES = [
+    '/', '/products', '/products?category=1', '/products?sort=top_rated',
+    '/products?search=phone', '/products?after=1', '/product/1',
+    '/products?category=1&price=3&in_stock=1&min_rating=4',
+    '/product/1?after=9999-01-01T00:00:00_1', '/blog', '/blog?after=9999-01-01T00:00:00_1',
+    '/blog/1', '/search?q=phone', '/cart', '/orders', '/orders?after=9999-01-01T00:00:00_1',
+    '/newsletter_preferences?email=john.doe@example.com',
+    '/admin', '/admin/users', '/admin/products', '/admin/products?after=1', '/admin/orders', '/admin/orders?before=2000-01-01T00:00:00_1', '/admin/orders/1',
+    '/admin/reviews', '/admin/newsletter', '/admin/contacts', '/admin/blog',
+    '/api/products', '/api/products?ids=1,2,3', '/api/products?category_id=1&fields=name,price',
+    '/api/products/1', '/api/categories', '/api/reviews?product_id=1', '/api/blog?fields=title',
+]
+# Lookup tables that stay small and are always read whole
+FULL_SCAN_ALLOWED = {'category', 'store_counter', 'product_facet'}
+
+def query_plan_problems(statement, plan):
+    # An unfiltered scan with a LIMIT and no sort stops after one page
+    bounded = 'LIMIT' in statement and 'WHERE' not in statement
+    problems = []
+    # Relevance ranking has to sort, but only the rows the FTS index matched
+    ranked = 'MATCH' in statement
+    for detail in plan:
+        if 'TEMP B-TREE' in detail and not ranked:
+            problems.append(detail)
+        scan = re.match(r'SCAN (\w+)$', detail)
+        if scan and scan.group(1) not in FULL_SCAN_ALLOWED and not bounded:
+            problems.append(detail)
+    return problems
+
+def query_plan_report():
+    # Requests every QUERY_PLAN_ROUTES path as an admin and explains each
+    # distinct SELECT. Returns the number of queries and a (path, statement,
+    # problems) entry for each that needs an index.
+    admin = User.query.filter_by(is_admin=True).first()
+    captured = {}
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if has_request_context() and statement.lstrip().upper().startswith('SELECT'):
+            captured.setdefault(statement, (request.full_path, parameters))
+
+    client = current_app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = admin.id
+        client_session['is_admin'] = True
+    event.listen(Engine, 'before_cursor_execute', capture)
+    try:
+        for path in QUERY_PLAN_ROUTES:
+            client.get(path)
+    finally:
+        event.remove(Engine, 'before_cursor_execute', capture)
+
+    failures = []
+    with db.engine.connect() as conn:
+        for statement, (path, parameters) in captured.items():
+            plan = [row[3] for row in conn.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+            problems = query_plan_problems(statement, plan)
+            if problems:
+                failures.append((path, statement, problems))
+    return len(captured), failures
+
+@cli.command('check-query-plans')
+def check_query_plans_command():
+    """Fail if any route query regresses to a full scan or a sort."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Query plan checks run against SQLite only')
+    total, failures = query_plan_report()
+    for path, statement, problems in failures:
+        click.echo(f'{path}: {" ".join(statement.split())}')
+        for problem in problems:
+            click.echo(f'    {problem}')
+    if failures:
+        raise click.ClickException(f'{len(failures)} of {total} queries need an index')
+    click.echo(f'All {total} queries use an index.')
+
+# Full-text search
+# FTS5 indexes over the product and blog tables. They use external content,
+# so the triggers below keep them in sync with every insert, update and delete.
+SEARCH_INDEXES = {
+    'product_fts': {
+        'table': 'product',
+        'columns': ('name', 'description'),
+        'weights': (10.0, 1.0),
+    },
+    'blog_fts': {
+        'table': 'blog',
+        'columns': ('title', 'content', 'tags'),
+        'weights': (10.0, 1.0, 5.0),
+    },
+}
+
+def init_search_index():
+    if db.engine.dialect.name != 'sqlite':
+        return
+    for index, spec in SEARCH_INDEXES.items():
+        table = spec['table']
+        columns = ', '.join(spec['columns'])
+        new_columns = ', '.join('new.' + c for c in spec['columns'])
+        old_columns = ', '.join('old.' + c for c in spec['columns'])
+        exists = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': index}
+        ).first()
+        statements = [
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({columns}, content='{table}', content_rowid='id', prefix='2 3')",
+            f"CREATE TRIGGER IF NOT EXISTS {index}_ai AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {index}(rowid, {columns}) VALUES (new.id, {new_columns}); END",
+            f"CREATE TRIGGER IF NOT EXISTS {index}_ad AFTER DELETE ON {table} BEGIN "
+            f"INSERT INTO {index}({index}, rowid, {columns}) VALUES ('delete', old.id, {old_columns}); END",
+            search_update_trigger(index),
+        ]
+        for statement in statements:
+            db.session.execute(text(statement))
+        if not exists:
+            # Backfill rows written before the index existed
+            db.session.execute(text(f"INSERT INTO {index}({index}) VALUES ('rebuild')"))
+    db.session.commit()
+
+def search_update_trigger(index):
+    # Only a change to an indexed column reindexes the row, so stock and
+    # price updates do not rewrite the product's FTS entry
+    spec = SEARCH_INDEXES[index]
+    columns = ', '.join(spec['columns'])
+    new_columns = ', '.join('new.' + c for c in spec['columns'])
+    old_columns = ', '.join('old.' + c for c in spec['columns'])
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS {index}_au AFTER UPDATE OF {columns} ON {spec['table']} BEGIN "
+        f"INSERT INTO {index}({index}, rowid, {columns}) VALUES ('delete', old.id, {old_columns}); "
+        f"INSERT INTO {index}(rowid, {columns}) VALUES (new.id, {new_columns}); END"
+    )
+
+def recreate_search_update_triggers():
+    # Migration 3. Databases indexed before it have update triggers that fire
+    # on every column; fresh ones get theirs from init_search_index.
+    if db.engine.dialect.name != 'sqlite':
+        return
+    for index in SEARCH_INDEXES:
+        exists = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name"),
+            {'name': f'{index}_au'}
+        ).first()
+        if exists:
+            db.session.execute(text(f'DROP TRIGGER {index}_au'))
+            db.session.execute(text(search_update_trigger(index)))
+
+def search_terms(query):
+    return re.findall(r'\w+', query.lower())
+
+def build_match_query(query):
+    # Every word must match, each as a prefix
+    return ' '.join(f'"{term}"*' for term in search_terms(query))
+
+def search_query(model, index, query, base_query=None):
+    # Join the model against its FTS index and order by bm25 relevance
+    base_query = base_query if base_query is not None else model.query
+    if db.engine.dialect.name != 'sqlite':
+        # Server databases have no FTS5 table; match every term against the indexed columns
+        columns = [getattr(model, column) for column in SEARCH_INDEXES[index]['columns']]
+        for term in search_terms(query):
+            base_query = base_query.filter(db.or_(*[column.ilike(f'%{term}%') for column in columns]))
+        return base_query.order_by(model.id)
+    match = build_match_query(query)
+    if not match:
+        return base_query.filter(db.false())
+    weights = ', '.join(str(w) for w in SEARCH_INDEXES[index]['weights'])
+    ranked = text(
+        f"SELECT rowid AS id, bm25({index}, {weights}) AS rank FROM {index} WHERE {index} MATCH :match"
+    ).bindparams(match=match).columns(id=db.Integer, rank=db.Float).subquery()
+    return base_query.join(ranked, model.id == ranked.c.id).order_by(ranked.c.rank)
+
+# Catalog facets
+# product_facet holds one product count per (category, price bucket, in
+# stock, whole-star rating) cell. On SQLite, triggers on product and
+# product_rating move a product between cells whenever one of those values
+# changes, so every write path keeps it current. The catalog reads the few
+# hundred cells and sums them for each facet instead of grouping the
+# product table per request.
+PRICE_BUCKETS = [(0, 25), (25, 50), (50, 100), (100, 250), (250, 500), (500, 1000), (1000, None)]
+RATING_FILTERS = [4, 3, 2, 1]
+
+def price_bucket_label(bucket):
+    low, high = PRICE_BUCKETS[bucket]
+    if high is None:
+        return f'${low} & above'
+    return f'Under ${high}' if low == 0 else f'${low} to ${high}'
+
+def price_bucket_sql(price):
+    cases = ' '.join(f'WHEN {price} < {high} THEN {bucket}' for bucket, (low, high) in enumerate(PRICE_BUCKETS) if high)
+    return f'CASE {cases} ELSE {len(PRICE_BUCKETS) - 1} END'
+
+def rating_bucket_sql(rating_avg):
+    return f'CAST(coalesce({rating_avg}, 0) AS INTEGER)'
+
+def facet_bump(cell, delta):
+    # cell is (key values, FROM/WHERE clause); the WHERE lets the upsert parse
+    values, source = cell
+    return (
+        f"INSERT INTO product_facet (category_id, price_bucket, in_stock, rating_bucket, product_count) "
+        f"SELECT {values}, {delta} {source} "
+        f"ON CONFLICT (category_id, price_bucket, in_stock, rating_bucket) "
+        f"DO UPDATE SET product_count = product_count + excluded.product_count;"
+    )
+
+def facet_totals_query():
+    # The same counts grouped from the product table, for rebuilds and for
+    # databases without the triggers
+    rating_avg = db.func.coalesce(ProductRating.rating_avg, 0)
+    if db.engine.dialect.name != 'sqlite':
+        rating_avg = db.func.floor(rating_avg)
+    price_bucket = db.case(
+        *[(Product.price < high, bucket) for bucket, (low, high) in enumerate(PRICE_BUCKETS) if high],
+        else_=len(PRICE_BUCKETS) - 1
+    )
+    columns = (Product.category_id, price_bucket, Product.stock_quantity > 0, db.cast(rating_avg, db.Integer))
+    return db.session.query(*columns, db.func.count(Product.id)).outerjoin(
+        ProductRating, ProductRating.product_id == Product.id
+    ).group_by(*columns)
+
+def rebuild_facets():
+    ProductFacet.query.delete()
+    db.session.execute(ProductFacet.__table__.insert().from_select(
+        ['category_id', 'price_bucket', 'in_stock', 'rating_bucket', 'product_count'], facet_totals_query()
+    ))
+
+def init_facet_index():
+    if db.engine.dialect.name != 'sqlite':
+        return
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = 'product_facet_ai'")
+    ).first()
+    product_cell = lambda row: (
+        f"{row}.category_id, {price_bucket_sql(row + '.price')}, {row}.stock_quantity > 0, "
+        f"coalesce((SELECT {rating_bucket_sql('rating_avg')} FROM product_rating WHERE product_id = {row}.id), 0)",
+        "WHERE true"
+    )
+    rated_cell = lambda row, bucket: (
+        f"category_id, {price_bucket_sql('price')}, stock_quantity > 0, {bucket}",
+        f"FROM product WHERE id = {row}.product_id"
+    )
+    old_bucket = rating_bucket_sql('old.rating_avg')
+    new_bucket = rating_bucket_sql('new.rating_avg')
+    statements = [
+        f"CREATE TRIGGER IF NOT EXISTS product_facet_ai AFTER INSERT ON product BEGIN "
+        f"{facet_bump(product_cell('new'), 1)} END",
+        f"CREATE TRIGGER IF NOT EXISTS product_facet_ad AFTER DELETE ON product BEGIN "
+        f"{facet_bump(product_cell('old'), -1)} END",
+        f"CREATE TRIGGER IF NOT EXISTS product_facet_au AFTER UPDATE OF category_id, price, stock_quantity ON product "
+        f"WHEN old.category_id IS NOT new.category_id "
+        f"OR {price_bucket_sql('old.price')} != {price_bucket_sql('new.price')} "
+        f"OR (old.stock_quantity > 0) IS NOT (new.stock_quantity > 0) BEGIN "
+        f"{facet_bump(product_cell('old'), -1)} {facet_bump(product_cell('new'), 1)} END",
+        f"CREATE TRIGGER IF NOT EXISTS product_rating_facet_ai AFTER INSERT ON product_rating BEGIN "
+        f"{facet_bump(rated_cell('new', 0), -1)} {facet_bump(rated_cell('new', new_bucket), 1)} END",
+        f"CREATE TRIGGER IF NOT EXISTS product_rating_facet_ad AFTER DELETE ON product_rating BEGIN "
+        f"{facet_bump(rated_cell('old', old_bucket), -1)} {facet_bump(rated_cell('old', 0), 1)} END",
+        f"CREATE TRIGGER IF NOT EXISTS product_rating_facet_au AFTER UPDATE OF rating_avg ON product_rating "
+        f"WHEN {old_bucket} != {new_bucket} BEGIN "
+        f"{facet_bump(rated_cell('old', old_bucket), -1)} {facet_bump(rated_cell('new', new_bucket), 1)} END",
+    ]
+    for statement in statements:
+        db.session.execute(text(statement))
+    if not exists:
+        # Count products written before the triggers existed
+        rebuild_facets()
+    db.session.commit()
+
+def facet_cells():
+    if db.engine.dialect.name == 'sqlite':
+        return db.session.query(
+            ProductFacet.category_id, ProductFacet.price_bucket, ProductFacet.in_stock,
+            ProductFacet.rating_bucket, ProductFacet.product_count
+        ).filter(ProductFacet.product_count > 0).all()
+    # Without triggers the grouped counts are cached with the catalog
+    return cached_fragment('facets', ['catalog'], lambda: [tuple(row) for row in facet_totals_query()])
+
+def catalog_filters():
+    price = request.args.get('price', type=int)
+    min_rating = request.args.get('min_rating', type=int)
+    return {
+        'category': request.args.get('category', type=int),
+        'price': price if price is not None and 0 <= price < len(PRICE_BUCKETS) else None,
+        'in_stock': request.args.get('in_stock') == '1',
+        'min_rating': min_rating if min_rating in RATING_FILTERS else None,
+    }
+
+def filter_products(query, filters):
+    if filters['category']:
+        query = query.filter(Product.category_id == filters['category'])
+    if filters['price'] is not None:
+        low, high = PRICE_BUCKETS[filters['price']]
+        if low:
+            query = query.filter(Product.price >= low)
+        if high:
+            query = query.filter(Product.price < high)
+    if filters['in_stock']:
+        query = query.filter(Product.stock_quantity > 0)
+    if filters['min_rating']:
+        query = query.filter(Product.rating_summary.has(ProductRating.rating_avg >= filters['min_rating']))
+    return query
+
+def facet_counts(filters):
+    # Each facet is counted under every active filter except its own, so the
+    # numbers say how many products choosing that value would show
+    counts = {'categories': {}, 'prices': [0] * len(PRICE_BUCKETS), 'in_stock': 0, 'ratings': dict.fromkeys(RATING_FILTERS, 0)}
+    for category_id, price_bucket, in_stock, rating_bucket, product_count in facet_cells():
+        matches = {
+            'category': not filters['category'] or category_id == filters['category'],
+            'price': filters['price'] is None or price_bucket == filters['price'],
+            'in_stock': not filters['in_stock'] or in_stock,
+            'min_rating': not filters['min_rating'] or rating_bucket >= filters['min_rating'],
+        }
+        others = lambda facet: all(matched for name, matched in matches.items() if name != facet)
+        if others('category'):
+            counts['categories'][category_id] = counts['categories'].get(category_id, 0) + product_count
+        if others('price'):
+            counts['prices'][price_bucket] += product_count
+        if others('in_stock') and in_stock:
+            counts['in_stock'] += product_count
+        if others('min_rating'):
+            for rating in RATING_FILTERS:
+                if rating_bucket >= rating:
+                    counts['ratings'][rating] += product_count
+    return counts
+
+# Autocomplete
+# Each worker keeps product names, category names and blog titles in a
+# sorted word array and answers prefix queries with bisect. The admin routes
+# add new entries as they are created. Writes that add or rename entries
+# (including bulk imports and writes made by other workers) invalidate the
+# 'labels' cache tag, which triggers a rebuild in a background thread while
+# the current index keeps serving. Reviews and stock changes leave it alone,
+# so popularity scores catch up at the next rebuild. Builds never run inside
+# a request: until a worker's first one is in, suggestions are empty.
+AUTOCOMPLETE_TAGS = ('labels',)
+AUTOCOMPLETE_MAX_LIMIT = 20
+# Entries added since the last build are scanned on every query, so past
+# this many a rebuild folds them into the sorted arrays
+AUTOCOMPLETE_MAX_ADDED = 1000
+# Words of a label that are indexed; later words rarely start a query
+AUTOCOMPLETE_MAX_WORDS = 8
+# For prefixes matching more entries than this, the best AUTOCOMPLETE_TOP_SIZE
+# are kept until the next rebuild; further words filter that list
+AUTOCOMPLETE_SCAN_LIMIT = 2000
+AUTOCOMPLETE_TOP_SIZE = 500
+# Categories rank above every product, blog posts below
+CATEGORY_SCORE = float('inf')
+POST_SCORE = -1.0
+WORD_RE = re.compile(r'\w+')
+
+def autocomplete_words(label):
+    return WORD_RE.findall(label.lower())
+
+def product_score(rating_count, stock_quantity):
+    # Popularity first; stock (capped) breaks ties and sinks sold-out items
+    return rating_count + min(max(stock_quantity or 0, 0), 1000) / 1001
+
+def label_matches(label, prefixes):
+    words = autocomplete_words(label)
+    return all(any(word.startswith(prefix) for word in words) for prefix in prefixes)
+
+class PrefixIndex:
+    def __init__(self, items, versions):
+        # items are (score, kind, id, label), numbered from the best score
+        # down so that a smaller ref is always the better match. keys[i] is a
+        # word from the label of items[refs[i]].
+        self.items = sorted(items, key=lambda item: item[0], reverse=True)
+        self.versions = versions
+        self.built_at = time.time()
+        entries = sorted(
+            (sys.intern(word), index)
+            for index, item in enumerate(self.items)
+            for word in set(autocomplete_words(item[3])[:AUTOCOMPLETE_MAX_WORDS])
+        )
+        self.keys = [word for word, index in entries]
+        self.refs = array('l', (index for word, index in entries))
+        # Entries added since the build, checked on every query
+        self.added = []
+        self.top = {}
+
+    def word_range(self, prefix):
+        return bisect_left(self.keys, prefix), bisect_left(self.keys, prefix + '\U0010ffff')
+
+    def add(self, item):
+        self.added.append(item)
+
+    def search(self, query, limit):
+        words = autocomplete_words(query)
+        if not words:
+            return []
+        # Walk the narrowest word's matches from the best down and keep those
+        # whose label also has the other words
+        (low, high), word = min(
+            ((self.word_range(word), word) for word in words),
+            key=lambda r: r[0][1] - r[0][0]
+        )
+        others = [w for w in words if w != word]
+        if high - low > AUTOCOMPLETE_SCAN_LIMIT:
+            if word not in self.top:
+                self.top[word] = sorted(set(self.refs[low:high]))[:AUTOCOMPLETE_TOP_SIZE]
+            candidates = self.top[word]
+        else:
+            candidates = sorted(set(self.refs[low:high]))
+        results = []
+        for index in candidates:
+            item = self.items[index]
+            if others and not label_matches(item[3], others):
+                continue
+            results.append(item)
+            if len(results) == limit:
+                break
+        # An entry added while a rebuild read the tables can be in both
+        found = {(item[1], item[2]) for item in results}
+        added = [item for item in self.added if (item[1], item[2]) not in found and label_matches(item[3], words)]
+        if added:
+            results = heapq.nlargest(limit, results + added, key=lambda item: item[0])
+        return results
+
+def autocomplete_versions():
+    return tuple(tag_version(tag) for tag in AUTOCOMPLETE_TAGS)
+
+def autocomplete_items():
+    rows = db.session.query(
+        Product.id, Product.name, Product.stock_quantity, db.func.coalesce(ProductRating.rating_count, 0)
+    ).outerjoin(ProductRating, ProductRating.product_id == Product.id).yield_per(5000)
+    for product_id, name, stock_quantity, rating_count in rows:
+        yield (product_score(rating_count, stock_quantity), 'product', product_id, name)
+    for category_id, name in db.session.query(Category.id, Category.name):
+        yield (CATEGORY_SCORE, 'category', category_id, name)
+    for post_id, title in db.session.query(Blog.id, Blog.title):
+        yield (POST_SCORE, 'post', post_id, title)
+
+autocomplete_lock = threading.Lock()
+
+def rebuild_autocomplete(app):
+    with app.app_context():
+        previous = app.extensions.get('autocomplete')
+        carried = len(previous.added) if previous else 0
+        index = PrefixIndex(autocomplete_items(), autocomplete_versions())
+        # Entries added while the tables were read may be missing from them
+        if previous is not None:
+            index.added = previous.added[carried:]
+        app.extensions['autocomplete'] = index
+
+def start_autocomplete_rebuild(app):
+    # One build per worker at a time. The thread is kept rather than a flag
+    # so a worker forked mid-build (whose copy of it is dead) starts its own.
+    with autocomplete_lock:
+        thread = app.extensions.get('autocomplete_rebuild')
+        if thread is not None and thread.is_alive():
+            return
+        thread = threading.Thread(target=rebuild_autocomplete, args=(app,), name='autocomplete', daemon=True)
+        app.extensions['autocomplete_rebuild'] = thread
+        thread.start()
+
+@setup
+def warm_autocomplete(app):
+    if app.config['AUTOCOMPLETE_WARMUP']:
+        start_autocomplete_rebuild(app)
+
+def get_autocomplete_index():
+    # None until the worker's first build is in
+    app = current_app._get_current_object()
+    index = app.extensions.get('autocomplete')
+    if index is None:
+        start_autocomplete_rebuild(app)
+        return None
+    age = time.time() - index.built_at
+    stale = index.versions != autocomplete_versions()
+    if (
+        (stale and age >= app.config['AUTOCOMPLETE_REFRESH_SECONDS'])
+        or age >= app.config['AUTOCOMPLETE_MAX_AGE']
+        or len(index.added) > AUTOCOMPLETE_MAX_ADDED
+    ):
+        start_autocomplete_rebuild(app)
+    return index
+
+def autocomplete_add(kind, id, label, score):
+    # Called after the write is committed. Its 'labels' invalidation still
+    # marks the index stale, so the next rebuild takes the entry from the
+    # tables; until then it is served from the added list.
+    index = current_app.extensions.get('autocomplete')
+    if index is not None:
+        index.add((score, kind, id, label))
+
+# Request metrics
+# Counters live in each worker process and are updated under one lock at the
+# end of a request, so the per-request cost is a few timer reads. SQL time
+# comes from the engine's cursor events and template time from a Template
+# subclass that times each top-level render. Registered ahead of the other
+# response hooks so the recorded status is the one sent (after 304s).
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+def metric_labels(**labels):
+    escaped = (
+        f'{name}="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(escaped) + '}'
+
+class RequestMetrics:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # (endpoint, method) -> Histogram; (endpoint, method, status) -> count;
+        # endpoint or template -> [count, seconds]
+        self.latency = {}
+        self.responses = {}
+        self.sql = {}
+        self.templates = {}
+
+    def record_request(self, endpoint, method, status, elapsed, queries, sql_time):
+        with self.lock:
+            histogram = self.latency.get((endpoint, method))
+            if histogram is None:
+                histogram = self.latency[endpoint, method] = Histogram(self.buckets)
+            histogram.observe(elapsed)
+            key = (endpoint, method, status)
+            self.responses[key] = self.responses.get(key, 0) + 1
+            totals = self.sql.setdefault(endpoint, [0, 0.0])
+            totals[0] += queries
+            totals[1] += sql_time
+
+    def record_render(self, template, elapsed):
+        with self.lock:
+            totals = self.templates.setdefault(template, [0, 0.0])
+            totals[0] += 1
+            totals[1] += elapsed
+
+    def render(self):
+        with self.lock:
+            latency = [(key, list(h.counts), h.sum) for key, h in sorted(self.latency.items())]
+            responses = sorted(self.responses.items())
+            sql = [(key, list(totals)) for key, totals in sorted(self.sql.items())]
+            templates = [(key, list(totals)) for key, totals in sorted(self.templates.items())]
+
+        lines = [
+            '# HELP http_request_duration_seconds Time from routing to the response being returned.',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for (endpoint, method), counts, total in latency:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'http_request_duration_seconds_bucket{metric_labels(endpoint=endpoint, method=method, le=le)} {cumulative}')
+            labels = metric_labels(endpoint=endpoint, method=method)
+            lines.append(f'http_request_duration_seconds_sum{labels} {total!r}')
+            lines.append(f'http_request_duration_seconds_count{labels} {cumulative}')
+        lines += ['# HELP http_requests_total Responses sent.', '# TYPE http_requests_total counter']
+        for (endpoint, method, status), count in responses:
+            lines.append(f'http_requests_total{metric_labels(endpoint=endpoint, method=method, status=status)} {count}')
+        lines += ['# HELP sql_statements_total SQL statements executed while handling requests.', '# TYPE sql_statements_total counter']
+        lines += [f'sql_statements_total{metric_labels(endpoint=endpoint)} {count}' for endpoint, (count, seconds) in sql]
+        lines += ['# HELP sql_duration_seconds_total Time spent executing SQL while handling requests.', '# TYPE sql_duration_seconds_total counter']
+        lines += [f'sql_duration_seconds_total{metric_labels(endpoint=endpoint)} {seconds!r}' for endpoint, (count, seconds) in sql]
+        lines += ['# HELP template_render_duration_seconds Time spent rendering templates.', '# TYPE template_render_duration_seconds summary']
+        for template, (count, seconds) in templates:
+            labels = metric_labels(template=template)
+            lines.append(f'template_render_duration_seconds_sum{labels} {seconds!r}')
+            lines.append(f'template_render_duration_seconds_count{labels} {count}')
+        lines += [
+            '# HELP process_start_time_seconds When this worker started counting.',
+            '# TYPE process_start_time_seconds gauge',
+            f'process_start_time_seconds {self.started!r}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+def get_request_metrics():
+    metrics = current_app.extensions.get('metrics')
+    if metrics is None:
+        metrics = current_app.extensions.setdefault('metrics', RequestMetrics(current_app.config['METRICS_BUCKETS']))
+    return metrics
+
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if has_request_context():
+                g.template_time = g.get('template_time', 0.0) + elapsed
+            if current_app.config['METRICS_ENABLED']:
+                get_request_metrics().record_render(self.name or '<string>', elapsed)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if not has_request_context():
+        return
+    elapsed = time.perf_counter() - context.query_started
+    g.sql_time = g.get('sql_time', 0.0) + elapsed
+    if current_app.config['SLOW_REQUEST_SECONDS'] is not None:
+        # Keep only the slowest few; a min-heap makes each check O(log n)
+        slowest = g.setdefault('slowest_queries', [])
+        if len(slowest) < current_app.config['SLOW_REQUEST_QUERIES']:
+            heapq.heappush(slowest, (elapsed, statement))
+        else:
+            heapq.heappushpop(slowest, (elapsed, statement))
+
+@request_hook('before_request')
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@request_hook('after_request')
+def note_response_status(response):
+    g.response_status = response.status_code
+    return response
+
+@request_hook('teardown_request')
+def record_request_metrics(exc):
+    started = g.get('request_started')
+    if started is None:
+        return
+    elapsed = time.perf_counter() - started
+    endpoint = request.endpoint or 'unmatched'
+    status = 500 if exc is not None else g.get('response_status', 500)
+    queries = g.get('query_count', 0)
+    sql_time = g.get('sql_time', 0.0)
+    if current_app.config['METRICS_ENABLED']:
+        get_request_metrics().record_request(endpoint, request.method, status, elapsed, queries, sql_time)
+
+    threshold = current_app.config['SLOW_REQUEST_SECONDS']
+    if threshold is not None and elapsed >= threshold:
+        worst = ''.join(
+            f"\n  {seconds * 1000:.1f} ms  {' '.join(statement.split())[:300]}"
+            for seconds, statement in sorted(g.get('slowest_queries', []), reverse=True)
+        )
+        current_app.logger.warning(
+            'Slow request %s %s (%s, %s): %.3fs, %d SQL statements in %.3fs, templates %.3fs%s',
+            request.method, request.path, endpoint, status, elapsed,
+            queries, sql_time, g.get('template_time', 0.0), worst,
+        )
+
+# Query budget
+class QueryBudgetExceeded(Exception):
+    pass
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.query_count = g.get('query_count', 0) + 1
+
+@request_hook('before_request')
+def reset_query_count():
+    g.query_count = 0
+
+@request_hook('after_request')
+def check_query_budget(response):
+    count = g.get('query_count', 0)
+    response.headers['X-Query-Count'] = str(count)
+    budget = current_app.config['QUERY_BUDGETS'].get(request.endpoint)
+    if budget is not None and count > budget:
+        message = f"{request.endpoint} issued {count} SQL statements, budget is {budget}"
+        if current_app.testing:
+            raise QueryBudgetExceeded(message)
+        current_app.logger.warning(message)
+    return response
+
+# Caching
+class MemoryCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at is not None and expires_at < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (value, expires_at)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class SQLiteCache:
+    # Evicts least recently used entries once the table passes max_entries.
+    # Hits refresh used_at at most every TOUCH_INTERVAL seconds per entry and
+    # are written TOUCH_BATCH at a time, or with the next set().
+    PRUNE_EVERY = 100
+    TOUCH_INTERVAL = 60
+    TOUCH_BATCH = 100
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.writes = 0
+        self.touched = {}
+        self.touch_lock = threading.Lock()
+        with self.connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache "
+                "(key TEXT PRIMARY KEY, value BLOB, expires_at REAL, used_at REAL)"
+            )
+
+    def connection(self):
+        if not hasattr(self.local, 'conn'):
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return self.local.conn
+
+    def get(self, key):
+        conn = self.connection()
+        row = conn.execute('SELECT value, expires_at, used_at FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        value, expires_at, used_at = row
+        now = time.time()
+        if expires_at is not None and expires_at < now:
+            return None
+        if used_at is None or now - used_at >= self.TOUCH_INTERVAL:
+            with self.touch_lock:
+                self.touched[key] = now
+                flush = len(self.touched) >= self.TOUCH_BATCH
+            if flush:
+                try:
+                    with conn:
+                        self.flush_touches(conn)
+                except sqlite3.OperationalError:
+                    # Busy; a missed touch only makes eviction less exact
+                    pass
+        return pickle.loads(value)
+
+    def flush_touches(self, conn):
+        with self.touch_lock:
+            touched, self.touched = self.touched, {}
+        if touched:
+            conn.executemany('UPDATE cache SET used_at = ? WHERE key = ?', [(used_at, key) for key, used_at in touched.items()])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self.connection() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)',
+                (key, pickle.dumps(value), expires_at, now)
+            )
+            self.flush_touches(conn)
+            self.writes += 1
+            if self.writes % self.PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM cache WHERE expires_at < ?', (now,))
+                conn.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY used_at DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)
+                )
+
+    def clear(self):
+        with self.connection() as conn:
+            conn.execute('DELETE FROM cache')
+
+def get_cache():
+    if 'page_cache' not in current_app.extensions:
+        if current_app.config['CACHE_BACKEND'] == 'sqlite':
+            path = os.path.join(current_app.root_path, current_app.config['CACHE_PATH'])
+            current_app.extensions['page_cache'] = SQLiteCache(path, current_app.config['CACHE_MAX_ENTRIES'])
+        else:
+            current_app.extensions['page_cache'] = MemoryCache(current_app.config['CACHE_MAX_ENTRIES'])
+    return current_app.extensions['page_cache']
+
+# Cached entries embed the current version of each tag they depend on, so
+# invalidating a tag is a single write that orphans every dependent entry.
+def tag_version(tag):
+    cache = get_cache()
+    version = cache.get('tag:' + tag)
+    if version is None:
+        version = uuid.uuid4().hex
+        cache.set('tag:' + tag, version)
+    return version
+
+def invalidate(*tags):
+    cache = get_cache()
+    for tag in tags:
+        cache.set('tag:' + tag, uuid.uuid4().hex)
+
+def cached_fragment(name, tags, build, ttl=None):
+    if not current_app.config['CACHE_ENABLED']:
+        return build()
+    cache = get_cache()
+    key = 'fragment:' + name + ':' + ':'.join(tag_version(tag) for tag in tags)
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, ttl or current_app.config['CACHE_DEFAULT_TTL'])
+    return value
+
+def cached_page(*tags, ttl=None):
+    # Full-page cache for anonymous visitors. Anything personalised (a
+    # logged-in user, pending flash messages) bypasses it.
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_app.config['CACHE_ENABLED'] or session.get('user_id') or session.get('_flashes'):
+                return view(*args, **kwargs)
+            cache = get_cache()
+            key = 'page:' + request.full_path + ':' + ':'.join(tag_version(tag) for tag in tags)
+            cached = cache.get(key)
+            if cached is not None:
+                body, mimetype, last_modified = cached
+                response = current_app.response_class(body, mimetype=mimetype)
+                response.last_modified = last_modified
+                response.headers['X-Cache'] = 'HIT'
+                return response
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200:
+                entry = (response.get_data(), response.mimetype, response.last_modified)
+                cache.set(key, entry, ttl or current_app.config['CACHE_DEFAULT_TTL'])
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+def category_list():
+    # Shared by the home page, catalog filter and admin forms
+    return cached_fragment('categories', ['categories'], lambda: [
+        {'id': c.id, 'name': c.name, 'description': c.description}
+        for c in Category.query.order_by(Category.id)
+    ])
+
+# Conditional GET and compression
+@request_hook('after_request')
+def conditional_and_compressed(response):
+    if request.method not in ('GET', 'HEAD') or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.status_code != 200 or response.mimetype not in current_app.config['COMPRESS_MIMETYPES']:
+        return response
+
+    # The ETag is a hash of the uncompressed body, so one validator covers
+    # every encoding and unchanged pages come back as 304 with no body
+    response.vary.add('Cookie')
+    response.add_etag()
+    response.make_conditional(request)
+    if response.status_code != 200:
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE'] or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if brotli and request.accept_encodings['br']:
+        response.set_data(brotli.compress(data))
+        response.headers['Content-Encoding'] = 'br'
+    elif request.accept_encodings['gzip']:
+        response.set_data(gzip.compress(data, compresslevel=current_app.config['COMPRESS_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    etag, _ = response.get_etag()
+    response.set_etag(etag, weak=True)
+    return response
+
+# Static assets
+# Templates link static files through static_url(), which appends a content
+# hash. Those URLs never change content, so they are cached for a year.
+# 'flask compress-static' writes .gz/.br siblings that are served in place
+# of the original when the client accepts them and they are no older than
+# it, so an asset edited since the last compress-static is sent as it is.
+STATIC_PRECOMPRESS_EXTENSIONS = ('.css', '.js', '.svg', '.txt')
+static_fingerprints = {}
+
+@template_global
+def static_url(filename):
+    if filename not in static_fingerprints:
+        path = safe_join(current_app.static_folder, filename)
+        with open(path, 'rb') as f:
+            static_fingerprints[filename] = hashlib.sha256(f.read()).hexdigest()[:12]
+    return url_for('static', filename=filename, v=static_fingerprints[filename])
+
+def precompressed_is_current(source, path):
+    try:
+        return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(source)
+    except (OSError, TypeError):
+        return False
+
+def serve_static(filename):
+    mimetype = mimetypes.guess_type(filename)[0]
+    source = safe_join(current_app.static_folder, filename)
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        path = safe_join(current_app.static_folder, filename + suffix)
+        if request.accept_encodings[encoding] and precompressed_is_current(source, path):
+            response = send_from_directory(current_app.static_folder, filename + suffix, mimetype=mimetype)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = current_app.send_static_file(filename)
+    response.vary.add('Accept-Encoding')
+    if request.args.get('v'):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = 31536000
+        response.cache_control.immutable = True
+    return response
+
+@setup
+def use_static_view(app):
+    app.view_functions['static'] = serve_static
+
+@cli.command('compress-static')
+def compress_static_command():
+    """Write precompressed copies of the static text assets."""
+    for root, _, files in os.walk(current_app.static_folder):
+        for name in files:
+            if not name.endswith(STATIC_PRECOMPRESS_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                data = f.read()
+            with open(path + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9))
+            if brotli:
+                with open(path + '.br', 'wb') as f:
+                    f.write(brotli.compress(data))
+            click.echo(os.path.relpath(path, current_app.static_folder))
+
+# Template compilation
+# Jinja keys each cached template on its name and a checksum of its source,
+# so edited templates are recompiled and a new Python version starts afresh.
+# 'flask compile-templates' fills the cache as a build step.
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    # Creates its directory on the first write, keeping imports free of I/O
+    def dump_bytecode(self, bucket):
+        os.makedirs(self.directory, exist_ok=True)
+        super().dump_bytecode(bucket)
+
+def template_bytecode_cache(app):
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    return TemplateBytecodeCache(os.path.join(app.root_path, cache_dir)) if cache_dir else None
+
+def warm_templates(env=None):
+    # Loads every template into the environment's in-memory cache, from the
+    # bytecode cache where it has a current entry
+    env = env or current_app.jinja_env
+    names = env.list_templates(extensions=['html'])
+    for name in names:
+        env.get_template(name)
+    return names
+
+@cli.command('compile-templates')
+def compile_templates_command():
+    """Compile every template into the shared bytecode cache."""
+    if current_app.jinja_env.bytecode_cache is None:
+        raise click.ClickException('TEMPLATE_CACHE_DIR is not set.')
+    started = time.perf_counter()
+    names = warm_templates()
+    click.echo(f'{len(names)} templates cached in {current_app.jinja_env.bytecode_cache.directory} '
+               f'({(time.perf_counter() - started) * 1000:.0f} ms)')
+
+@cli.command('bench-templates')
+def bench_templates_command():
+    """Time loading each template from source, from the bytecode cache and from memory."""
+    timings = {}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        # The first pass also pulls the sources into the OS page cache, so
+        # no timing below includes a disk read
+        primed = current_app.create_jinja_environment()
+        primed.bytecode_cache = TemplateBytecodeCache(cache_dir)
+        warm_templates(primed)
+        # A fresh environment per source, as a newly started worker would have
+        environments = {'source': current_app.create_jinja_environment(), 'bytecode': current_app.create_jinja_environment()}
+        environments['bytecode'].bytecode_cache = TemplateBytecodeCache(cache_dir)
+        environments['memory'] = primed
+        for label, env in environments.items():
+            for name in env.list_templates(extensions=['html']):
+                started = time.perf_counter()
+                env.get_template(name)
+                timings.setdefault(name, {})[label] = (time.perf_counter() - started) * 1000
+
+    click.echo(f"{'template':<28} {'source ms':>10} {'bytecode ms':>12} {'memory ms':>10}")
+    for name, row in sorted(timings.items(), key=lambda item: -item[1]['source']):
+        click.echo(f"{name:<28} {row['source']:>10.2f} {row['bytecode']:>12.2f} {row['memory']:>10.3f}")
+    totals = {label: sum(row[label] for row in timings.values()) for label in ('source', 'bytecode', 'memory')}
+    click.echo(f"{'total':<28} {totals['source']:>10.2f} {totals['bytecode']:>12.2f} {totals['memory']:>10.3f}")
+
+# Product images
+# An upload is stored as <sha256>.<ext> and its variants as
+# <sha256>-<width>.webp/.jpg, so a URL always names the same bytes and is
+# served as immutable. Variants are made in the background after upload; a
+# variant requested before it exists is queued again and answered with the
+# original, cached only briefly. Smaller originals are never upscaled, so a
+# variant can be narrower than its name says.
+IMAGE_URL_PREFIX = '/images/'
+IMAGE_NAME_RE = re.compile(r'([0-9a-f]{64})(?:-(\d+))?\.(jpg|png|gif|webp)')
+IMAGE_EXTENSIONS = ('jpg', 'png', 'gif', 'webp')
+# (Pillow format, extension) of each variant
+IMAGE_VARIANT_FORMATS = (('WEBP', 'webp'), ('JPEG', 'jpg'))
+
+def sniff_image(data):
+    # The extension for the image type in the first bytes, or None
+    if data[:3] == b'\xff\xd8\xff':
+        return 'jpg'
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def image_path(name):
+    # Files are spread over 256 directories by the first byte of the hash
+    return os.path.join(current_app.root_path, current_app.config['IMAGE_STORE_DIR'], name[:2], name)
+
+def write_image_file(name, data):
+    path = image_path(name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under a temporary name and renamed, so no reader sees half a file
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), suffix='.tmp', delete=False) as f:
+        f.write(data)
+    os.replace(f.name, path)
+
+def store_image(data, ext):
+    digest = hashlib.sha256(data).hexdigest()
+    name = f'{digest}.{ext}'
+    if not os.path.exists(image_path(name)):
+        write_image_file(name, data)
+    if Image is not None:
+        get_image_pipeline().submit(digest, ext)
+    return IMAGE_URL_PREFIX + name
+
+def make_image_variants(digest, ext):
+    quality = current_app.config['IMAGE_QUALITY']
+    widths = [
+        width for width in sorted(current_app.config['IMAGE_WIDTHS'])
+        if not all(os.path.exists(image_path(f'{digest}-{width}.{variant_ext}')) for fmt, variant_ext in IMAGE_VARIANT_FORMATS)
+    ]
+    if not widths:
+        return
+    with Image.open(image_path(f'{digest}.{ext}')) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info or 'A' in image.mode else 'RGB')
+        for width in widths:
+            resized = image.copy()
+            resized.thumbnail((width, width * 10), Image.LANCZOS)
+            for fmt, variant_ext in IMAGE_VARIANT_FORMATS:
+                name = f'{digest}-{width}.{variant_ext}'
+                if os.path.exists(image_path(name)):
+                    continue
+                output = resized
+                if fmt == 'JPEG' and resized.mode == 'RGBA':
+                    # JPEG has no alpha channel; flatten onto white
+                    output = Image.new('RGB', resized.size, (255, 255, 255))
+                    output.paste(resized, mask=resized.getchannel('A'))
+                buffer = io.BytesIO()
+                if fmt == 'JPEG':
+                    output.save(buffer, fmt, quality=quality, optimize=True, progressive=True)
+                else:
+                    output.save(buffer, fmt, quality=quality, method=4)
+                write_image_file(name, buffer.getvalue())
+
+class ImagePipeline:
+    def __init__(self, app, workers):
+        self.app = app
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='images')
+        self.pending = set()
+        self.lock = threading.Lock()
+
+    def submit(self, digest, ext):
+        with self.lock:
+            if digest in self.pending:
+                return
+            self.pending.add(digest)
+        self.executor.submit(self.run, digest, ext)
+
+    def run(self, digest, ext):
+        with self.app.app_context():
+            try:
+                make_image_variants(digest, ext)
+            except Exception:
+                current_app.logger.exception('Could not resize image %s.%s', digest, ext)
+            finally:
+                with self.lock:
+                    self.pending.discard(digest)
+
+def get_image_pipeline():
+    pipeline = current_app.extensions.get('image_pipeline')
+    if pipeline is None:
+        pipeline = current_app.extensions.setdefault('image_pipeline', ImagePipeline(
+            current_app._get_current_object(), current_app.config['IMAGE_WORKERS']
+        ))
+    return pipeline
+
+@template_global
+def image_variants(url):
+    # srcset strings for an uploaded image, or None for remote URLs and
+    # when there are no variants to offer
+    if Image is None or not url or not url.startswith(IMAGE_URL_PREFIX):
+        return None
+    match = IMAGE_NAME_RE.fullmatch(url[len(IMAGE_URL_PREFIX):])
+    if not match or match.group(2):
+        return None
+    digest = match.group(1)
+    widths = sorted(current_app.config['IMAGE_WIDTHS'])
+    variants = {
+        ext: ', '.join(f'{IMAGE_URL_PREFIX}{digest}-{width}.{ext} {width}w' for width in widths)
+        for fmt, ext in IMAGE_VARIANT_FORMATS
+    }
+    variants['src'] = f'{IMAGE_URL_PREFIX}{digest}-{widths[len(widths) // 2]}.jpg'
+    return variants
+
+@route(IMAGE_URL_PREFIX + '<name>')
+def product_image(name):
+    match = IMAGE_NAME_RE.fullmatch(name)
+    if not match:
+        abort(404)
+    digest, width, ext = match.groups()
+    if width is not None and (
+        width not in {str(w) for w in current_app.config['IMAGE_WIDTHS']}
+        or ext not in {variant_ext for fmt, variant_ext in IMAGE_VARIANT_FORMATS}
+    ):
+        # Only the configured variants are ever made
+        abort(404)
+    path = image_path(name)
+    if os.path.isfile(path):
+        response = send_from_directory(os.path.dirname(path), name, max_age=31536000)
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    original = next((f'{digest}.{ext}' for ext in IMAGE_EXTENSIONS if os.path.isfile(image_path(f'{digest}.{ext}'))), None)
+    if width is None or original is None:
+        abort(404)
+    if Image is not None:
+        get_image_pipeline().submit(digest, original.rsplit('.', 1)[1])
+    return send_from_directory(os.path.dirname(image_path(original)), original, max_age=60)
+
+@cli.command('build-images')
+def build_images_command():
+    """Make any missing resized variants of the stored product images."""
+    if Image is None:
+        raise click.ClickException('Resizing images needs Pillow (pip install Pillow).')
+    count = 0
+    for root, _, files in os.walk(os.path.join(current_app.root_path, current_app.config['IMAGE_STORE_DIR'])):
+        for name in files:
+            match = IMAGE_NAME_RE.fullmatch(name)
+            if match and not match.group(2):
+                make_image_variants(match.group(1), match.group(3))
+                count += 1
+    click.echo(f'{count} images checked.')
+
+# Keyset pagination
+# Listings page on their sort key instead of OFFSET, so every page costs the
+# same regardless of how deep into the table it is.
+PER_PAGE = 24
+MAX_PER_PAGE = 100
+
+class KeysetPage:
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+
+    def url_for(self, direction, cursor):
+        args = request.args.to_dict()
+        args.pop('after', None)
+        args.pop('before', None)
+        args[direction] = cursor
+        return url_for(request.endpoint, **dict(request.view_args or {}, **args))
+
+    @property
+    def next_url(self):
+        return self.url_for('after', self.next_cursor) if self.next_cursor else None
+
+    @property
+    def prev_url(self):
+        return self.url_for('before', self.prev_cursor) if self.prev_cursor else None
+
+def encode_cursor(row, by_date):
+    if by_date:
+        return f"{row.created_at.isoformat()}_{row.id}"
+    return str(row.id)
+
+def decode_cursor(cursor, by_date):
+    if not cursor:
+        return None
+    try:
+        if by_date:
+            created_at, id = cursor.rsplit('_', 1)
+            return (datetime.fromisoformat(created_at), int(id))
+        return (int(cursor),)
+    except ValueError:
+        return None
+
+def paginate(query, model, by_date=True):
+    # by_date pages newest first on (created_at, id); otherwise oldest first on id
+    per_page = min(max(request.args.get('per_page', PER_PAGE, type=int), 1), MAX_PER_PAGE)
+    if by_date:
+        key = tuple_(model.created_at, model.id)
+        order = (model.created_at.desc(), model.id.desc())
+        reverse_order = (model.created_at.asc(), model.id.asc())
+        follows = lambda cursor: key < tuple_(*cursor)
+        precedes = lambda cursor: key > tuple_(*cursor)
+    else:
+        order = (model.id.asc(),)
+        reverse_order = (model.id.desc(),)
+        follows = lambda cursor: model.id > cursor[0]
+        precedes = lambda cursor: model.id < cursor[0]
+    after = decode_cursor(request.args.get('after'), by_date)
+    before = decode_cursor(request.args.get('before'), by_date)
+
+    # Counting is a full scan, so it only runs when asked for
+    total = None
+    if request.args.get('count'):
+        total = query.order_by(None).count()
+
+    if before:
+        rows = query.filter(precedes(before)).order_by(*reverse_order).limit(per_page + 1).all()
+        items = list(reversed(rows[:per_page]))
+        prev_cursor = encode_cursor(items[0], by_date) if len(rows) > per_page else None
+        next_cursor = encode_cursor(items[-1], by_date) if items else None
+    else:
+        if after:
+            query = query.filter(follows(after))
+        rows = query.order_by(*order).limit(per_page + 1).all()
+        items = rows[:per_page]
+        next_cursor = encode_cursor(items[-1], by_date) if len(rows) > per_page else None
+        prev_cursor = encode_cursor(items[0], by_date) if after and items else None
+    return KeysetPage(items, next_cursor, prev_cursor, total)
+
+# Store counters
+# Totals for the admin dashboard, bumped by the write paths in the same
+# transaction as the rows they count. reconcile-counters rebuilds them.
+COUNTED_MODELS = {'users': User, 'products': Product, 'orders': Order, 'reviews': Review}
+
+def order_status_counter(status):
+    return f"orders_{status}"
+
+def bump_counters(deltas):
+    counter = StoreCounter.__table__
+    stmt = upsert_insert(counter)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['name'],
+        set_={'value': counter.c.value + stmt.excluded.value}
+    )
+    db.session.execute(stmt, [{'name': name, 'value': value} for name, value in deltas.items()])
+
+def read_counters():
+    counters = dict(db.session.query(StoreCounter.name, StoreCounter.value))
+    stats = {name: int(counters.get(name, 0)) for name in COUNTED_MODELS}
+    stats['revenue'] = counters.get('revenue', 0)
+    stats['orders_by_status'] = {
+        name[len('orders_'):]: int(value)
+        for name, value in sorted(counters.items())
+        if name.startswith('orders_') and value
+    }
+    return stats
+
+def reconcile_counters():
+    counters = {name: model.query.count() for name, model in COUNTED_MODELS.items()}
+    counters['revenue'] = db.session.query(db.func.coalesce(db.func.sum(Order.total_amount), 0)).scalar()
+    for status, count in db.session.query(Order.status, db.func.count(Order.id)).group_by(Order.status):
+        counters[order_status_counter(status)] = count
+    StoreCounter.query.delete()
+    db.session.execute(StoreCounter.__table__.insert(), [
+        {'name': name, 'value': value} for name, value in counters.items()
+    ])
+
+# Product ratings
+# Per-product review count, sum and average, updated by add_review so
+# listings can show and sort by rating without reading the review table.
+def record_rating(product_id, rating_sum, rating_count=1):
+    # Adds rating_count ratings totalling rating_sum to the product's summary
+    summary = ProductRating.__table__
+    stmt = upsert_insert(summary).values(
+        product_id=product_id, rating_count=rating_count, rating_sum=rating_sum,
+        rating_avg=rating_sum * 1.0 / rating_count
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['product_id'],
+        set_={
+            'rating_count': summary.c.rating_count + stmt.excluded.rating_count,
+            'rating_sum': summary.c.rating_sum + stmt.excluded.rating_sum,
+            'rating_avg': (summary.c.rating_sum + stmt.excluded.rating_sum) * 1.0 / (summary.c.rating_count + stmt.excluded.rating_count),
+        }
+    )
+    db.session.execute(stmt)
+
+# Matches ix_product_rating_rank so the ordering is read straight off the index
+TOP_RATED_ORDER = (
+    ProductRating.rating_avg.desc(),
+    ProductRating.rating_count.desc(),
+    ProductRating.product_id.desc(),
+)
+
+def reconcile_ratings():
+    ProductRating.query.delete()
+    totals = db.session.query(
+        Review.product_id,
+        db.func.count(Review.id),
+        db.func.sum(Review.rating),
+        db.func.avg(Review.rating)
+    ).group_by(Review.product_id)
+    db.session.execute(ProductRating.__table__.insert().from_select(
+        ['product_id', 'rating_count', 'rating_sum', 'rating_avg'], totals
+    ))
+
+def init_counters():
+    # A database with rows from before the counter and rating tables existed
+    # gets them filled once, like the search and facet indexes
+    if StoreCounter.query.first() is None:
+        reconcile_counters()
+    if ProductRating.query.first() is None and Review.query.first() is not None:
+        reconcile_ratings()
+    db.session.commit()
+
+@cli.command('reconcile-counters')
+def reconcile_counters_command():
+    """Recompute the dashboard counters, product ratings and facet counts from the tables."""
+    reconcile_counters()
+    reconcile_ratings()
+    rebuild_facets()
+    db.session.commit()
+    click.echo('Counters reconciled.')
+
+# Cart store
+# Carts live in the cart_item table. The session only carries the user id,
+# or a random cart id for guests, which is merged into the user's cart on
+# login. Guests can fill a cart; checkout asks them to log in first.
+def user_cart_id(user_id):
+    return f"user-{user_id}"
+
+def current_cart_id():
+    if session.get('user_id'):
+        return user_cart_id(session['user_id'])
+    if 'cart_id' not in session:
+        session['cart_id'] = uuid.uuid4().hex
+    return session['cart_id']
+
+def cart_add(cart_id, product_id, quantity):
+    # Atomic increment: a single upsert on the (cart_id, product_id) key
+    if quantity < 1:
+        raise ValueError('quantity must be at least 1')
+    stmt = upsert_insert(CartItem.__table__).values(
+        cart_id=cart_id, product_id=product_id, quantity=quantity, updated_at=datetime.utcnow()
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['cart_id', 'product_id'],
+        set_={
+            'quantity': CartItem.__table__.c.quantity + stmt.excluded.quantity,
+            'updated_at': stmt.excluded.updated_at,
+        }
+    )
+    db.session.execute(stmt)
+
+def cart_set_quantity(cart_id, product_id, quantity):
+    if quantity <= 0:
+        cart_remove(cart_id, product_id)
+        return
+    updated = CartItem.query.filter_by(cart_id=cart_id, product_id=product_id).update(
+        {'quantity': quantity, 'updated_at': datetime.utcnow()}
+    )
+    if not updated:
+        cart_add(cart_id, product_id, quantity)
+
+def cart_remove(cart_id, product_id):
+    CartItem.query.filter_by(cart_id=cart_id, product_id=product_id).delete()
+
+def cart_clear(cart_id):
+    CartItem.query.filter_by(cart_id=cart_id).delete()
+
+def lock_cart(cart_id):
+    # The first write of a checkout. A concurrent checkout of the same cart
+    # waits here until this one commits, then finds the cart already cleared.
+    # Returns the number of lines in the cart.
+    return CartItem.query.filter_by(cart_id=cart_id).update(
+        {'updated_at': datetime.utcnow()}, synchronize_session=False
+    )
+
+def cart_items(cart_id):
+    rows = db.session.query(CartItem.product_id, CartItem.quantity).filter_by(cart_id=cart_id).order_by(CartItem.product_id)
+    return [{'product_id': product_id, 'quantity': quantity} for product_id, quantity in rows]
+
+def merge_carts(source_id, target_id):
+    for item in cart_items(source_id):
+        cart_add(target_id, item['product_id'], item['quantity'])
+    cart_clear(source_id)
+
+def purge_guest_carts(before):
+    # A cart goes only when none of its lines was touched since the cutoff.
+    # Users' carts are kept.
+    recent = db.session.query(CartItem.cart_id).filter(CartItem.updated_at >= before)
+    return CartItem.query.filter(
+        CartItem.updated_at < before,
+        ~CartItem.cart_id.startswith(user_cart_id('')),
+        ~CartItem.cart_id.in_(recent.scalar_subquery()),
+    ).delete(synchronize_session=False)
+
+@cli.command('purge-carts')
+@click.option('--days', type=int, default=None, help='Defaults to GUEST_CART_DAYS.')
+def purge_carts_command(days):
+    """Delete guest cart lines not updated for GUEST_CART_DAYS."""
+    days = current_app.config['GUEST_CART_DAYS'] if days is None else days
+    deleted = purge_guest_carts(datetime.utcnow() - timedelta(days=days))
+    db.session.commit()
+    click.echo(f'Deleted {deleted} guest cart lines.')
+
+# Cart pricing
+class PricedCart:
+    def __init__(self, lines, total):
+        self.lines = lines
+        self.total = total
+
+    def order_item_rows(self, order_id):
+        return [
+            {
+                'order_id': order_id,
+                'product_id': line['product'].id,
+                'quantity': line['quantity'],
+                'price': line['product'].price,
+            }
+            for line in self.lines
+        ]
+
+def price_cart(cart_items):
+    # Resolve every cart line with a single IN query; lines whose product
+    # no longer exists are dropped
+    product_ids = {item['product_id'] for item in cart_items}
+    products = {}
+    if product_ids:
+        products = {p.id: p for p in Product.query.filter(Product.id.in_(product_ids))}
+
+    lines = []
+    total = 0
+    for item in cart_items:
+        product = products.get(item['product_id'])
+        if product:
+            line_total = product.price * item['quantity']
+            lines.append({
+                'product': product,
+                'quantity': item['quantity'],
+                'line_total': line_total
+            })
+            total += line_total
+    return PricedCart(lines, total)
+
+# Inventory reservation
+# Stock is taken with conditional UPDATEs (stock_quantity >= qty), so
+# concurrent checkouts never oversell and never hold a lock across a
+# read-modify-write in Python. A hold is handed back only by whoever deletes
+# it, so two releases of the same hold credit its stock once.
+class OutOfStock(Exception):
+    def __init__(self, products):
+        super().__init__(', '.join(p.name for p in products))
+        self.products = products
+
+def decrement_stock(lines):
+    if not lines:
+        return
+    if any(line['quantity'] < 1 for line in lines):
+        raise ValueError('quantities must be at least 1')
+    product = Product.__table__
+    stmt = product.update().where(
+        product.c.id == bindparam('line_product_id'),
+        product.c.stock_quantity >= bindparam('line_quantity')
+    ).values(stock_quantity=product.c.stock_quantity - bindparam('line_quantity'))
+    params = [{'line_product_id': line['product'].id, 'line_quantity': line['quantity']} for line in lines]
+    result = db.session.execute(stmt, params)
+    if result.rowcount != len(lines):
+        # Work out which lines could not be filled before giving up
+        quantities = {line['product'].id: line['quantity'] for line in lines}
+        db.session.rollback()
+        products = Product.query.filter(Product.id.in_(quantities)).all()
+        raise OutOfStock([p for p in products if (p.stock_quantity or 0) < quantities[p.id]])
+
+def release_reservations(query):
+    reservation = StockReservation.__table__
+    if db.engine.dialect.name == 'postgresql':
+        claimed = db.session.execute(
+            reservation.delete()
+            .where(reservation.c.id.in_(query.with_entities(StockReservation.id).scalar_subquery()))
+            .returning(reservation.c.product_id, reservation.c.quantity)
+        ).all()
+    else:
+        # SQLite has no DELETE ... RETURNING here, so each hold is claimed by
+        # its own DELETE and only credited when that removed the row
+        rows = query.with_entities(StockReservation.id, StockReservation.product_id, StockReservation.quantity).all()
+        claimed = [
+            (product_id, quantity) for id, product_id, quantity in rows
+            if db.session.execute(reservation.delete().where(reservation.c.id == id)).rowcount == 1
+        ]
+    if not claimed:
+        return
+    product = Product.__table__
+    db.session.execute(
+        product.update().where(product.c.id == bindparam('held_product_id')).values(
+            stock_quantity=product.c.stock_quantity + bindparam('held_quantity')
+        ),
+        [{'held_product_id': product_id, 'held_quantity': quantity} for product_id, quantity in claimed]
+    )
+
+def release_expired_reservations(product_ids=None):
+    # With product_ids, only the holds on those products; called before stock
+    # is taken so an expired hold never blocks a sale
+    query = StockReservation.query.filter(StockReservation.expires_at < datetime.utcnow())
+    if product_ids is not None:
+        query = query.filter(StockReservation.product_id.in_(product_ids))
+    release_reservations(query)
+
+def take_stock(cart_id, lines):
+    # Hands back this cart's own holds and any expired ones on the same
+    # products, then takes the stock for the lines
+    release_reservations(StockReservation.query.filter_by(cart_id=cart_id))
+    release_expired_reservations([line['product'].id for line in lines])
+    decrement_stock(lines)
+
+def reserve_stock(cart_id, lines):
+    # Replace whatever this cart already holds with the current lines
+    take_stock(cart_id, lines)
+    expires_at = datetime.utcnow() + timedelta(minutes=current_app.config['RESERVATION_TTL_MINUTES'])
+    if lines:
+        db.session.execute(StockReservation.__table__.insert(), [
+            {'cart_id': cart_id, 'product_id': line['product'].id, 'quantity': line['quantity'], 'expires_at': expires_at}
+            for line in lines
+        ])
+
+@cli.command('release-reservations')
+def release_reservations_command():
+    """Return stock held by abandoned checkouts."""
+    release_expired_reservations()
+    db.session.commit()
+    click.echo('Expired reservations released.')
+
+# Catalog import
+# 'flask import-products' and the admin upload stream a CSV or JSON Lines
+# feed and upsert it on SKU, one executemany and one commit per batch. Only
+# the current batch and the category names are held in memory.
+PRODUCT_IMPORT_FIELDS = ('sku', 'name', 'description', 'price', 'stock_quantity', 'image_url', 'category_id')
+CATALOG_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+
+class ImportReport:
+    def __init__(self, max_errors):
+        self.max_errors = max_errors
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.error_count = 0
+        self.errors = []
+
+    def add_error(self, line_number, message):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append((line_number, message))
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'error_count': self.error_count,
+            'errors': [{'line': line, 'message': message} for line, message in self.errors],
+        }
+
+def catalog_format(filename):
+    return CATALOG_FORMATS.get(os.path.splitext(filename or '')[1].lower())
+
+def read_catalog_rows(stream, fmt):
+    # Yields (line number, row) from a binary stream without reading it whole
+    text_stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+    if fmt == 'csv':
+        reader = csv.DictReader(text_stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(text_stream, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            yield line_number, None
+
+def parse_product_row(row, categories):
+    # Returns the product column values, or raises ValueError with the reason
+    if not isinstance(row, dict):
+        raise ValueError('not a valid JSON object')
+    values = {field: str(row.get(field) or '').strip() for field in ('sku', 'name', 'description', 'image_url')}
+    if not values['sku']:
+        raise ValueError('sku is required')
+    if len(values['sku']) > 64:
+        raise ValueError('sku is longer than 64 characters')
+    if not values['name']:
+        raise ValueError('name is required')
+    if len(values['name']) > 200 or len(values['image_url']) > 200:
+        raise ValueError('name and image_url are limited to 200 characters')
+    try:
+        values['price'] = float(row.get('price'))
+        values['stock_quantity'] = int(row.get('stock_quantity') or 0)
+    except (TypeError, ValueError):
+        raise ValueError('price must be a number and stock_quantity a whole number')
+    if not math.isfinite(values['price']):
+        raise ValueError('price must be a finite number')
+    if values['price'] < 0 or values['stock_quantity'] < 0:
+        raise ValueError('price and stock_quantity cannot be negative')
+    category = str(row.get('category') or '').strip()
+    if category:
+        if len(category) > 100:
+            raise ValueError('category is limited to 100 characters')
+        if category.lower() in categories:
+            values['category_id'] = categories[category.lower()]
+        else:
+            # Created by write_product_rows in the batch's own transaction
+            values['category'] = category
+    else:
+        try:
+            values['category_id'] = int(row.get('category_id'))
+        except (TypeError, ValueError):
+            raise ValueError('category or category_id is required')
+        if values['category_id'] not in categories.values():
+            raise ValueError(f"unknown category_id {values['category_id']}")
+    return values
+
+def product_category_ids(rows):
+    # Rows that name a category not in the table yet carry it under
+    # 'category'. It is created here, so a rolled back batch leaves none behind.
+    names = {}
+    for values in rows:
+        if 'category' in values:
+            names.setdefault(values['category'].lower(), values['category'])
+    if not names:
+        return rows, {}
+    ids = {
+        name.lower(): category_id for category_id, name in
+        db.session.query(Category.id, Category.name).filter(db.func.lower(Category.name).in_(list(names)))
+    }
+    for key, name in names.items():
+        if key not in ids:
+            category = Category(name=name)
+            db.session.add(category)
+            db.session.flush()
+            ids[key] = category.id
+    rows = [
+        dict({field: value for field, value in values.items() if field != 'category'}, category_id=ids[values['category'].lower()])
+        if 'category' in values else values
+        for values in rows
+    ]
+    return rows, ids
+
+def write_product_rows(rows, existing, report, categories=None):
+    rows, created = product_category_ids(rows)
+    stmt = upsert_insert(Product.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['sku'],
+        set_={field: stmt.excluded[field] for field in PRODUCT_IMPORT_FIELDS if field != 'sku'},
+    )
+    db.session.execute(stmt, rows)
+    inserted = sum(1 for values in rows if values['sku'] not in existing)
+    if inserted:
+        bump_counters({'products': inserted})
+    db.session.commit()
+    if categories is not None:
+        categories.update(created)
+    report.inserted += inserted
+    report.updated += len(rows) - inserted
+
+def write_product_batch(batch, report, categories=None):
+    # batch maps each SKU to (line number, column values). Categories created
+    # for the batch are added to categories (lowercased name to id).
+    existing = {sku for (sku,) in db.session.query(Product.sku).filter(Product.sku.in_(list(batch)))}
+    try:
+        write_product_rows([values for line_number, values in batch.values()], existing, report, categories)
+    except (DataError, IntegrityError):
+        # Written again row by row so the rows the database rejects are
+        # reported and the rest of the batch still goes in
+        db.session.rollback()
+        for line_number, values in batch.values():
+            try:
+                write_product_rows([values], existing, report, categories)
+            except (DataError, IntegrityError) as e:
+                db.session.rollback()
+                report.add_error(line_number, f'rejected by the database: {e.orig}')
+    # The search index follows through its triggers; the caches are dropped
+    # once for the whole batch
+    invalidate('catalog', 'categories', 'labels')
+
+def import_catalog(stream, fmt, batch_size=None, progress=None):
+    batch_size = batch_size or current_app.config['IMPORT_BATCH_SIZE']
+    report = ImportReport(current_app.config['IMPORT_MAX_ERRORS'])
+    categories = {name.lower(): category_id for category_id, name in db.session.query(Category.id, Category.name)}
+    # Keyed by SKU so a repeated SKU within a batch keeps its last row
+    batch = {}
+    for line_number, row in read_catalog_rows(stream, fmt):
+        report.rows += 1
+        try:
+            values = parse_product_row(row, categories)
+        except ValueError as e:
+            report.add_error(line_number, str(e))
+            continue
+        batch[values['sku']] = (line_number, values)
+        if len(batch) >= batch_size:
+            write_product_batch(batch, report, categories)
+            batch = {}
+            if progress:
+                progress(report)
+    if batch:
+        write_product_batch(batch, report, categories)
+    if progress:
+        progress(report)
+    return report
+
+@cli.command('import-products')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), help='Defaults to the file extension.')
+@click.option('--batch-size', type=int, default=None, help='Rows per transaction.')
+def import_products_command(path, fmt, batch_size):
+    """Upsert products from a CSV or JSON Lines file, keyed on SKU."""
+    fmt = fmt or catalog_format(path)
+    if fmt is None:
+        raise click.UsageError('Cannot tell the format from the file name; pass --format.')
+    def progress(report):
+        click.echo(f'{report.rows} rows read, {report.inserted} inserted, {report.updated} updated, {report.error_count} errors')
+    with open(path, 'rb') as stream:
+        report = import_catalog(stream, fmt, batch_size, progress)
+    for line_number, message in report.errors:
+        click.echo(f'line {line_number}: {message}', err=True)
+    if report.error_count > len(report.errors):
+        click.echo(f'... and {report.error_count - len(report.errors)} more errors', err=True)
+
+# Exports
+# Orders, subscribers and contact messages stream out as CSV or NDJSON in
+# created_at order. Rows are fetched EXPORT_BATCH_SIZE at a time (a
+# server-side cursor on PostgreSQL) and written out in chunks, so an export
+# of any size holds one batch in memory.
+EXPORTS = {
+    'orders': (Order, ('id', 'user_id', 'total_amount', 'status', 'shipping_address', 'notes', 'created_at')),
+    'subscribers': (Newsletter, ('id', 'email', 'name', 'preferences', 'created_at')),
+    'contacts': (Contact, ('id', 'name', 'email', 'subject', 'message', 'created_at')),
+}
+EXPORT_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def export_rows(name, since=None, until=None, status=None):
+    # since is inclusive and until exclusive; status only applies to orders
+    model, columns = EXPORTS[name]
+    query = db.session.query(*[getattr(model, column) for column in columns])
+    if since:
+        query = query.filter(model.created_at >= since)
+    if until:
+        query = query.filter(model.created_at < until)
+    if status and model is Order:
+        query = query.filter(Order.status == status)
+    return query.order_by(model.created_at, model.id).yield_per(current_app.config['EXPORT_BATCH_SIZE'])
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def export_chunks(columns, rows, fmt):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if fmt == 'csv':
+        writer.writerow(columns)
+    for row in rows:
+        values = [export_value(value) for value in row]
+        if fmt == 'csv':
+            writer.writerow(values)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, values))) + '\n')
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def parse_export_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+@cli.command('export')
+@click.argument('name', type=click.Choice(list(EXPORTS)))
+@click.option('--format', 'fmt', type=click.Choice(list(EXPORT_FORMATS)), default='csv')
+@click.option('--since', type=click.DateTime(['%Y-%m-%d']), help='First day to include.')
+@click.option('--until', type=click.DateTime(['%Y-%m-%d']), help='First day to leave out.')
+@click.option('--status', help='Only orders with this status.')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='Defaults to stdout.')
+def export_command(name, fmt, since, until, status, output):
+    """Stream orders, subscribers or contacts as CSV or NDJSON."""
+    for chunk in export_chunks(EXPORTS[name][1], export_rows(name, since, until, status), fmt):
+        output.write(chunk)
+
+# Write-behind queue
+# Form submissions that nobody reads back straight away go through a bounded
+# in-process queue and are committed in groups by one background thread. Each
+# is appended to a journal segment before it is queued. The worker starts a
+# new segment for every batch and deletes a segment once everything in it has
+# been committed. A segment left behind by a stopped process is replayed, and
+# every submission carries an id recorded in the same transaction as its
+# rows, so a submission that was committed just before a crash is skipped.
+class QueueFull(Exception):
+    pass
+
+# Substrings of OperationalError messages that mean the database is busy or
+# out of reach rather than that the statement can never succeed
+TRANSIENT_DB_ERRORS = ('locked', 'busy', 'could not connect', 'connection refused',
+                       'server closed the connection', 'terminating connection', 'timeout expired')
+
+def transient_db_error(error):
+    message = str(error.orig).lower()
+    return error.connection_invalidated or any(text in message for text in TRANSIENT_DB_ERRORS)
+
+def write_submissions(items):
+    by_id = {}
+    for item in items:
+        by_id.setdefault(item.get('id') or uuid.uuid4().hex, item)
+    committed = {
+        id for (id,) in db.session.query(WriteReceipt.id).filter(WriteReceipt.id.in_(list(by_id)))
+    }
+    items = {id: item for id, item in by_id.items() if id not in committed}
+    if not items:
+        return
+    now = datetime.utcnow()
+    db.session.execute(WriteReceipt.__table__.insert(), [{'id': id, 'committed_at': now} for id in items])
+    rows = {'newsletter': [], 'contact': [], 'review': []}
+    for item in items.values():
+        rows[item['kind']].append(dict(item['values'], created_at=datetime.fromisoformat(item['created_at'])))
+    if rows['newsletter']:
+        # One row per address: the first submission wins and addresses that
+        # are already subscribed are skipped
+        by_email = {}
+        for row in rows['newsletter']:
+            by_email.setdefault(row['email'], row)
+        existing = {email for (email,) in db.session.query(Newsletter.email).filter(Newsletter.email.in_(list(by_email)))}
+        new_rows = [row for email, row in by_email.items() if email not in existing]
+        if new_rows:
+            db.session.execute(Newsletter.__table__.insert(), new_rows)
+    if rows['contact']:
+        db.session.execute(Contact.__table__.insert(), rows['contact'])
+    if rows['review']:
+        db.session.execute(Review.__table__.insert(), rows['review'])
+        bump_counters({'reviews': len(rows['review'])})
+        ratings = {}
+        for row in rows['review']:
+            rating_sum, rating_count = ratings.get(row['product_id'], (0, 0))
+            ratings[row['product_id']] = (rating_sum + row['rating'], rating_count + 1)
+        for product_id, (rating_sum, rating_count) in ratings.items():
+            record_rating(product_id, rating_sum, rating_count)
+    db.session.commit()
+    if rows['review']:
+        invalidate('catalog')
+
+def prune_write_receipts():
+    cutoff = datetime.utcnow() - timedelta(days=current_app.config['WRITE_RECEIPT_DAYS'])
+    WriteReceipt.query.filter(WriteReceipt.committed_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+def write_batch(items):
+    # Returns whether the batch was committed. A busy or unreachable database
+    # is retried up to WRITE_RETRY_LIMIT times; any other operational error
+    # gives up at once, leaving the batch in its journal for replay-writes. A
+    # batch the database rejects is retried one submission at a time so a
+    # single bad row is dropped instead of blocking the queue.
+    delay = 0.5
+    for attempt in range(current_app.config['WRITE_RETRY_LIMIT']):
+        try:
+            with current_app.app_context():
+                write_submissions(items)
+            return True
+        except OperationalError as error:
+            if not transient_db_error(error):
+                current_app.logger.exception('Write-behind batch failed')
+                return False
+            current_app.logger.warning('Write-behind batch failed (%s), retrying in %.1fs', error.orig, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+        except DBAPIError:
+            if len(items) == 1:
+                current_app.logger.exception('Dropping rejected %s submission', items[0]['kind'])
+                return True
+            results = [write_batch([item]) for item in items]
+            return all(results)
+    current_app.logger.error('Write-behind batch of %d still failing after %d attempts', len(items), attempt + 1)
+    return False
+
+def read_journal(path):
+    with open(path, encoding='utf-8') as journal:
+        for line in journal:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # A line cut short by a crash mid-write
+                continue
+
+def replay_journals(journal_dir, batch_size):
+    # Replays segments whose process has gone; live ones are locked. A
+    # segment that cannot be committed is kept for the next attempt.
+    replayed = 0
+    if not os.path.isdir(journal_dir):
+        return replayed
+    for filename in sorted(os.listdir(journal_dir)):
+        path = os.path.join(journal_dir, filename)
+        if not filename.endswith('.jsonl'):
+            continue
+        with open(path, 'a') as handle:
+            if fcntl:
+                try:
+                    fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+            if not os.path.exists(path):
+                # Replayed by another process while we waited
+                continue
+            items = list(read_journal(path))
+            for start in range(0, len(items), batch_size):
+                if not write_batch(items[start:start + batch_size]):
+                    break
+                replayed += len(items[start:start + batch_size])
+            else:
+                os.remove(path)
+    return replayed
+
+class JournalSegment:
+    # One journal file, locked for as long as it is open. It stops taking
+    # submissions once sealed and is deleted when the last of them commits,
+    # or closed and kept for replay-writes if any of them could not be.
+    def __init__(self, journal_dir):
+        self.path = os.path.join(journal_dir, f'{os.getpid()}-{uuid.uuid4().hex}.jsonl')
+        self.file = open(self.path, 'a', encoding='utf-8')
+        if fcntl:
+            fcntl.flock(self.file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.pending = 0
+        self.sealed = False
+        self.failed = False
+
+    def finish(self):
+        if self.failed:
+            current_app.logger.error('Write-behind journal %s kept for "flask replay-writes"', self.path)
+        else:
+            os.remove(self.path)
+        self.file.close()
+
+class WriteBehindQueue:
+    def __init__(self, app, journal_dir, max_size, batch_size, flush_interval, fsync):
+        self.app = app
+        self.journal_dir = journal_dir
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.queue = queue.Queue()
+        self.slots = threading.BoundedSemaphore(max_size)
+        self.lock = threading.Lock()
+        os.makedirs(journal_dir, exist_ok=True)
+        self.segment = JournalSegment(journal_dir)
+        self.thread = threading.Thread(target=self.run, name='write-behind', daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, item, timeout):
+        if not self.slots.acquire(timeout=timeout):
+            raise QueueFull()
+        with self.lock:
+            segment = self.segment
+            segment.file.write(json.dumps(item) + '\n')
+            segment.file.flush()
+            if self.fsync:
+                os.fsync(segment.file.fileno())
+            segment.pending += 1
+            self.queue.put((segment, item))
+
+    def run(self):
+        with self.app.app_context():
+            replay_journals(self.journal_dir, self.batch_size)
+            prune_write_receipts()
+            self.write_batches()
+
+    def write_batches(self):
+        stopping = False
+        while not stopping:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            with self.lock:
+                # Later submissions go to a new segment, so this one can be
+                # deleted as soon as the batch commits
+                self.segment.sealed = True
+                self.segment = JournalSegment(self.journal_dir)
+            committed = write_batch([item for segment, item in batch])
+            with self.lock:
+                for segment, item in batch:
+                    segment.pending -= 1
+                    segment.failed = segment.failed or not committed
+                for segment in {segment for segment, item in batch}:
+                    if segment.sealed and segment.pending == 0:
+                        segment.finish()
+            for _ in batch:
+                self.slots.release()
+
+    def close(self):
+        # Commits what is queued; anything left stays in its journal segment
+        atexit.unregister(self.close)
+        self.queue.put(None)
+        self.thread.join(timeout=30)
+        with self.app.app_context(), self.lock:
+            self.segment.sealed = True
+            if self.segment.pending == 0:
+                self.segment.finish()
+
+write_queue_lock = threading.Lock()
+
+def get_write_queue():
+    with write_queue_lock:
+        if 'write_queue' not in current_app.extensions:
+            current_app.extensions['write_queue'] = WriteBehindQueue(
+                current_app._get_current_object(),
+                os.path.join(current_app.root_path, current_app.config['WRITE_JOURNAL_DIR']),
+                current_app.config['WRITE_QUEUE_MAX'],
+                current_app.config['WRITE_BATCH_SIZE'],
+                current_app.config['WRITE_FLUSH_INTERVAL'],
+                current_app.config['WRITE_JOURNAL_FSYNC'],
+            )
+        return current_app.extensions['write_queue']
+
+def submit_write(kind, **values):
+    item = {'id': uuid.uuid4().hex, 'kind': kind, 'values': values, 'created_at': datetime.utcnow().isoformat()}
+    if current_app.config['WRITE_BEHIND_ENABLED']:
+        get_write_queue().submit(item, current_app.config['WRITE_QUEUE_TIMEOUT'])
+    else:
+        write_submissions([item])
+
+@cli.command('replay-writes')
+def replay_writes_command():
+    """Commit submissions left in the journals of stopped processes."""
+    path = os.path.join(current_app.root_path, current_app.config['WRITE_JOURNAL_DIR'])
+    replayed = replay_journals(path, current_app.config['WRITE_BATCH_SIZE'])
+    prune_write_receipts()
+    click.echo(f'Replayed {replayed} submissions.')
+
+# JSON API
+# Read-only JSON over the catalog. Responses select only the requested
+# columns and serialise the result rows directly, without building ORM
+# objects. Each resource is (model, fields, by_date), paged like its page.
+API_RESOURCES = {
+    'products': (Product, {
+        'id': Product.id,
+        'sku': Product.sku,
+        'name': Product.name,
+        'description': Product.description,
+        'price': Product.price,
+        'stock_quantity': Product.stock_quantity,
+        'image_url': Product.image_url,
+        'category_id': Product.category_id,
+        'created_at': Product.created_at,
+        'rating_count': db.func.coalesce(ProductRating.rating_count, 0),
+        'rating_avg': ProductRating.rating_avg,
+    }, False),
+    'categories': (Category, {
+        'id': Category.id,
+        'name': Category.name,
+        'description': Category.description,
+        'created_at': Category.created_at,
+    }, False),
+    'reviews': (Review, {
+        'id': Review.id,
+        'product_id': Review.product_id,
+        'user_id': Review.user_id,
+        'rating': Review.rating,
+        'comment': Review.comment,
+        'created_at': Review.created_at,
+    }, True),
+    'blog': (Blog, {
+        'id': Blog.id,
+        'title': Blog.title,
+        'content': Blog.content,
+        'author': Blog.author,
+        'tags': Blog.tags,
+        'created_at': Blog.created_at,
+    }, True),
+}
+# Query parameters that filter a resource's listing
+API_FILTERS = {
+    'products': {'category_id': Product.category_id},
+    'reviews': {'product_id': Review.product_id},
+}
+# Fields that need an outer join to another table
+API_JOINS = {
+    'rating_count': (ProductRating, ProductRating.product_id == Product.id),
+    'rating_avg': (ProductRating, ProductRating.product_id == Product.id),
+}
+
+class ApiError(Exception):
+    pass
+
+def api_fields(resource, requested):
+    columns = API_RESOURCES[resource][1]
+    if not requested:
+        return list(columns)
+    fields = [field.strip() for field in requested.split(',') if field.strip()]
+    unknown = [field for field in fields if field not in columns]
+    if unknown:
+        raise ApiError(f"Unknown fields for {resource}: {', '.join(unknown)}")
+    return fields
+
+def api_query(resource, fields):
+    # Selects the requested fields in order, followed by id and, for
+    # date-paged resources, created_at so the keyset cursor can be built
+    model, columns, by_date = API_RESOURCES[resource]
+    selected = dict.fromkeys(fields + ['id'] + (['created_at'] if by_date else []))
+    query = db.session.query(*[columns[field].label(field) for field in selected]).select_from(model)
+    joins = dict(API_JOINS[field] for field in selected if field in API_JOINS)
+    for target, onclause in joins.items():
+        query = query.outerjoin(target, onclause)
+    return query
+
+def api_rows(rows, fields):
+    # Rows from api_query start with the requested fields, so zip drops the
+    # cursor columns. created_at is the only value JSON can't take as is.
+    items = [dict(zip(fields, row)) for row in rows]
+    if 'created_at' in fields:
+        for item in items:
+            item['created_at'] = export_value(item['created_at'])
+    return items
+
+def parse_ids(value):
+    try:
+        ids = [int(id) for id in value.split(',') if id.strip()]
+    except ValueError:
+        raise ApiError('ids must be a comma-separated list of integers')
+    if len(ids) > MAX_PER_PAGE:
+        raise ApiError(f'At most {MAX_PER_PAGE} ids per request')
+    return ids
+
+@cli.command('bench-api')
+@click.option('--products', default=1000, help='Products serialised per round.')
+@click.option('--rounds', default=20, help='Rounds to average over.')
+def bench_api_command(products, rounds):
+    """Time serialising products from ORM objects and from selected columns."""
+    fields = list(API_RESOURCES['products'][1])
+    columns = [column.name for column in Product.__table__.columns]
+
+    def from_orm():
+        items = Product.query.order_by(Product.id).limit(products).all()
+        return json.dumps([
+            dict({name: export_value(getattr(item, name)) for name in columns},
+                 rating_count=item.rating_count, rating_avg=item.average_rating)
+            for item in items
+        ])
+
+    def from_rows():
+        rows = api_query('products', fields).order_by(Product.id).limit(products).all()
+        return json.dumps(api_rows(rows, fields))
+
+    count = min(products, Product.query.count())
+    if not count:
+        raise click.ClickException('No products to serialise; run "flask seed" or "flask import-products" first.')
+    for label, build in (('orm', from_orm), ('columns', from_rows)):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            build()
+            db.session.expunge_all()
+        elapsed = (time.perf_counter() - started) / rounds
+        click.echo(f'{label:<8} {elapsed * 1000:8.2f} ms per request  {elapsed * 1000 * 1000 / count:8.2f} ms per 1k products')
+
+# Login throttling
+# Password checks are deliberately slow, so they run on a small bounded pool
+# instead of the request thread and each client IP and username draws from a
+# token bucket. A burst of logins is refused early rather than taking every
+# core away from the storefront.
+def refill_bucket(tokens, updated_at, now, burst, per_minute):
+    # Returns the bucket after taking one token, and how long to wait if empty
+    rate = per_minute / 60.0
+    tokens = min(burst, tokens + (now - updated_at) * rate)
+    if tokens >= 1:
+        return tokens - 1, 0
+    return tokens, (1 - tokens) / rate
+
+class MemoryRateLimiter:
+    def __init__(self, max_keys=10000):
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key, burst, per_minute):
+        now = time.time()
+        with self.lock:
+            tokens, updated_at = self.buckets.pop(key, (burst, now))
+            tokens, wait = refill_bucket(tokens, updated_at, now, burst, per_minute)
+            self.buckets[key] = (tokens, now)
+            while len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        return wait
+
+class SQLiteRateLimiter:
+    # Buckets idle for an hour are full again and are deleted
+    PRUNE_EVERY = 100
+    IDLE_SECONDS = 3600
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.writes = 0
+        conn = self.connection()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS bucket "
+            "(key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)"
+        )
+
+    def connection(self):
+        if not hasattr(self.local, 'conn'):
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.local.conn = conn
+        return self.local.conn
+
+    def acquire(self, key, burst, per_minute):
+        now = time.time()
+        conn = self.connection()
+        # IMMEDIATE takes the write lock up front so two workers cannot both
+        # spend the last token
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT tokens, updated_at FROM bucket WHERE key = ?', (key,)).fetchone()
+            tokens, updated_at = row or (burst, now)
+            tokens, wait = refill_bucket(tokens, updated_at, now, burst, per_minute)
+            conn.execute(
+                'INSERT OR REPLACE INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?)',
+                (key, tokens, now)
+            )
+            self.writes += 1
+            if self.writes % self.PRUNE_EVERY == 0:
+                conn.execute('DELETE FROM bucket WHERE updated_at < ?', (now - self.IDLE_SECONDS,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return wait
+
+@setup
+def trust_proxies(app):
+    # remote_addr and the URL scheme come from the X-Forwarded headers set by
+    # the trusted proxies
+    proxies = app.config['TRUSTED_PROXIES']
+    if proxies:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=proxies, x_proto=proxies)
+
+def get_rate_limiter():
+    if 'rate_limiter' not in current_app.extensions:
+        if current_app.config['RATE_LIMIT_BACKEND'] == 'sqlite':
+            path = os.path.join(current_app.root_path, current_app.config['RATE_LIMIT_PATH'])
+            current_app.extensions['rate_limiter'] = SQLiteRateLimiter(path)
+        else:
+            current_app.extensions['rate_limiter'] = MemoryRateLimiter()
+    return current_app.extensions['rate_limiter']
+
+def login_wait(username):
+    # Seconds until this client may try again, 0 when the attempt is allowed
+    limiter = get_rate_limiter()
+    limits = current_app.config['LOGIN_RATE_LIMITS']
+    return max(
+        limiter.acquire('ip:%s' % request.remote_addr, **limits['ip']),
+        limiter.acquire('username:%s' % username.lower(), **limits['username']),
+    )
+
+def hash_password(password):
+    return generate_password_hash(password, method=current_app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password, method):
+    # Returns whether the password matches and, if the stored hash uses other
+    # parameters, a replacement hash made with the current method
+    if not check_password_hash(password_hash, password):
+        return False, None
+    if password_hash.split('$', 1)[0] != method:
+        return True, generate_password_hash(password, method=method)
+    return True, None
+
+class PasswordVerifier:
+    def __init__(self, workers, queue_limit):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    def submit(self, password_hash, password, method):
+        # None when the pool and its queue are full
+        if not self.slots.acquire(blocking=False):
+            return None
+        future = self.executor.submit(verify_password, password_hash, password, method)
+        future.add_done_callback(lambda f: self.slots.release())
+        return future
+
+def get_password_verifier():
+    if 'password_verifier' not in current_app.extensions:
+        current_app.extensions['password_verifier'] = PasswordVerifier(
+            current_app.config['LOGIN_WORKERS'], current_app.config['LOGIN_QUEUE_LIMIT']
+        )
+    return current_app.extensions['password_verifier']
+
 # Routes
-@app.route('/')
+@route('/')
+@cached_page('catalog', 'categories')
 def index():
     featured_products = Product.query.limit(8).all()
-    categories = Category.query.all()
-    return render_template('index.html', featured_products=featured_products, categories=categories)
+    top_rated = Product.query.join(ProductRating).order_by(*TOP_RATED_ORDER).limit(4).all()
+    categories = category_list()
+    return render_template('index.html', featured_products=featured_products, top_rated=top_rated, categories=categories)
 
-@app.route('/products')
+@route('/products')
+@cached_page('catalog', 'categories')
 def products():
-    category_id = request.args.get('category')
     search = request.args.get('search', '')
+    sort = request.args.get('sort', '')
+    filters = catalog_filters()
     
-    query = Product.query
-    if category_id:
-        query = query.filter_by(category_id=category_id)
+    query = filter_products(Product.query, filters)
     if search:
-        query = query.filter(Product.name.contains(search))
-    
-    products = query.all()
-    categories = Category.query.all()
-    return render_template('products.html', products=products, categories=categories, search=search)
+        # Relevance-ranked results are capped rather than paged
+        page = KeysetPage(search_query(Product, 'product_fts', search, base_query=query).limit(MAX_PER_PAGE).all())
+    elif sort == 'top_rated':
+        # Like search results, the top-rated listing is capped rather than paged
+        query = query.join(ProductRating).order_by(*TOP_RATED_ORDER)
+        page = KeysetPage(query.limit(MAX_PER_PAGE).all())
+    else:
+        page = paginate(query, Product, by_date=False)
+    categories = category_list()
+    # Facet counts cover the whole catalog, so they are left out of search results
+    facets = None if search else facet_counts(filters)
+    return render_template('products.html', products=page.items, page=page, categories=categories, search=search, sort=sort,
+                           filters=filters, facets=facets, price_buckets=[price_bucket_label(b) for b in range(len(PRICE_BUCKETS))],
+                           rating_filters=RATING_FILTERS)
 
-@app.route('/product/<int:product_id>')
+@route('/product/<int:product_id>')
+@cached_page('catalog')
 def product_detail(product_id):
     product = Product.query.get_or_404(product_id)
-    reviews = Review.query.filter_by(product_id=product_id).all()
-    return render_template('product_detail.html', product=product, reviews=reviews)
+    page = paginate(Review.query.options(joinedload(Review.user)).filter_by(product_id=product_id), Review)
+    return render_template('product_detail.html', product=product, reviews=page.items, page=page)
 
-@app.route('/login', methods=['GET', 'POST'])
+@route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         
+        wait = login_wait(username)
+        if wait:
+            flash('Too many login attempts. Please try again in %d seconds.' % math.ceil(wait), 'error')
+            response = make_response(render_template('login.html'), 429)
+            response.headers['Retry-After'] = str(math.ceil(wait))
+            return response
+        
+        # Unknown usernames are rejected without hashing; register already
+        # tells visitors which usernames are taken
         user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password_hash, password):
+        valid, new_hash = False, None
+        if user:
+            future = get_password_verifier().submit(user.password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+            try:
+                if future is None:
+                    raise FutureTimeoutError()
+                valid, new_hash = future.result(timeout=current_app.config['LOGIN_TIMEOUT'])
+            except FutureTimeoutError:
+                flash('The server is busy. Please try again in a moment.', 'error')
+                response = make_response(render_template('login.html'), 503)
+                response.headers['Retry-After'] = '1'
+                return response
+        
+        if valid:
+            if new_hash:
+                user.password_hash = new_hash
+            guest_cart_id = session.pop('cart_id', None)
+            if guest_cart_id:
+                merge_carts(guest_cart_id, user_cart_id(user.id))
+            db.session.commit()
             session['user_id'] = user.id
             session['username'] = user.username
             session['is_admin'] = user.is_admin
@@ -143,7 +2990,7 @@ def login():
     
     return render_template('login.html')
 
-@app.route('/register', methods=['GET', 'POST'])
+@route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
@@ -162,10 +3009,11 @@ def register():
         user = User(
             username=username,
             email=email,
-            password_hash=generate_password_hash(password),
+            password_hash=hash_password(password),
             full_name=full_name
         )
         db.session.add(user)
+        bump_counters({'users': 1})
         db.session.commit()
         
         flash('Registration successful! Please login.', 'success')
@@ -173,13 +3021,13 @@ def register():
     
     return render_template('register.html')
 
-@app.route('/logout')
+@route('/logout')
 def logout():
     session.clear()
     flash('Logged out successfully!', 'success')
     return redirect(url_for('index'))
 
-@app.route('/profile')
+@route('/profile')
 def profile():
     if not session.get('user_id'):
         flash('Please login first!', 'error')
@@ -188,7 +3036,7 @@ def profile():
     user = User.query.get(session['user_id'])
     return render_template('profile.html', user=user)
 
-@app.route('/update_profile', methods=['POST'])
+@route('/update_profile', methods=['POST'])
 def update_profile():
     if not session.get('user_id'):
         return redirect(url_for('login'))
@@ -202,50 +3050,43 @@ def update_profile():
     flash('Profile updated successfully!', 'success')
     return redirect(url_for('profile'))
 
-@app.route('/cart')
+@route('/cart')
 def cart():
-    if not session.get('user_id'):
-        flash('Please login first!', 'error')
-        return redirect(url_for('login'))
-    
-    cart_items = session.get('cart', [])
-    products = []
-    total = 0
-    
-    for item in cart_items:
-        product = Product.query.get(item['product_id'])
-        if product:
-            products.append({
-                'product': product,
-                'quantity': item['quantity']
-            })
-            total += product.price * item['quantity']
-    
-    return render_template('cart.html', products=products, total=total)
+    priced = price_cart(cart_items(current_cart_id()))
+    return render_template('cart.html', products=priced.lines, total=priced.total)
 
-@app.route('/add_to_cart', methods=['POST'])
+@route('/add_to_cart', methods=['POST'])
 def add_to_cart():
-    if not session.get('user_id'):
-        return jsonify({'error': 'Please login first!'})
-    
-    product_id = int(request.form['product_id'])
-    quantity = int(request.form['quantity'])
+    # Guests get a cart too; it is merged into their own when they log in
+    try:
+        product_id = int(request.form['product_id'])
+        quantity = int(request.form['quantity'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Invalid product or quantity.'}), 400
+    if quantity < 1:
+        return jsonify({'error': 'Quantity must be at least 1.'}), 400
+    if db.session.get(Product, product_id) is None:
+        return jsonify({'error': 'Product not found.'}), 404
     
-    if 'cart' not in session:
-        session['cart'] = []
-    
-    cart = session['cart']
-    for item in cart:
-        if item['product_id'] == product_id:
-            item['quantity'] += quantity
-            break
-    else:
-        cart.append({'product_id': product_id, 'quantity': quantity})
-    
-    session['cart'] = cart
+    cart_add(current_cart_id(), product_id, quantity)
+    db.session.commit()
     return jsonify({'success': 'Product added to cart!'})
 
-@app.route('/checkout', methods=['GET', 'POST'])
+@route('/update_cart', methods=['POST'])
+def update_cart():
+    try:
+        product_id = int(request.form['product_id'])
+        quantity = int(request.form['quantity'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Invalid product or quantity.'}), 400
+    if quantity > 0 and db.session.get(Product, product_id) is None:
+        return jsonify({'error': 'Product not found.'}), 404
+    
+    cart_set_quantity(current_cart_id(), product_id, quantity)
+    db.session.commit()
+    return jsonify({'success': 'Cart updated!'})
+
+@route('/checkout', methods=['GET', 'POST'])
 def checkout():
     if not session.get('user_id'):
         flash('Please login first!', 'error')
@@ -255,101 +3096,121 @@ def checkout():
         shipping_address = request.form['shipping_address']
         notes = request.form.get('notes', '')
         
-        cart_items = session.get('cart', [])
-        if not cart_items:
+        cart_id = current_cart_id()
+        # A second submission of the same cart (a double click) waits here
+        # and then finds it empty instead of placing the order twice
+        if not lock_cart(cart_id):
+            db.session.rollback()
+            flash('Your cart is empty!', 'error')
+            return redirect(url_for('cart'))
+        priced = price_cart(cart_items(cart_id))
+        if not priced.lines:
+            db.session.rollback()
             flash('Your cart is empty!', 'error')
             return redirect(url_for('cart'))
         
-        total = 0
-        for item in cart_items:
-            product = Product.query.get(item['product_id'])
-            total += product.price * item['quantity']
+        # The cart's own reservation is handed back and the stock taken again
+        # in the same transaction as the order insert
+        try:
+            take_stock(cart_id, priced.lines)
+        except OutOfStock as e:
+            flash(f'Not enough stock for: {e}', 'error')
+            return redirect(url_for('cart'))
         
         order = Order(
             user_id=session['user_id'],
-            total_amount=total,
+            total_amount=priced.total,
+            status='pending',
             shipping_address=shipping_address,
             notes=notes
         )
         db.session.add(order)
         db.session.flush()
         
-        for item in cart_items:
-            product = Product.query.get(item['product_id'])
-            order_item = OrderItem(
-                order_id=order.id,
-                product_id=item['product_id'],
-                quantity=item['quantity'],
-                price=product.price
-            )
-            db.session.add(order_item)
-        
+        db.session.execute(OrderItem.__table__.insert(), priced.order_item_rows(order.id))
+        cart_clear(cart_id)
+        bump_counters({'orders': 1, 'revenue': priced.total, order_status_counter(order.status): 1})
         db.session.commit()
-        session['cart'] = []
         flash('Order placed successfully!', 'success')
         return redirect(url_for('orders'))
     
-    cart_items = session.get('cart', [])
-    products = []
-    total = 0
-    
-    for item in cart_items:
-        product = Product.query.get(item['product_id'])
-        if product:
-            products.append({
-                'product': product,
-                'quantity': item['quantity']
-            })
-            total += product.price * item['quantity']
+    # Showing the form writes nothing; stock is held by start_checkout
+    priced = price_cart(cart_items(current_cart_id()))
+    return render_template('checkout.html', products=priced.lines, total=priced.total)
+
+@route('/checkout/start', methods=['POST'])
+def start_checkout():
+    # Holds the cart's stock for RESERVATION_TTL_MINUTES while the shopper
+    # fills in the checkout form
+    if not session.get('user_id'):
+        flash('Please login first!', 'error')
+        return redirect(url_for('login'))
     
-    return render_template('checkout.html', products=products, total=total)
+    cart_id = current_cart_id()
+    lock_cart(cart_id)
+    priced = price_cart(cart_items(cart_id))
+    if not priced.lines:
+        db.session.rollback()
+        flash('Your cart is empty!', 'error')
+        return redirect(url_for('cart'))
+    try:
+        reserve_stock(cart_id, priced.lines)
+        db.session.commit()
+    except OutOfStock as e:
+        flash(f'Not enough stock for: {e}', 'error')
+        return redirect(url_for('cart'))
+    return redirect(url_for('checkout'))
 
-@app.route('/orders')
+@route('/orders')
 def orders():
     if not session.get('user_id'):
         flash('Please login first!', 'error')
         return redirect(url_for('login'))
     
-    user_orders = Order.query.filter_by(user_id=session['user_id']).order_by(Order.created_at.desc()).all()
-    return render_template('orders.html', orders=user_orders)
+    query = Order.query.options(selectinload(Order.items).joinedload(OrderItem.product))
+    page = paginate(query.filter_by(user_id=session['user_id']), Order)
+    return render_template('orders.html', orders=page.items, page=page)
 
-@app.route('/add_review', methods=['POST'])
+@route('/add_review', methods=['POST'])
 def add_review():
     if not session.get('user_id'):
         return jsonify({'error': 'Please login first!'})
     
-    product_id = int(request.form['product_id'])
-    rating = int(request.form['rating'])
+    try:
+        product_id = int(request.form['product_id'])
+        rating = int(request.form['rating'])
+    except (KeyError, ValueError):
+        return jsonify({'error': 'Invalid product or rating.'}), 400
+    if not 1 <= rating <= 5:
+        return jsonify({'error': 'Rating must be between 1 and 5.'}), 400
+    # Checked here because the queued write cannot report back
+    if db.session.query(Product.id).filter_by(id=product_id).first() is None:
+        return jsonify({'error': 'Product not found.'}), 400
     comment = request.form.get('comment', '')
     
-    review = Review(
-        user_id=session['user_id'],
-        product_id=product_id,
-        rating=rating,
-        comment=comment
-    )
-    db.session.add(review)
-    db.session.commit()
+    try:
+        submit_write('review', user_id=session['user_id'], product_id=product_id, rating=rating, comment=comment)
+    except QueueFull:
+        return jsonify({'error': 'We are receiving a lot of reviews right now. Please try again shortly.'}), 503
     
     return jsonify({'success': 'Review added successfully!'})
 
-@app.route('/newsletter', methods=['POST'])
+@route('/newsletter', methods=['POST'])
 def newsletter():
     email = request.form['email']
     name = request.form.get('name', '')
     preferences = request.form.get('preferences', '')
     
-    if Newsletter.query.filter_by(email=email).first():
-        flash('Email already subscribed!', 'error')
-    else:
-        subscriber = Newsletter(email=email, name=name, preferences=preferences)
-        db.session.add(subscriber)
-        db.session.commit()
+    # Addresses that are already subscribed are skipped when the queue is written
+    try:
+        submit_write('newsletter', email=email, name=name, preferences=preferences)
         flash('Successfully subscribed to newsletter!', 'success')
+    except QueueFull:
+        flash('We are receiving a lot of sign-ups right now. Please try again shortly.', 'error')
     
     return redirect(url_for('index'))
 
-@app.route('/contact', methods=['GET', 'POST'])
+@route('/contact', methods=['GET', 'POST'])
 def contact():
     if request.method == 'POST':
         name = request.form['name']
@@ -357,45 +3218,75 @@ def contact():
         subject = request.form['subject']
         message = request.form['message']
         
-        contact_msg = Contact(name=name, email=email, subject=subject, message=message)
-        db.session.add(contact_msg)
-        db.session.commit()
+        try:
+            submit_write('contact', name=name, email=email, subject=subject, message=message)
+        except QueueFull:
+            flash('We are receiving a lot of messages right now. Please try again shortly.', 'error')
+            return render_template('contact.html'), 503
         
         flash('Message sent successfully!', 'success')
         return redirect(url_for('contact'))
     
     return render_template('contact.html')
 
-@app.route('/blog')
+@route('/blog')
+@cached_page('blog')
 def blog():
-    posts = Blog.query.order_by(Blog.created_at.desc()).all()
-    return render_template('blog.html', posts=posts)
+    page = paginate(Blog.query, Blog)
+    return render_template('blog.html', posts=page.items, page=page)
 
-@app.route('/blog/<int:post_id>')
+@route('/blog/<int:post_id>')
+@cached_page('blog')
 def blog_post(post_id):
     post = Blog.query.get_or_404(post_id)
-    return render_template('blog_post.html', post=post)
+    # Posts are never edited, so their creation time is a valid Last-Modified
+    response = make_response(render_template('blog_post.html', post=post))
+    response.last_modified = post.created_at
+    return response
 
-@app.route('/search')
+@route('/search')
 def search():
     query = request.args.get('q', '')
     results = []
     
     if query:
-        products = Product.query.filter(Product.name.contains(query)).all()
-        posts = Blog.query.filter(Blog.title.contains(query)).all()
+        products = search_query(Product, 'product_fts', query).limit(50).all()
+        posts = search_query(Blog, 'blog_fts', query).limit(50).all()
         results = {'products': products, 'posts': posts}
     
     return render_template('search.html', query=query, results=results)
 
+@route('/autocomplete')
+def autocomplete():
+    query = request.args.get('q', '').strip()
+    limit = min(max(request.args.get('limit', current_app.config['AUTOCOMPLETE_LIMIT'], type=int), 1), AUTOCOMPLETE_MAX_LIMIT)
+    index = get_autocomplete_index() if query else None
+    results = []
+    for score, kind, id, label in (index.search(query, limit) if index else []):
+        if kind == 'product':
+            url = url_for('product_detail', product_id=id)
+        elif kind == 'category':
+            url = url_for('products', category=id)
+        else:
+            url = url_for('blog_post', post_id=id)
+        results.append({'type': kind, 'id': id, 'label': label, 'url': url})
+    response = jsonify({'query': query, 'results': results})
+    if query and index is None:
+        # Still building; an empty answer must not be cached
+        response.cache_control.no_store = True
+        return response
+    response.cache_control.public = True
+    response.cache_control.max_age = 60
+    return response
+
 # Search Results Display
-@app.route('/search_results')
+@route('/search_results')
 def search_results():
     query = request.args.get('q', '')
     return f"<h1>Search Results for: {query}</h1><p>No results found for your search.</p>"
 
 # User Profile Lookup
-@app.route('/user_profile')
+@route('/user_profile')
 def user_profile():
     user_id = request.args.get('id')
     if user_id:
@@ -408,7 +3299,7 @@ def user_profile():
     return "<h1>User not found</h1>"
 
 # Product Review Display
-@app.route('/review_display')
+@route('/review_display')
 def review_display():
     review_id = request.args.get('id')
     if review_id:
@@ -421,7 +3312,7 @@ def review_display():
     return "<h1>Review not found</h1>"
 
 # Newsletter Subscriber Lookup
-@app.route('/newsletter_preferences')
+@route('/newsletter_preferences')
 def newsletter_preferences():
     email = request.args.get('email')
     if email:
@@ -433,7 +3324,7 @@ def newsletter_preferences():
     return "<h1>Subscriber not found</h1>"
 
 # Contact Message Display
-@app.route('/contact_display')
+@route('/contact_display')
 def contact_display():
     contact_id = request.args.get('id')
     if contact_id:
@@ -446,7 +3337,7 @@ def contact_display():
     return "<h1>Contact message not found</h1>"
 
 # Blog Post Content Display
-@app.route('/blog_content')
+@route('/blog_content')
 def blog_content():
     post_id = request.args.get('id')
     if post_id:
@@ -459,7 +3350,7 @@ def blog_content():
     return "<h1>Blog post not found</h1>"
 
 # Order Notes Display
-@app.route('/order_notes')
+@route('/order_notes')
 def order_notes():
     order_id = request.args.get('id')
     if order_id:
@@ -472,7 +3363,7 @@ def order_notes():
     return "<h1>Order not found</h1>"
 
 # Product Description Display
-@app.route('/product_description')
+@route('/product_description')
 def product_description():
     product_id = request.args.get('id')
     if product_id:
@@ -485,7 +3376,7 @@ def product_description():
     return "<h1>Product not found</h1>"
 
 # Category Description Display
-@app.route('/category_description')
+@route('/category_description')
 def category_description():
     category_id = request.args.get('id')
     if category_id:
@@ -498,7 +3389,7 @@ def category_description():
     return "<h1>Category not found</h1>"
 
 # User Information Display
-@app.route('/user_name')
+@route('/user_name')
 def user_name():
     user_id = request.args.get('id')
     if user_id:
@@ -510,88 +3401,184 @@ def user_name():
             return f"<h1>User Information</h1><p>Searching for user: {user_id}</p><p>Invalid user ID format</p>"
     return "<h1>User not found</h1>"
 
+# API Routes
+@route('/api/<resource>')
+@cached_page('catalog', 'categories', 'blog')
+def api_list(resource):
+    if resource not in API_RESOURCES:
+        return jsonify({'error': f'Unknown resource {resource}'}), 404
+    model, columns, by_date = API_RESOURCES[resource]
+    try:
+        fields = api_fields(resource, request.args.get('fields'))
+        query = api_query(resource, fields)
+        for arg, column in API_FILTERS.get(resource, {}).items():
+            value = request.args.get(arg, type=int)
+            if value is not None:
+                query = query.filter(column == value)
+        # Batch get: one round trip for a known set of records, in id order
+        if request.args.get('ids'):
+            rows = query.filter(model.id.in_(parse_ids(request.args['ids']))).order_by(model.id).all()
+            return jsonify({'items': api_rows(rows, fields)})
+    except ApiError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    page = paginate(query, model, by_date=by_date)
+    body = {'items': api_rows(page.items, fields), 'next': page.next_url, 'prev': page.prev_url}
+    if page.total is not None:
+        body['total'] = page.total
+    return jsonify(body)
+
+@route('/api/<resource>/<int:item_id>')
+@cached_page('catalog', 'categories', 'blog')
+def api_detail(resource, item_id):
+    if resource not in API_RESOURCES:
+        return jsonify({'error': f'Unknown resource {resource}'}), 404
+    model = API_RESOURCES[resource][0]
+    try:
+        fields = api_fields(resource, request.args.get('fields'))
+    except ApiError as e:
+        return jsonify({'error': str(e)}), 400
+    row = api_query(resource, fields).filter(model.id == item_id).first()
+    if row is None:
+        return jsonify({'error': f'No {resource} with id {item_id}'}), 404
+    return jsonify(api_rows([row], fields)[0])
+
 # Admin Routes
-@app.route('/admin')
+@route('/admin')
 def admin_dashboard():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    stats = {
-        'users': User.query.count(),
-        'products': Product.query.count(),
-        'orders': Order.query.count(),
-        'reviews': Review.query.count()
-    }
+    stats = read_counters()
     
-    recent_orders = Order.query.order_by(Order.created_at.desc()).limit(5).all()
+    # Ids grow with created_at, and walking the primary key avoids a sort
+    recent_orders = Order.query.options(joinedload(Order.user)).order_by(Order.id.desc()).limit(5).all()
     return render_template('admin/dashboard.html', stats=stats, recent_orders=recent_orders)
 
-@app.route('/admin/users')
+@route('/admin/users')
 def admin_users():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    users = User.query.all()
-    return render_template('admin/users.html', users=users)
+    page = paginate(User.query, User, by_date=False)
+    return render_template('admin/users.html', users=page.items, page=page)
 
-@app.route('/admin/products')
+@route('/admin/products')
 def admin_products():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    products = Product.query.all()
-    categories = Category.query.all()
-    return render_template('admin/products.html', products=products, categories=categories)
+    page = paginate(Product.query.options(joinedload(Product.category)), Product, by_date=False)
+    categories = category_list()
+    return render_template('admin/products.html', products=page.items, page=page, categories=categories)
 
-@app.route('/admin/orders')
+@route('/admin/orders')
 def admin_orders():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    orders = Order.query.order_by(Order.created_at.desc()).all()
-    return render_template('admin/orders.html', orders=orders)
+    # Summary rows only; each order's items are fetched when its modal opens
+    page = paginate(Order.query.options(joinedload(Order.user)), Order)
+    return render_template('admin/orders.html', orders=page.items, page=page)
 
-@app.route('/admin/reviews')
+@route('/admin/orders/<int:order_id>')
+def admin_order_detail(order_id):
+    if not session.get('is_admin'):
+        abort(403)
+    
+    order = Order.query.options(
+        joinedload(Order.user),
+        selectinload(Order.items).joinedload(OrderItem.product)
+    ).filter_by(id=order_id).first_or_404()
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({
+            'id': order.id,
+            'username': order.user.username,
+            'email': order.user.email,
+            'total_amount': order.total_amount,
+            'status': order.status,
+            'shipping_address': order.shipping_address,
+            'notes': order.notes,
+            'created_at': order.created_at.isoformat(),
+            'items': [
+                {'product_id': item.product_id, 'name': item.product.name, 'quantity': item.quantity, 'price': item.price}
+                for item in order.items
+            ],
+        })
+    return render_template('admin/_order_detail.html', order=order)
+
+@route('/admin/reviews')
 def admin_reviews():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    reviews = Review.query.order_by(Review.created_at.desc()).all()
-    return render_template('admin/reviews.html', reviews=reviews)
+    page = paginate(Review.query.options(joinedload(Review.user), joinedload(Review.product)), Review)
+    return render_template('admin/reviews.html', reviews=page.items, page=page)
 
-@app.route('/admin/newsletter')
+@route('/admin/newsletter')
 def admin_newsletter():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    subscribers = Newsletter.query.order_by(Newsletter.created_at.desc()).all()
-    return render_template('admin/newsletter.html', subscribers=subscribers)
+    page = paginate(Newsletter.query, Newsletter)
+    return render_template('admin/newsletter.html', subscribers=page.items, page=page)
 
-@app.route('/admin/contacts')
+@route('/admin/contacts')
 def admin_contacts():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    contacts = Contact.query.order_by(Contact.created_at.desc()).all()
-    return render_template('admin/contacts.html', contacts=contacts)
+    page = paginate(Contact.query, Contact)
+    return render_template('admin/contacts.html', contacts=page.items, page=page)
+
+@route('/admin/export/<name>')
+def admin_export(name):
+    if not session.get('is_admin'):
+        flash('Access denied!', 'error')
+        return redirect(url_for('index'))
+    
+    fmt = request.args.get('format', 'csv')
+    if name not in EXPORTS or fmt not in EXPORT_FORMATS:
+        abort(404)
+    try:
+        since = parse_export_date(request.args.get('since'))
+        until = parse_export_date(request.args.get('until'))
+    except ValueError:
+        abort(400)
+    
+    rows = export_rows(name, since, until, request.args.get('status'))
+    filename = f"{name}-{datetime.utcnow():%Y%m%d}.{fmt}"
+    return Response(
+        stream_with_context(export_chunks(EXPORTS[name][1], rows, fmt)),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={filename}'},
+    )
+
+@route('/admin/metrics')
+def admin_metrics():
+    token = current_app.config['METRICS_TOKEN']
+    authorization = request.headers.get('Authorization', '')
+    if not session.get('is_admin') and not (token and hmac.compare_digest(authorization, f'Bearer {token}')):
+        abort(403)
+    return Response(get_request_metrics().render(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-@app.route('/admin/blog')
+@route('/admin/blog')
 def admin_blog():
     if not session.get('is_admin'):
         flash('Access denied!', 'error')
         return redirect(url_for('index'))
     
-    posts = Blog.query.order_by(Blog.created_at.desc()).all()
-    return render_template('admin/blog.html', posts=posts)
+    page = paginate(Blog.query, Blog)
+    return render_template('admin/blog.html', posts=page.items, page=page)
 
-@app.route('/admin/add_product', methods=['POST'])
+@route('/admin/add_product', methods=['POST'])
 def admin_add_product():
     if not session.get('is_admin'):
         return redirect(url_for('index'))
@@ -603,6 +3590,15 @@ def admin_add_product():
     category_id = int(request.form['category_id'])
     image_url = request.form.get('image_url', '')
     
+    upload = request.files.get('image')
+    if upload and upload.filename:
+        data = upload.read(current_app.config['IMAGE_MAX_BYTES'] + 1)
+        ext = sniff_image(data)
+        if len(data) > current_app.config['IMAGE_MAX_BYTES'] or ext is None:
+            flash('Images must be JPEG, PNG, GIF or WebP files of at most %d MB.' % (current_app.config['IMAGE_MAX_BYTES'] // 2**20), 'error')
+            return redirect(url_for('admin_products'))
+        image_url = store_image(data, ext)
+    
     product = Product(
         name=name,
         description=description,
@@ -612,12 +3608,37 @@ def admin_add_product():
         image_url=image_url
     )
     db.session.add(product)
+    bump_counters({'products': 1})
     db.session.commit()
+    invalidate('catalog', 'labels')
+    autocomplete_add('product', product.id, product.name, product_score(0, product.stock_quantity))
     
     flash('Product added successfully!', 'success')
     return redirect(url_for('admin_products'))
 
-@app.route('/admin/add_category', methods=['POST'])
+@route('/admin/import_products', methods=['POST'])
+def admin_import_products():
+    if not session.get('is_admin'):
+        return redirect(url_for('index'))
+    
+    upload = request.files.get('file')
+    fmt = catalog_format(upload.filename) if upload else None
+    if fmt is None:
+        flash('Please choose a .csv or .jsonl file to import.', 'error')
+        return redirect(url_for('admin_products'))
+    
+    report = import_catalog(upload.stream, fmt, progress=lambda r: current_app.logger.info(
+        'Importing %s: %d rows, %d inserted, %d updated, %d errors',
+        upload.filename, r.rows, r.inserted, r.updated, r.error_count))
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(report.as_dict())
+    
+    flash(f'Imported {upload.filename}: {report.inserted} added, {report.updated} updated, {report.error_count} rejected.', 'success')
+    for line_number, message in report.errors[:10]:
+        flash(f'Line {line_number}: {message}', 'error')
+    return redirect(url_for('admin_products'))
+
+@route('/admin/add_category', methods=['POST'])
 def admin_add_category():
     if not session.get('is_admin'):
         return redirect(url_for('index'))
@@ -628,11 +3649,13 @@ def admin_add_category():
     category = Category(name=name, description=description)
     db.session.add(category)
     db.session.commit()
+    invalidate('catalog', 'categories', 'labels')
+    autocomplete_add('category', category.id, category.name, CATEGORY_SCORE)
     
     flash('Category added successfully!', 'success')
     return redirect(url_for('admin_products'))
 
-@app.route('/admin/add_blog_post', methods=['POST'])
+@route('/admin/add_blog_post', methods=['POST'])
 def admin_add_blog_post():
     if not session.get('is_admin'):
         return redirect(url_for('index'))
@@ -645,11 +3668,13 @@ def admin_add_blog_post():
     post = Blog(title=title, content=content, author=author, tags=tags)
     db.session.add(post)
     db.session.commit()
+    invalidate('blog', 'labels')
+    autocomplete_add('post', post.id, post.title, POST_SCORE)
     
     flash('Blog post added successfully!', 'success')
     return redirect(url_for('admin_blog'))
 
-@app.route('/admin/update_order_status', methods=['POST'])
+@route('/admin/update_order_status', methods=['POST'])
 def admin_update_order_status():
     if not session.get('is_admin'):
         return redirect(url_for('index'))
@@ -660,6 +3685,8 @@ def admin_update_order_status():
     
     order = Order.query.get(order_id)
     if order:
+        if order.status != status:
+            bump_counters({order_status_counter(order.status): -1, order_status_counter(status): 1})
         order.status = status
         if admin_notes:
             order.notes = admin_notes
@@ -668,123 +3695,120 @@ def admin_update_order_status():
     
     return redirect(url_for('admin_orders'))
 
-# Initialize database
-with app.app_context():
+# Database setup
+# Nothing runs at import time. 'flask init-db' creates the schema, applies
+# migrations and builds the search index; 'flask seed' also loads the demo
+# data. Run one of them once per deploy, not once per worker.
+def init_db():
     db.create_all()
-    
-    # Create admin user if not exists
-    if not User.query.filter_by(username='admin').first():
-        admin = User(
-            username='admin',
-            email='admin@techstore.com',
-            password_hash=generate_password_hash('admin123'),
-            full_name='Administrator',
-            bio='System administrator with full access to all features',
-            is_admin=True
-        )
-        db.session.add(admin)
-        db.session.commit()
-    
-    # Create sample user for testing
-    if not User.query.filter_by(username='testuser').first():
-        test_user = User(
-            username='testuser',
-            email='test@example.com',
-            password_hash=generate_password_hash('password123'),
-            full_name='Test User',
-            bio='Regular user for testing purposes'
-        )
-        db.session.add(test_user)
-        db.session.commit()
-    
-    # Create sample categories
-    if Category.query.count() == 0:
-        categories = [
-            Category(name='Electronics & Computers', description='Smartphones, laptops, tablets, headphones, smart home devices, and cutting-edge technology'),
-            Category(name='Clothing, Shoes & Jewelry', description='Fashion for men, women, and kids. Shoes, accessories, watches, and jewelry from top brands'),
-            Category(name='Books & Audible', description='Best-selling books, textbooks, e-books, audiobooks, and educational materials'),
-            Category(name='Home & Kitchen', description='Furniture, home decor, kitchen appliances, tools, and garden supplies for your home')
-        ]
-        for category in categories:
-            db.session.add(category)
-        db.session.commit()
-    
-    # Create sample products
-    if Product.query.count() == 0:
-        products = [
-            Product(name='Apple iPhone 15 Pro Max 256GB - Natural Titanium', description='The iPhone 15 Pro Max features a titanium design, A17 Pro chip, and advanced camera system with 5x optical zoom. Includes USB-C connectivity and Action Button for enhanced functionality.', price=1199.00, stock_quantity=47, category_id=1, image_url='https://m.media-amazon.com/images/I/81Os1SDWpcL._AC_SX679_.jpg'),
-            Product(name='Samsung Galaxy S24 Ultra 512GB - Titanium Black', description='Samsung Galaxy S24 Ultra with S Pen, 200MP camera, and AI-powered features. Features a 6.8-inch Dynamic AMOLED 2X display and titanium construction.', price=1299.99, stock_quantity=23, category_id=1, image_url='https://m.media-amazon.com/images/I/71w3e1oKiNL._AC_SX679_.jpg'),
-            Product(name='MacBook Pro 14-inch M3 Pro Chip 512GB SSD - Space Black', description='MacBook Pro with M3 Pro chip, 14-inch Liquid Retina XDR display, and up to 18 hours of battery life. Perfect for professional workflows and creative projects.', price=1999.00, stock_quantity=12, category_id=1, image_url='https://m.media-amazon.com/images/I/61L5QgPvgxL._AC_SX679_.jpg'),
-            Product(name='Nike Air Max 270 Men\'s Running Shoes - Black/White', description='Nike Air Max 270 features the tallest Air Max unit ever for all-day comfort. Mesh upper with synthetic overlays for breathability and support.', price=150.00, stock_quantity=89, category_id=2, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
-            Product(name='Adidas Originals Men\'s Trefoil Hoodie - Black', description='Classic Adidas Originals hoodie with Trefoil logo. Made from soft cotton blend with kangaroo pocket and drawstring hood. Perfect for casual wear.', price=65.00, stock_quantity=156, category_id=2, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
-            Product(name='Python Crash Course, 3rd Edition: A Hands-On, Project-Based Introduction to Programming', description='Learn Python programming through hands-on projects. Covers Python basics, data structures, web applications, and data visualization. Perfect for beginners and intermediate programmers.', price=39.95, stock_quantity=203, category_id=3, image_url='https://m.media-amazon.com/images/I/71NUZ+rHN2L._AC_UY218_.jpg'),
-            Product(name='Fiskars 4-Claw Garden Weeder Tool - Steel Head with Ergonomic Handle', description='Professional garden weeder with 4-claw design for efficient weed removal. Steel head with ergonomic handle for comfortable use. Ideal for maintaining healthy gardens.', price=24.97, stock_quantity=67, category_id=4, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
-            Product(name='Amazon Echo Dot (5th Gen, 2022 release) - Smart speaker with Alexa - Charcoal', description='Smart speaker with Alexa. Voice control your music, get answers, and control smart home devices. Improved audio quality and built-in temperature sensor.', price=49.99, stock_quantity=312, category_id=1, image_url='https://m.media-amazon.com/images/I/714Rq4k05UL._AC_SX679_.jpg'),
-            Product(name='Sony WH-1000XM5 Wireless Premium Noise Canceling Headphones - Black', description='Industry-leading noise canceling with Dual Noise Sensor technology. 30-hour battery life with quick charge. Premium sound quality and comfortable over-ear design.', price=399.99, stock_quantity=28, category_id=1, image_url='https://m.media-amazon.com/images/I/71o8Q5XJS5L._AC_SX679_.jpg'),
-            Product(name='Dell XPS 13 Laptop - 13.4-inch FHD+ Display, Intel Core i7, 16GB RAM, 512GB SSD', description='Premium ultrabook with 13.4-inch InfinityEdge display, Intel Core i7 processor, 16GB RAM, and 512GB SSD. Lightweight design with all-day battery life.', price=1299.99, stock_quantity=15, category_id=1, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
-            Product(name='Nike Dri-FIT Men\'s Training Shorts - Black', description='Lightweight training shorts with Dri-FIT technology to keep you dry and comfortable. Elastic waistband with drawstring and side pockets for essentials.', price=35.00, stock_quantity=178, category_id=2, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
-            Product(name='The Lean Startup: How Today\'s Entrepreneurs Use Continuous Innovation', description='Eric Ries\'s methodology for building successful startups. Learn how to build a sustainable business through validated learning and rapid experimentation.', price=16.99, stock_quantity=145, category_id=3, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY218_.jpg')
-        ]
-        for product in products:
-            db.session.add(product)
-        db.session.commit()
-    
-    # Create sample blog posts
-    if Blog.query.count() == 0:
-        posts = [
-            Blog(title='Black Friday 2024: Best Deals on Electronics and Tech Gadgets', content='Discover the hottest Black Friday deals on smartphones, laptops, headphones, and smart home devices. Our team has curated the best offers from top brands including Apple, Samsung, Sony, and more. Save up to 70% on premium electronics this shopping season.', author='Deal Hunter Team', tags='black friday, deals, electronics, savings'),
-            Blog(title='Sustainable Shopping: How to Make Eco-Friendly Purchases in 2024', content='Learn how to shop sustainably while still getting the products you love. From choosing eco-friendly brands to understanding product lifecycle, discover practical tips for reducing your environmental footprint through conscious shopping decisions.', author='Sustainability Expert', tags='sustainability, eco-friendly, shopping, environment'),
-            Blog(title='Tech Trends 2024: The Gadgets That Will Define This Year', content='From AI-powered devices to foldable smartphones, explore the cutting-edge technology trends shaping 2024. Our comprehensive review covers the latest innovations in consumer electronics, smart home technology, and wearable devices.', author='Tech Innovation Team', tags='technology, trends, gadgets, innovation, 2024'),
-            Blog(title='Home Office Setup Guide: Essential Products for Remote Work', content='Create the perfect home office with our curated selection of ergonomic furniture, high-quality monitors, noise-canceling headphones, and productivity tools. Transform your workspace into a professional environment that boosts productivity and comfort.', author='Workplace Solutions', tags='home office, remote work, productivity, ergonomics'),
-            Blog(title='Fashion Forward: Spring 2024 Style Trends and Must-Have Items', content='Stay ahead of the fashion curve with our guide to spring 2024 trends. From sustainable fashion choices to statement pieces, discover the clothing and accessories that will define this season\'s style.', author='Fashion Editorial Team', tags='fashion, style, trends, spring 2024, clothing')
-        ]
-        for post in posts:
-            db.session.add(post)
-        db.session.commit()
-    
-    # Create sample newsletter subscribers
-    if Newsletter.query.count() == 0:
-        subscribers = [
-            Newsletter(email='john.doe@example.com', name='John Doe', preferences='Electronics, Books, Weekly deals'),
-            Newsletter(email='jane.smith@example.com', name='Jane Smith', preferences='Fashion, Home & Kitchen, Monthly newsletter'),
-            Newsletter(email='mike.wilson@example.com', name='Mike Wilson', preferences='All categories, Daily deals, New arrivals')
-        ]
-        for subscriber in subscribers:
-            db.session.add(subscriber)
-        db.session.commit()
-    
-    # Create sample contact messages
-    if Contact.query.count() == 0:
-        contacts = [
-            Contact(name='Sarah Johnson', email='sarah.j@example.com', subject='Product Inquiry', message='I am interested in learning more about your latest smartphone models and their specifications.'),
-            Contact(name='David Brown', email='david.brown@example.com', subject='Shipping Question', message='Can you provide information about international shipping options and estimated delivery times?'),
-            Contact(name='Lisa Davis', email='lisa.davis@example.com', subject='Return Policy', message='I would like to understand your return policy for electronics and what the process involves.')
-        ]
-        for contact in contacts:
-            db.session.add(contact)
-        db.session.commit()
-    
-    # Create sample reviews
-    if Review.query.count() == 0:
-        reviews = [
-            Review(user_id=1, product_id=1, rating=5, comment='Excellent phone! Great camera quality and battery life. Highly recommended.'),
-            Review(user_id=2, product_id=2, rating=4, comment='Good laptop overall, but the price could be better. Performance is solid.'),
-            Review(user_id=1, product_id=3, rating=5, comment='Amazing headphones! The noise cancellation is incredible.')
-        ]
-        for review in reviews:
-            db.session.add(review)
-        db.session.commit()
-    
-    # Create sample orders with notes
-    if Order.query.count() == 0:
-        orders = [
-            Order(user_id=1, total_amount=1199.00, status='completed', shipping_address='123 Main St, City, State 12345', notes='Please deliver during business hours only.'),
-            Order(user_id=2, total_amount=1999.00, status='shipped', shipping_address='456 Oak Ave, City, State 67890', notes='Gift wrapping requested for this order.'),
-            Order(user_id=1, total_amount=399.99, status='pending', shipping_address='789 Pine Rd, City, State 11111', notes='Customer requested expedited shipping.')
-        ]
-        for order in orders:
-            db.session.add(order)
-        db.session.commit()
+    migrate()
+    init_counters()
+    init_search_index()
+    init_facet_index()
+
+def seed_db():
+    # Each table is only filled while it is empty, one executemany per table
+    users = [
+        dict(username='admin', email='admin@techstore.com', password_hash=hash_password('admin123'),
+             full_name='Administrator', bio='System administrator with full access to all features', is_admin=True),
+        dict(username='testuser', email='test@example.com', password_hash=hash_password('password123'),
+             full_name='Test User', bio='Regular user for testing purposes', is_admin=False),
+    ] if User.query.first() is None else []
+    sample_data = [
+        (User, users),
+        (Category, [
+            dict(name='Electronics & Computers', description='Smartphones, laptops, tablets, headphones, smart home devices, and cutting-edge technology'),
+            dict(name='Clothing, Shoes & Jewelry', description='Fashion for men, women, and kids. Shoes, accessories, watches, and jewelry from top brands'),
+            dict(name='Books & Audible', description='Best-selling books, textbooks, e-books, audiobooks, and educational materials'),
+            dict(name='Home & Kitchen', description='Furniture, home decor, kitchen appliances, tools, and garden supplies for your home')
+        ]),
+        (Product, [
+            dict(name='Apple iPhone 15 Pro Max 256GB - Natural Titanium', description='The iPhone 15 Pro Max features a titanium design, A17 Pro chip, and advanced camera system with 5x optical zoom. Includes USB-C connectivity and Action Button for enhanced functionality.', price=1199.00, stock_quantity=47, category_id=1, image_url='https://m.media-amazon.com/images/I/81Os1SDWpcL._AC_SX679_.jpg'),
+            dict(name='Samsung Galaxy S24 Ultra 512GB - Titanium Black', description='Samsung Galaxy S24 Ultra with S Pen, 200MP camera, and AI-powered features. Features a 6.8-inch Dynamic AMOLED 2X display and titanium construction.', price=1299.99, stock_quantity=23, category_id=1, image_url='https://m.media-amazon.com/images/I/71w3e1oKiNL._AC_SX679_.jpg'),
+            dict(name='MacBook Pro 14-inch M3 Pro Chip 512GB SSD - Space Black', description='MacBook Pro with M3 Pro chip, 14-inch Liquid Retina XDR display, and up to 18 hours of battery life. Perfect for professional workflows and creative projects.', price=1999.00, stock_quantity=12, category_id=1, image_url='https://m.media-amazon.com/images/I/61L5QgPvgxL._AC_SX679_.jpg'),
+            dict(name='Nike Air Max 270 Men\'s Running Shoes - Black/White', description='Nike Air Max 270 features the tallest Air Max unit ever for all-day comfort. Mesh upper with synthetic overlays for breathability and support.', price=150.00, stock_quantity=89, category_id=2, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
+            dict(name='Adidas Originals Men\'s Trefoil Hoodie - Black', description='Classic Adidas Originals hoodie with Trefoil logo. Made from soft cotton blend with kangaroo pocket and drawstring hood. Perfect for casual wear.', price=65.00, stock_quantity=156, category_id=2, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
+            dict(name='Python Crash Course, 3rd Edition: A Hands-On, Project-Based Introduction to Programming', description='Learn Python programming through hands-on projects. Covers Python basics, data structures, web applications, and data visualization. Perfect for beginners and intermediate programmers.', price=39.95, stock_quantity=203, category_id=3, image_url='https://m.media-amazon.com/images/I/71NUZ+rHN2L._AC_UY218_.jpg'),
+            dict(name='Fiskars 4-Claw Garden Weeder Tool - Steel Head with Ergonomic Handle', description='Professional garden weeder with 4-claw design for efficient weed removal. Steel head with ergonomic handle for comfortable use. Ideal for maintaining healthy gardens.', price=24.97, stock_quantity=67, category_id=4, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
+            dict(name='Amazon Echo Dot (5th Gen, 2022 release) - Smart speaker with Alexa - Charcoal', description='Smart speaker with Alexa. Voice control your music, get answers, and control smart home devices. Improved audio quality and built-in temperature sensor.', price=49.99, stock_quantity=312, category_id=1, image_url='https://m.media-amazon.com/images/I/714Rq4k05UL._AC_SX679_.jpg'),
+            dict(name='Sony WH-1000XM5 Wireless Premium Noise Canceling Headphones - Black', description='Industry-leading noise canceling with Dual Noise Sensor technology. 30-hour battery life with quick charge. Premium sound quality and comfortable over-ear design.', price=399.99, stock_quantity=28, category_id=1, image_url='https://m.media-amazon.com/images/I/71o8Q5XJS5L._AC_SX679_.jpg'),
+            dict(name='Dell XPS 13 Laptop - 13.4-inch FHD+ Display, Intel Core i7, 16GB RAM, 512GB SSD', description='Premium ultrabook with 13.4-inch InfinityEdge display, Intel Core i7 processor, 16GB RAM, and 512GB SSD. Lightweight design with all-day battery life.', price=1299.99, stock_quantity=15, category_id=1, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
+            dict(name='Nike Dri-FIT Men\'s Training Shorts - Black', description='Lightweight training shorts with Dri-FIT technology to keep you dry and comfortable. Elastic waistband with drawstring and side pockets for essentials.', price=35.00, stock_quantity=178, category_id=2, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY695_.jpg'),
+            dict(name='The Lean Startup: How Today\'s Entrepreneurs Use Continuous Innovation', description='Eric Ries\'s methodology for building successful startups. Learn how to build a sustainable business through validated learning and rapid experimentation.', price=16.99, stock_quantity=145, category_id=3, image_url='https://m.media-amazon.com/images/I/71Q4+8VqHVL._AC_UY218_.jpg')
+        ]),
+        (Blog, [
+            dict(title='Black Friday 2024: Best Deals on Electronics and Tech Gadgets', content='Discover the hottest Black Friday deals on smartphones, laptops, headphones, and smart home devices. Our team has curated the best offers from top brands including Apple, Samsung, Sony, and more. Save up to 70% on premium electronics this shopping season.', author='Deal Hunter Team', tags='black friday, deals, electronics, savings'),
+            dict(title='Sustainable Shopping: How to Make Eco-Friendly Purchases in 2024', content='Learn how to shop sustainably while still getting the products you love. From choosing eco-friendly brands to understanding product lifecycle, discover practical tips for reducing your environmental footprint through conscious shopping decisions.', author='Sustainability Expert', tags='sustainability, eco-friendly, shopping, environment'),
+            dict(title='Tech Trends 2024: The Gadgets That Will Define This Year', content='From AI-powered devices to foldable smartphones, explore the cutting-edge technology trends shaping 2024. Our comprehensive review covers the latest innovations in consumer electronics, smart home technology, and wearable devices.', author='Tech Innovation Team', tags='technology, trends, gadgets, innovation, 2024'),
+            dict(title='Home Office Setup Guide: Essential Products for Remote Work', content='Create the perfect home office with our curated selection of ergonomic furniture, high-quality monitors, noise-canceling headphones, and productivity tools. Transform your workspace into a professional environment that boosts productivity and comfort.', author='Workplace Solutions', tags='home office, remote work, productivity, ergonomics'),
+            dict(title='Fashion Forward: Spring 2024 Style Trends and Must-Have Items', content='Stay ahead of the fashion curve with our guide to spring 2024 trends. From sustainable fashion choices to statement pieces, discover the clothing and accessories that will define this season\'s style.', author='Fashion Editorial Team', tags='fashion, style, trends, spring 2024, clothing')
+        ]),
+        (Newsletter, [
+            dict(email='john.doe@example.com', name='John Doe', preferences='Electronics, Books, Weekly deals'),
+            dict(email='jane.smith@example.com', name='Jane Smith', preferences='Fashion, Home & Kitchen, Monthly newsletter'),
+            dict(email='mike.wilson@example.com', name='Mike Wilson', preferences='All categories, Daily deals, New arrivals')
+        ]),
+        (Contact, [
+            dict(name='Sarah Johnson', email='sarah.j@example.com', subject='Product Inquiry', message='I am interested in learning more about your latest smartphone models and their specifications.'),
+            dict(name='David Brown', email='david.brown@example.com', subject='Shipping Question', message='Can you provide information about international shipping options and estimated delivery times?'),
+            dict(name='Lisa Davis', email='lisa.davis@example.com', subject='Return Policy', message='I would like to understand your return policy for electronics and what the process involves.')
+        ]),
+        (Review, [
+            dict(user_id=1, product_id=1, rating=5, comment='Excellent phone! Great camera quality and battery life. Highly recommended.'),
+            dict(user_id=2, product_id=2, rating=4, comment='Good laptop overall, but the price could be better. Performance is solid.'),
+            dict(user_id=1, product_id=3, rating=5, comment='Amazing headphones! The noise cancellation is incredible.')
+        ]),
+        (Order, [
+            dict(user_id=1, total_amount=1199.00, status='completed', shipping_address='123 Main St, City, State 12345', notes='Please deliver during business hours only.'),
+            dict(user_id=2, total_amount=1999.00, status='shipped', shipping_address='456 Oak Ave, City, State 67890', notes='Gift wrapping requested for this order.'),
+            dict(user_id=1, total_amount=399.99, status='pending', shipping_address='789 Pine Rd, City, State 11111', notes='Customer requested expedited shipping.')
+        ]),
+    ]
+    for model, rows in sample_data:
+        if rows and model.query.first() is None:
+            db.session.execute(model.__table__.insert(), rows)
+    reconcile_counters()
+    reconcile_ratings()
+    db.session.commit()
+
+@cli.command('init-db')
+def init_db_command():
+    """Create the schema, apply migrations and build the indexes and counters."""
+    init_db()
+    click.echo('Database initialised.')
+
+@cli.command('seed')
+def seed_command():
+    """Initialise the database and load the sample catalog."""
+    init_db()
+    seed_db()
+    click.echo('Sample data loaded.')
+
+def create_app(config=None):
+    """Build a store app from DefaultConfig and the given overrides.
+
+    Every call returns a new app with its own config and extensions. Binding
+    is lazy: no connection is opened until the first query. With
+    TEMPLATE_WARMUP set, every template is loaded before this returns.
+    """
+    app = Flask(__name__)
+    app.config.from_object(DefaultConfig)
+    if config:
+        app.config.from_mapping(config)
+    db.init_app(app)
+    for function in setup_functions:
+        function(app)
+    for command in cli.commands.values():
+        app.cli.add_command(command)
+    app.jinja_env.template_class = TimedTemplate
+    app.jinja_env.bytecode_cache = template_bytecode_cache(app)
+    if app.config['TEMPLATE_WARMUP']:
+        warm_templates(app.jinja_env)
+    return app
 
 if __name__ == '__main__':
+    app = create_app()
+    with app.app_context():
+        init_db()
+        seed_db()
     app.run(debug=True, port=5001)
@@ -0,0 +1,459 @@
+from app import (
+    PRICE_BUCKETS, Blog, Category, Contact, Newsletter, Order, OrderItem, Product, Review, User,
+    create_app as create_store_app, db, hash_password, init_db, rebuild_facets, reconcile_counters,
+    reconcile_ratings,
+)
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import AppGroup
+import click
+import itertools
+import json
+import math
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+cli = AppGroup('loadtest')
+
+# Load testing
+# 'flask generate-data' fills an empty database with a synthetic store at
+# production volumes. Every table draws from its own generator seeded from
+# --seed, so the same seed and scale always give the same rows (password
+# salts aside). 'flask load-test' replays a weighted mix of customer and
+# admin requests against it, in process through the test client or over
+# HTTP with --url, and reports throughput and latency percentiles per route. --output saves the
+# results as JSON; --baseline compares a run with saved results and fails
+# when throughput or a route's p95 latency is worse by more than --tolerance.
+SYNTHETIC_VOLUMES = {
+    'users': 50000,
+    'categories': 40,
+    'products': 100000,
+    'orders': 400000,
+    'order_items': 1000000,
+    'reviews': 500000,
+    'posts': 5000,
+    'subscribers': 200000,
+    'contacts': 20000,
+}
+SYNTHETIC_WORDS = {
+    'brand': ['Acme', 'Northwind', 'Contoso', 'Fabrikam', 'Globex', 'Initech', 'Vandelay', 'Hooli', 'Soylent', 'Tyrell', 'Wonka', 'Stark'],
+    'adjective': ['Wireless', 'Portable', 'Smart', 'Compact', 'Premium', 'Classic', 'Ultra', 'Eco', 'Pro', 'Mini', 'Rugged', 'Ergonomic'],
+    'noun': ['Headphones', 'Speaker', 'Laptop', 'Monitor', 'Keyboard', 'Backpack', 'Jacket', 'Sneakers', 'Lamp', 'Blender',
+             'Kettle', 'Chair', 'Desk', 'Camera', 'Watch', 'Router', 'Novel', 'Cookbook', 'Drill', 'Tent'],
+    'color': ['Black', 'White', 'Silver', 'Navy', 'Red', 'Green', 'Graphite', 'Sand'],
+    'first': ['Alex', 'Sam', 'Jordan', 'Taylor', 'Morgan', 'Casey', 'Riley', 'Jamie', 'Avery', 'Quinn', 'Robin', 'Drew'],
+    'last': ['Smith', 'Garcia', 'Chen', 'Okafor', 'Novak', 'Silva', 'Kim', 'Patel', 'Muller', 'Rossi', 'Haddad', 'Larsen'],
+}
+SYNTHETIC_COMMENTS = [
+    'Exactly as described.', 'Works well, arrived quickly.', 'Good value for the price.',
+    'Stopped working after a month.', 'Better than I expected.', 'Decent, but the manual is poor.',
+    'Would buy again.', 'Feels cheap.', 'My second one, still happy.', 'Returned it.',
+]
+SYNTHETIC_EPOCH = datetime(2023, 1, 1)
+SYNTHETIC_SPAN = timedelta(days=730)
+# Every generated account shares this password
+LOAD_TEST_PASSWORD = 'loadtest'
+# Routes with fewer measured requests than this are reported but not compared,
+# as their tail percentiles are mostly noise
+LOAD_TEST_MIN_SAMPLES = 50
+
+def synthetic_time(index, total):
+    # Spread rows evenly over the span so ids grow with created_at
+    return SYNTHETIC_EPOCH + SYNTHETIC_SPAN * (index / max(total, 1))
+
+def skewed_id(rng, count):
+    # Low ids are the popular ones: half of all picks fall in the first eighth
+    return int(count * rng.random() ** 3) + 1
+
+def synthetic_name(rng):
+    return f"{rng.choice(SYNTHETIC_WORDS['first'])} {rng.choice(SYNTHETIC_WORDS['last'])}"
+
+def synthetic_users(volumes, seed):
+    rng = random.Random(f'{seed}:users')
+    password_hash = hash_password(LOAD_TEST_PASSWORD)
+    total = volumes['users']
+    yield dict(id=1, username='admin', email='admin@example.com', password_hash=password_hash,
+               full_name='Administrator', is_admin=True, created_at=SYNTHETIC_EPOCH)
+    for n in range(2, total + 1):
+        yield dict(id=n, username=f'customer{n}', email=f'customer{n}@example.com', password_hash=password_hash,
+                   full_name=synthetic_name(rng), is_admin=False, created_at=synthetic_time(n, total))
+
+def synthetic_categories(volumes, seed):
+    nouns = SYNTHETIC_WORDS['noun']
+    pairs = [(a, b) for a in nouns for b in nouns if a != b]
+    random.Random(f'{seed}:categories').shuffle(pairs)
+    for n, (first, second) in enumerate(pairs[:volumes['categories']], 1):
+        yield dict(id=n, name=f'{first} & {second}', description=f'{first}, {second.lower()} and accessories',
+                   created_at=SYNTHETIC_EPOCH)
+
+def synthetic_products(volumes, seed, prices):
+    # Prices are appended to prices for the order generator
+    rng = random.Random(f'{seed}:products')
+    words = SYNTHETIC_WORDS
+    total = volumes['products']
+    for n in range(1, total + 1):
+        brand, adjective, noun, color = (rng.choice(words[key]) for key in ('brand', 'adjective', 'noun', 'color'))
+        price = round(math.exp(rng.uniform(math.log(5), math.log(2500))), 2)
+        prices.append(price)
+        yield dict(
+            id=n, sku=f'SYN-{n:07d}', name=f'{brand} {adjective} {noun} {rng.randint(100, 999)} - {color}',
+            description=f'{adjective} {noun.lower()} from {brand} in {color.lower()}. {rng.choice(SYNTHETIC_COMMENTS)}',
+            price=price, stock_quantity=0 if rng.random() < 0.1 else rng.randint(1, 500), image_url=None,
+            category_id=rng.randint(1, volumes['categories']), created_at=synthetic_time(n, total),
+        )
+
+def synthetic_orders(volumes, seed, prices):
+    # Yields (order, items) pairs; item counts average order_items / orders
+    rng = random.Random(f'{seed}:orders')
+    total = volumes['orders']
+    most_items = max(1, round(2 * volumes['order_items'] / max(total, 1) - 1))
+    statuses = ['pending', 'processing', 'shipped', 'completed', 'completed', 'completed', 'cancelled']
+    item_id = 0
+    for n in range(1, total + 1):
+        items = []
+        for _ in range(rng.randint(1, most_items)):
+            item_id += 1
+            product_id = skewed_id(rng, len(prices))
+            items.append(dict(id=item_id, order_id=n, product_id=product_id, quantity=rng.randint(1, 3),
+                              price=prices[product_id - 1]))
+        order = dict(
+            id=n, user_id=rng.randint(2, volumes['users']),
+            total_amount=round(sum(item['price'] * item['quantity'] for item in items), 2),
+            status=rng.choice(statuses), shipping_address=f'{rng.randint(1, 999)} Market St, Springfield',
+            notes=None, created_at=synthetic_time(n, total),
+        )
+        yield order, items
+
+def synthetic_reviews(volumes, seed):
+    rng = random.Random(f'{seed}:reviews')
+    total = volumes['reviews']
+    for n in range(1, total + 1):
+        yield dict(id=n, user_id=rng.randint(2, volumes['users']), product_id=skewed_id(rng, volumes['products']),
+                   rating=rng.choices(range(1, 6), weights=(5, 7, 13, 30, 45))[0],
+                   comment=rng.choice(SYNTHETIC_COMMENTS), created_at=synthetic_time(n, total))
+
+def synthetic_posts(volumes, seed):
+    rng = random.Random(f'{seed}:posts')
+    words = SYNTHETIC_WORDS
+    total = volumes['posts']
+    for n in range(1, total + 1):
+        adjective, noun = rng.choice(words['adjective']), rng.choice(words['noun'])
+        paragraph = ' '.join(
+            f'The {rng.choice(words["brand"])} {noun.lower()} is {rng.choice(SYNTHETIC_COMMENTS).lower()}'
+            for _ in range(rng.randint(5, 30))
+        )
+        yield dict(id=n, title=f'{rng.choice(["Choosing", "Reviewing", "Caring for"])} a {adjective} {noun}',
+                   content=paragraph, author=synthetic_name(rng), tags=f'{adjective.lower()}, {noun.lower()}',
+                   created_at=synthetic_time(n, total))
+
+def synthetic_subscribers(volumes, seed):
+    rng = random.Random(f'{seed}:subscribers')
+    total = volumes['subscribers']
+    for n in range(1, total + 1):
+        yield dict(id=n, email=f'subscriber{n}@example.com', name=synthetic_name(rng),
+                   preferences=', '.join(rng.sample(SYNTHETIC_WORDS['noun'], 3)), created_at=synthetic_time(n, total))
+
+def synthetic_contacts(volumes, seed):
+    rng = random.Random(f'{seed}:contacts')
+    total = volumes['contacts']
+    for n in range(1, total + 1):
+        yield dict(id=n, name=synthetic_name(rng), email=f'contact{n}@example.com',
+                   subject=rng.choice(['Order status', 'Return request', 'Product question', 'Invoice']),
+                   message=rng.choice(SYNTHETIC_COMMENTS), created_at=synthetic_time(n, total))
+
+def generate_dataset(volumes, seed, batch_size, progress=None):
+    prices = []
+    tables = [
+        (User, synthetic_users(volumes, seed)),
+        (Category, synthetic_categories(volumes, seed)),
+        (Product, synthetic_products(volumes, seed, prices)),
+        (Review, synthetic_reviews(volumes, seed)),
+        (Blog, synthetic_posts(volumes, seed)),
+        (Newsletter, synthetic_subscribers(volumes, seed)),
+        (Contact, synthetic_contacts(volumes, seed)),
+    ]
+    for model, rows in tables:
+        written = 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            db.session.execute(model.__table__.insert(), batch)
+            db.session.commit()
+            written += len(batch)
+        if progress:
+            progress(model.__tablename__, written)
+
+    orders = synthetic_orders(volumes, seed, prices)
+    written = items_written = 0
+    while True:
+        batch = list(itertools.islice(orders, batch_size))
+        if not batch:
+            break
+        items = [item for order, order_items in batch for item in order_items]
+        db.session.execute(Order.__table__.insert(), [order for order, order_items in batch])
+        db.session.execute(OrderItem.__table__.insert(), items)
+        db.session.commit()
+        written += len(batch)
+        items_written += len(items)
+    if progress:
+        progress(Order.__tablename__, written)
+        progress(OrderItem.__tablename__, items_written)
+
+    reconcile_counters()
+    reconcile_ratings()
+    rebuild_facets()
+    db.session.commit()
+
+@cli.command('generate-data')
+@click.option('--scale', default=1.0, help='Multiplier for the default volumes.')
+@click.option('--seed', default=42, help='Seed for the generators.')
+@click.option('--batch-size', default=10000, help='Rows per insert batch.')
+def generate_data_command(scale, seed, batch_size):
+    """Fill an empty database with a deterministic synthetic store."""
+    init_db()
+    if Product.query.first() is not None or User.query.first() is not None:
+        raise click.ClickException('generate-data needs an empty database; point DATABASE_URL at a new file.')
+    volumes = {name: max(1, int(count * scale)) for name, count in SYNTHETIC_VOLUMES.items()}
+    volumes['users'] = max(volumes['users'], 2)
+    started = time.perf_counter()
+    generate_dataset(volumes, seed, batch_size, progress=lambda table, count: click.echo(f'{table:<14} {count:>9} rows'))
+    click.echo(f'Generated in {time.perf_counter() - started:.1f}s. Every account uses the password "{LOAD_TEST_PASSWORD}".')
+
+def browse_step(rng, ids):
+    category = rng.randint(1, ids['categories'])
+    return [('products', 'GET', rng.choice([
+        '/products',
+        f'/products?category={category}',
+        f'/products?category={category}&price={rng.randrange(len(PRICE_BUCKETS))}&in_stock=1',
+        f'/products?after={rng.randint(1, ids["products"])}',
+        '/products?sort=top_rated',
+    ]), None)]
+
+def product_step(rng, ids):
+    return [('product_detail', 'GET', f'/product/{skewed_id(rng, ids["products"])}', None)]
+
+def search_step(rng, ids):
+    word = rng.choice(SYNTHETIC_WORDS[rng.choice(['brand', 'adjective', 'noun'])]).lower()
+    if rng.random() < 0.3:
+        return [('autocomplete', 'GET', f'/autocomplete?q={word[:3]}', None)]
+    return [('search', 'GET', rng.choice([f'/search?q={word}', f'/products?search={word}']), None)]
+
+def cart_step(rng, ids):
+    return [('add_to_cart', 'POST', '/add_to_cart', {'product_id': skewed_id(rng, ids['products']), 'quantity': 1})]
+
+def checkout_step(rng, ids):
+    return cart_step(rng, ids) + [
+        ('start_checkout', 'POST', '/checkout/start', {}),
+        ('checkout', 'GET', '/checkout', None),
+        ('place_order', 'POST', '/checkout', {'shipping_address': '1 Load Test Way', 'notes': ''}),
+    ]
+
+def admin_step(rng, ids):
+    # Labels starting with 'admin' are sent with the admin session
+    label, path = rng.choice([
+        ('admin_dashboard', '/admin'),
+        ('admin_orders', '/admin/orders'),
+        ('admin_order_detail', f'/admin/orders/{rng.randint(1, ids["orders"])}'),
+        ('admin_users', '/admin/users'),
+        ('admin_reviews', '/admin/reviews'),
+        ('admin_products', '/admin/products'),
+    ])
+    return [(label, 'GET', path, None)]
+
+# (weight, step) pairs; each step returns the (label, method, path, form)
+# requests one visitor action makes
+LOAD_TEST_MIX = [
+    (30, browse_step),
+    (30, product_step),
+    (14, search_step),
+    (12, cart_step),
+    (4, checkout_step),
+    (10, admin_step),
+]
+
+class TestClientSession:
+    # Logging in writes the session directly, so runs do not spend their
+    # time in password hashing
+    def __init__(self):
+        self.client = current_app.test_client()
+
+    def login(self, user):
+        with self.client.session_transaction() as client_session:
+            client_session['user_id'] = user.id
+            client_session['username'] = user.username
+            client_session['is_admin'] = user.is_admin
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        response.get_data()
+        return response.status_code
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+class HttpSession:
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(NoRedirect(), urllib.request.HTTPCookieProcessor())
+
+    def send(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method), timeout=30) as response:
+                response.read()
+                return response.status, response.headers
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code, e.headers
+
+    def login(self, user):
+        while True:
+            status, headers = self.send('POST', '/login', {'username': user.username, 'password': LOAD_TEST_PASSWORD})
+            if status != 429:
+                break
+            time.sleep(float(headers.get('Retry-After', 1)))
+        if status != 302:
+            raise click.ClickException(f'Could not log in as {user.username} (HTTP {status}); was the data made by generate-data?')
+
+    def request(self, method, path, data=None):
+        return self.send(method, path, data)[0]
+
+def run_load_test(sessions, admin, ids, requests_per_worker, warmup, seed):
+    steps = [step for weight, step in LOAD_TEST_MIX]
+    weights = [weight for weight, step in LOAD_TEST_MIX]
+    rngs = [random.Random(f'{seed}:worker{n}') for n in range(len(sessions))]
+    timings = [{} for _ in sessions]
+    errors = [{} for _ in sessions]
+
+    def worker(n, count, record):
+        done = 0
+        while done < count:
+            for label, method, path, data in rngs[n].choices(steps, weights)[0](rngs[n], ids):
+                session = admin if label.startswith('admin') else sessions[n]
+                started = time.perf_counter()
+                status = session.request(method, path, data)
+                elapsed = time.perf_counter() - started
+                if record:
+                    timings[n].setdefault(label, []).append(elapsed)
+                    if status >= 400:
+                        errors[n][label] = errors[n].get(label, 0) + 1
+                done += 1
+
+    def run(count, record):
+        threads = [threading.Thread(target=worker, args=(n, count, record)) for n in range(len(sessions))]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - started
+
+    # Warm caches, indexes and connection pools before measuring
+    run(warmup, False)
+    elapsed = run(requests_per_worker, True)
+
+    merged, failed = {}, {}
+    for worker_timings, worker_errors in zip(timings, errors):
+        for label, values in worker_timings.items():
+            merged.setdefault(label, []).extend(values)
+        for label, count in worker_errors.items():
+            failed[label] = failed.get(label, 0) + count
+    routes = {}
+    for label, values in sorted(merged.items()):
+        values.sort()
+        routes[label] = {
+            'requests': len(values),
+            'errors': failed.get(label, 0),
+            'rps': round(len(values) / elapsed, 1),
+            'p50_ms': round(values[int(len(values) * 0.50)] * 1000, 2),
+            'p95_ms': round(values[int(len(values) * 0.95)] * 1000, 2),
+            'p99_ms': round(values[int(len(values) * 0.99)] * 1000, 2),
+        }
+    total = sum(route['requests'] for route in routes.values())
+    return {'elapsed': round(elapsed, 2), 'rps': round(total / elapsed, 1), 'routes': routes}
+
+def load_test_regressions(result, baseline, tolerance):
+    problems = []
+    if result['rps'] < baseline['rps'] * (1 - tolerance):
+        problems.append(f"overall: {result['rps']} req/s, baseline {baseline['rps']}")
+    for label, before in baseline['routes'].items():
+        after = result['routes'].get(label)
+        if after is None or min(after['requests'], before['requests']) < LOAD_TEST_MIN_SAMPLES:
+            continue
+        if after['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            problems.append(f"{label}: p95 {after['p95_ms']} ms, baseline {before['p95_ms']} ms")
+        if after['rps'] < before['rps'] * (1 - tolerance):
+            problems.append(f"{label}: {after['rps']} req/s, baseline {before['rps']}")
+        if after['errors'] > before['errors']:
+            problems.append(f"{label}: {after['errors']} errors, baseline {before['errors']}")
+    return problems
+
+@cli.command('load-test')
+@click.option('--url', default=None, help='Base URL of a running server; without it requests go through the test client.')
+@click.option('--workers', default=8, help='Concurrent visitors, each logged in as its own customer.')
+@click.option('--requests', 'requests_per_worker', default=500, help='Measured requests per worker.')
+@click.option('--warmup', default=50, help='Unmeasured requests per worker before the run.')
+@click.option('--seed', default=42, help='Seed for the request mix.')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write the results to this JSON file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Results of an earlier run to compare with.')
+@click.option('--tolerance', default=0.2, help='Allowed slowdown against the baseline, as a fraction.')
+def load_test_command(url, workers, requests_per_worker, warmup, seed, output, baseline, tolerance):
+    """Replay a mixed browse, search, cart, checkout and admin workload and report per-route latency."""
+    ids = {
+        name: db.session.query(db.func.max(model.id)).scalar() or 0
+        for name, model in (('products', Product), ('categories', Category), ('orders', Order))
+    }
+    admin = User.query.filter_by(is_admin=True).order_by(User.id).first()
+    customers = User.query.filter_by(is_admin=False).order_by(User.id).limit(workers).all()
+    if not ids['products'] or not ids['orders'] or admin is None or len(customers) < workers:
+        raise click.ClickException(f'Needs products, orders, an admin and {workers} customers; run "flask generate-data" first.')
+    db.session.remove()
+
+    make_session = (lambda: HttpSession(url)) if url else TestClientSession
+    admin_session = make_session()
+    admin_session.login(admin)
+    sessions = []
+    for customer in customers:
+        sessions.append(make_session())
+        sessions[-1].login(customer)
+
+    result = run_load_test(sessions, admin_session, ids, requests_per_worker, warmup, seed)
+    result['settings'] = {'target': url or 'test client', 'workers': workers, 'requests': requests_per_worker,
+                          'warmup': warmup, 'seed': seed, 'products': ids['products']}
+
+    click.echo(f"{'route':<20} {'requests':>9} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for label, route in result['routes'].items():
+        click.echo(f"{label:<20} {route['requests']:>9} {route['errors']:>7} {route['rps']:>8} "
+                   f"{route['p50_ms']:>8} {route['p95_ms']:>8} {route['p99_ms']:>8}")
+    click.echo(f"{'total':<20} {sum(r['requests'] for r in result['routes'].values()):>9} "
+               f"{sum(r['errors'] for r in result['routes'].values()):>7} {result['rps']:>8}")
+    if output:
+        with open(output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+    if baseline:
+        with open(baseline) as f:
+            before = json.load(f)
+        if before.get('settings', {}) != result['settings']:
+            click.echo('Warning: the baseline was recorded with different settings.')
+        problems = load_test_regressions(result, before, tolerance)
+        if problems:
+            raise click.ClickException('Regressions against the baseline:\n  ' + '\n  '.join(problems))
+        click.echo(f'No regressions beyond {tolerance:.0%} of the baseline.')
+
+def create_app(config=None):
+    """The store app from app.create_app() with the load testing commands added.
+
+    Run them with 'flask --app loadtest generate-data' or 'load-test'; the
+    store itself never imports this module.
+    """
+    app = create_store_app(config)
+    for command in cli.commands.values():
+        app.cli.add_command(command)
+    return app
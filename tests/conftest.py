@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as store  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    """A store app bound to a fresh SQLite file holding the sample data."""
+    app = store.create_app({
+        'TESTING': True,
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'store.db'}",
+        'CACHE_ENABLED': False,
+        'WRITE_BEHIND_ENABLED': False,
+        'WRITE_JOURNAL_DIR': str(tmp_path / 'write_journal'),
+        'TEMPLATE_CACHE_DIR': None,
+        'IMAGE_STORE_DIR': str(tmp_path / 'images'),
+    })
+    with app.app_context():
+        store.init_db()
+        store.seed_db()
+    yield app
+    with app.app_context():
+        store.db.session.remove()
+        store.db.get_engine().dispose()
@@ -0,0 +1,15 @@
+import app as store
+
+
+def test_admin_products_are_paged(app):
+    client = app.test_client()
+    with app.app_context():
+        admin_id = store.User.query.filter_by(is_admin=True).first().id
+        first_ids = [id for (id,) in store.db.session.query(store.Product.id).order_by(store.Product.id).limit(3)]
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = admin_id
+        client_session['is_admin'] = True
+    response = client.get('/admin/products?per_page=2')
+    assert response.status_code == 200
+    assert f'after={first_ids[1]}'.encode() in response.data
+    assert f'/product/{first_ids[2]}'.encode() not in response.data
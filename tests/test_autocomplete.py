@@ -0,0 +1,72 @@
+import io
+import json
+import time
+import uuid
+from datetime import datetime
+
+import app as store
+
+
+def is_stale(index):
+    return index.versions != store.autocomplete_versions()
+
+
+def built_index(app):
+    store.rebuild_autocomplete(app)
+    return store.get_autocomplete_index()
+
+
+def wait_for_rebuild(app):
+    app.extensions['autocomplete_rebuild'].join(10)
+    return app.extensions['autocomplete']
+
+
+def test_only_label_changes_mark_the_index_stale(app):
+    with app.app_context():
+        index = built_index(app)
+        store.write_submissions([{
+            'id': uuid.uuid4().hex,
+            'kind': 'review',
+            'values': {'user_id': 2, 'product_id': 1, 'rating': 5, 'comment': 'Great'},
+            'created_at': datetime.utcnow().isoformat(),
+        }])
+        assert not is_stale(index)
+
+        row = {'sku': 'NEW-1', 'name': 'Quartz Desk Lamp', 'price': 20, 'stock_quantity': 4, 'category_id': 1}
+        store.import_catalog(io.BytesIO(json.dumps(row).encode() + b'\n'), 'jsonl')
+        assert is_stale(index)
+
+
+def test_first_build_runs_outside_the_request(app):
+    client = app.test_client()
+    response = client.get('/autocomplete?q=lap')
+    assert response.json['results'] == []
+    assert response.cache_control.no_store
+    with app.app_context():
+        wait_for_rebuild(app)
+    response = client.get('/autocomplete?q=lap')
+    assert response.json['results']
+    assert response.cache_control.max_age == 60
+
+
+def test_added_entries_keep_a_concurrent_invalidation(app):
+    with app.app_context():
+        index = built_index(app)
+        store.invalidate('labels')
+        store.autocomplete_add('category', 999, 'Quartz Gadgets', store.CATEGORY_SCORE)
+        assert is_stale(index)
+        assert [item[3] for item in index.search('quartz', 5)] == ['Quartz Gadgets']
+
+
+def test_old_or_overfull_indexes_are_rebuilt(app):
+    app.config['AUTOCOMPLETE_REFRESH_SECONDS'] = 3600
+    with app.app_context():
+        index = built_index(app)
+        index.built_at = time.time() - app.config['AUTOCOMPLETE_MAX_AGE']
+        assert store.get_autocomplete_index() is index
+        rebuilt = wait_for_rebuild(app)
+        assert rebuilt is not index
+
+        rebuilt.added = [(0.0, 'post', n, f'Post {n}') for n in range(store.AUTOCOMPLETE_MAX_ADDED + 1)]
+        store.get_autocomplete_index()
+        assert wait_for_rebuild(app) is not rebuilt
@@ -0,0 +1,19 @@
+import app as store
+
+
+def test_sqlite_cache_evicts_least_recently_read(tmp_path, monkeypatch):
+    monkeypatch.setattr(store.SQLiteCache, 'PRUNE_EVERY', 1)
+    clock = [1000.0]
+    monkeypatch.setattr(store.time, 'time', lambda: clock[0])
+    cache = store.SQLiteCache(str(tmp_path / 'cache.db'), max_entries=2)
+    cache.set('old', 1)
+    clock[0] += 100
+    cache.set('newer', 2)
+    clock[0] += 100
+    # Read long after it was written, so it is now the most recently used
+    assert cache.get('old') == 1
+    clock[0] += 100
+    cache.set('newest', 3)
+    assert cache.get('old') == 1
+    assert cache.get('newer') is None
+    assert cache.get('newest') == 3
@@ -0,0 +1,59 @@
+from datetime import datetime, timedelta
+
+import app as store
+
+
+def test_guest_cart_is_merged_on_login(app):
+    client = app.test_client()
+    assert client.post('/add_to_cart', data={'product_id': 1, 'quantity': 2}).get_json() == {'success': 'Product added to cart!'}
+    assert client.post('/add_to_cart', data={'product_id': 3, 'quantity': 1}).status_code == 200
+    assert client.post('/update_cart', data={'product_id': 3, 'quantity': 4}).status_code == 200
+    assert client.get('/cart').status_code == 200
+    with client.session_transaction() as client_session:
+        guest_cart_id = client_session['cart_id']
+    # Checkout still needs an account
+    assert client.get('/checkout').status_code == 302
+
+    with app.app_context():
+        user_cart_id = store.user_cart_id(store.User.query.filter_by(username='testuser').one().id)
+        store.cart_add(user_cart_id, 1, 1)
+        store.db.session.commit()
+
+    response = client.post('/login', data={'username': 'testuser', 'password': 'password123'})
+    assert response.status_code == 302
+    with client.session_transaction() as client_session:
+        assert 'cart_id' not in client_session
+    with app.app_context():
+        assert store.cart_items(guest_cart_id) == []
+        assert store.cart_items(user_cart_id) == [
+            {'product_id': 1, 'quantity': 3},
+            {'product_id': 3, 'quantity': 4},
+        ]
+
+
+def test_unknown_products_are_not_added(app):
+    client = app.test_client()
+    response = client.post('/add_to_cart', data={'product_id': 999999, 'quantity': 1})
+    assert response.status_code == 404
+    assert client.post('/update_cart', data={'product_id': 999999, 'quantity': 2}).status_code == 404
+    with app.app_context():
+        assert store.CartItem.query.filter_by(product_id=999999).count() == 0
+
+
+def test_only_abandoned_guest_carts_are_purged(app):
+    now = datetime.utcnow()
+    old = now - timedelta(days=app.config['GUEST_CART_DAYS'] + 1)
+    with app.app_context():
+        for cart_id, product_id, updated_at in [
+            ('abandoned', 1, old), ('abandoned', 2, old),
+            ('active', 1, old), ('active', 2, now),
+            (store.user_cart_id(2), 1, old),
+        ]:
+            store.db.session.add(store.CartItem(cart_id=cart_id, product_id=product_id, quantity=1, updated_at=updated_at))
+        store.db.session.commit()
+    result = app.test_cli_runner().invoke(args=['purge-carts'])
+    assert 'Deleted 2 guest cart lines' in result.output
+    with app.app_context():
+        assert store.cart_items('abandoned') == []
+        assert len(store.cart_items('active')) == 2
+        assert len(store.cart_items(store.user_cart_id(2))) == 1
@@ -0,0 +1,167 @@
+import threading
+from datetime import datetime, timedelta
+
+import app as store
+
+STOCK = 5
+SHOPPERS = 16
+
+
+def add_shoppers(count):
+    # Sessions are written directly, so the password hash is never checked
+    rows = [
+        {'username': f'shopper{n}', 'email': f'shopper{n}@example.com', 'password_hash': 'unused'}
+        for n in range(count)
+    ]
+    store.db.session.execute(store.User.__table__.insert(), rows)
+    store.db.session.commit()
+    return [user.id for user in store.User.query.filter(store.User.username.like('shopper%')).order_by(store.User.id)]
+
+
+def client_for(app, user_id):
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = user_id
+    return client
+
+
+def set_stock(product_id, quantity):
+    store.Product.query.filter_by(id=product_id).update({'stock_quantity': quantity})
+    store.db.session.commit()
+
+
+def run_together(targets):
+    barrier = threading.Barrier(len(targets))
+    errors = []
+
+    def run(target):
+        try:
+            barrier.wait()
+            target()
+        except Exception as e:  # surfaced by the assertion below
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(target,)) for target in targets]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors, errors
+
+
+def product_orders(product_id):
+    return store.OrderItem.query.filter_by(product_id=product_id).count()
+
+
+def test_concurrent_checkouts_sell_exactly_the_stock(app):
+    with app.app_context():
+        user_ids = add_shoppers(SHOPPERS)
+        set_stock(1, STOCK)
+        orders_before = product_orders(1)
+
+    def shop(user_id):
+        client = client_for(app, user_id)
+
+        def checkout():
+            assert client.post('/add_to_cart', data={'product_id': 1, 'quantity': 1}).status_code == 200
+            client.post('/checkout/start')
+            client.post('/checkout', data={'shipping_address': '1 Test Street'})
+        return checkout
+
+    run_together([shop(user_id) for user_id in user_ids])
+
+    with app.app_context():
+        assert product_orders(1) - orders_before == STOCK
+        assert store.db.session.get(store.Product, 1).stock_quantity == 0
+        assert store.StockReservation.query.count() == 0
+
+
+def test_double_submitted_checkout_places_one_order(app):
+    with app.app_context():
+        user_id = add_shoppers(1)[0]
+        set_stock(1, 10)
+        orders_before = product_orders(1)
+    client = client_for(app, user_id)
+    client.post('/add_to_cart', data={'product_id': 1, 'quantity': 1})
+    client.post('/checkout/start')
+
+    clients = [client_for(app, user_id) for _ in range(2)]
+    run_together([
+        lambda c=c: c.post('/checkout', data={'shipping_address': '1 Test Street'})
+        for c in clients
+    ])
+
+    with app.app_context():
+        assert product_orders(1) - orders_before == 1
+        assert store.db.session.get(store.Product, 1).stock_quantity == 9
+
+
+def test_expired_hold_is_released_once(app):
+    with app.app_context():
+        set_stock(1, 0)
+        store.db.session.execute(store.StockReservation.__table__.insert(), [{
+            'cart_id': 'abandoned', 'product_id': 1, 'quantity': 5,
+            'expires_at': datetime.utcnow() - timedelta(minutes=1),
+        }])
+        store.db.session.commit()
+
+    def release():
+        with app.app_context():
+            store.release_expired_reservations()
+            store.db.session.commit()
+
+    run_together([release, release])
+
+    with app.app_context():
+        assert store.db.session.get(store.Product, 1).stock_quantity == 5
+        assert store.StockReservation.query.count() == 0
+
+
+def test_non_positive_quantities_are_rejected(app):
+    with app.app_context():
+        user_id = add_shoppers(1)[0]
+        stock = store.db.session.get(store.Product, 1).stock_quantity
+    client = client_for(app, user_id)
+
+    for quantity in (0, -5):
+        assert client.post('/add_to_cart', data={'product_id': 1, 'quantity': quantity}).status_code == 400
+    client.post('/checkout', data={'shipping_address': '1 Test Street'})
+
+    with app.app_context():
+        assert store.db.session.get(store.Product, 1).stock_quantity == stock
+        assert store.CartItem.query.filter_by(cart_id=store.user_cart_id(user_id)).count() == 0
+
+
+def test_viewing_checkout_holds_no_stock(app):
+    with app.app_context():
+        user_id = add_shoppers(1)[0]
+        set_stock(1, 3)
+    client = client_for(app, user_id)
+    client.post('/add_to_cart', data={'product_id': 1, 'quantity': 2})
+    assert client.get('/checkout').status_code == 200
+    with app.app_context():
+        assert store.db.session.get(store.Product, 1).stock_quantity == 3
+        assert store.StockReservation.query.count() == 0
+
+    assert client.post('/checkout/start').headers['Location'].endswith('/checkout')
+    with app.app_context():
+        assert store.db.session.get(store.Product, 1).stock_quantity == 1
+        assert store.StockReservation.query.count() == 1
+
+
+def test_expired_holds_on_a_product_are_released_when_it_is_bought(app):
+    with app.app_context():
+        user_id = add_shoppers(1)[0]
+        set_stock(1, 0)
+        store.db.session.execute(store.StockReservation.__table__.insert(), [{
+            'cart_id': 'abandoned', 'product_id': 1, 'quantity': 2,
+            'expires_at': datetime.utcnow() - timedelta(minutes=1),
+        }])
+        store.db.session.commit()
+    client = client_for(app, user_id)
+    client.post('/add_to_cart', data={'product_id': 1, 'quantity': 1})
+    client.post('/checkout', data={'shipping_address': '1 Test Street'})
+    with app.app_context():
+        assert store.db.session.get(store.Product, 1).stock_quantity == 1
+        assert store.StockReservation.query.count() == 0
+        assert store.Order.query.filter_by(user_id=user_id).count() == 1
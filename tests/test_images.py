@@ -0,0 +1,27 @@
+import hashlib
+
+import app as store
+
+PNG = b'\x89PNG\r\n\x1a\n' + b'\0' * 32
+
+
+def stored_original():
+    digest = hashlib.sha256(PNG).hexdigest()
+    store.write_image_file(f'{digest}.png', PNG)
+    return digest
+
+
+def test_only_configured_variants_are_served(app, monkeypatch):
+    # Without Pillow nothing is queued, so only the routing is exercised
+    monkeypatch.setattr(store, 'Image', None)
+    with app.app_context():
+        digest = stored_original()
+    client = app.test_client()
+    width = min(app.config['IMAGE_WIDTHS'])
+    response = client.get(f'/images/{digest}-{width}.webp')
+    assert response.status_code == 200
+    assert response.data == PNG
+    assert client.get(f'/images/{digest}-{width + 1}.webp').status_code == 404
+    assert client.get(f'/images/{digest}-0{width}.jpg').status_code == 404
+    assert client.get(f'/images/{digest}-{width}.png').status_code == 404
+    assert client.get(f'/images/{digest}.png').status_code == 200
@@ -0,0 +1,74 @@
+import io
+import json
+
+import app as store
+
+
+def feed(*rows):
+    return io.BytesIO(''.join(json.dumps(row) + '\n' for row in rows).encode())
+
+
+def product(sku, **values):
+    return dict({'sku': sku, 'name': f'Product {sku}', 'price': '9.99', 'stock_quantity': 3, 'category_id': 1}, **values)
+
+
+def test_non_finite_prices_are_rejected(app):
+    with app.app_context():
+        report = store.import_catalog(feed(
+            product('NAN-1', price='nan'),
+            product('INF-1', price='inf'),
+            product('INF-2', price='-Infinity'),
+            product('OK-1'),
+        ), 'jsonl')
+        assert report.inserted == 1
+        assert [line for line, message in report.errors] == [1, 2, 3]
+        assert all('finite' in message for line, message in report.errors)
+        assert store.Product.query.filter(store.Product.sku.in_(['NAN-1', 'INF-1', 'INF-2'])).count() == 0
+
+
+def test_rows_the_database_rejects_are_reported_and_the_rest_written(app):
+    with app.app_context():
+        products_before = store.Product.query.count()
+        report = store.ImportReport(10)
+        good = store.parse_product_row(product('GOOD-1'), {'general': 1})
+        also_good = store.parse_product_row(product('GOOD-2'), {'general': 1})
+        # A row that passed parsing but breaks a constraint, such as a
+        # category deleted while the import ran
+        bad = dict(store.parse_product_row(product('BAD-1'), {'general': 1}), name=None)
+        store.write_product_batch({'GOOD-1': (1, good), 'BAD-1': (2, bad), 'GOOD-2': (3, also_good)}, report)
+        assert report.inserted == 2
+        assert [line for line, message in report.errors] == [2]
+        assert store.Product.query.count() == products_before + 2
+        assert store.read_counters()['products'] == products_before + 2
+
+
+def test_categories_are_created_with_the_rows_that_use_them(app):
+    with app.app_context():
+        categories_before = store.Category.query.count()
+        report = store.import_catalog(feed(
+            product('LAMP-1', category='Lamps', category_id=None),
+            product('LAMP-2', category='lamps', price='nan', category_id=None),
+            product('RUG-1', category='Rugs', price=-1, category_id=None),
+            product('LONG-1', category='x' * 101, category_id=None),
+            product('LAMP-3', category='LAMPS', category_id=None),
+        ), 'jsonl')
+        assert report.inserted == 2
+        assert [line for line, message in report.errors] == [2, 3, 4]
+        assert '100 characters' in report.errors[2][1]
+        assert [c.name for c in store.Category.query.filter(store.Category.id > categories_before)] == ['Lamps']
+        lamps = store.Category.query.filter_by(name='Lamps').one()
+        assert store.Product.query.filter_by(category_id=lamps.id).count() == 2
+
+
+def test_a_rejected_row_leaves_no_category_behind(app):
+    with app.app_context():
+        categories_before = store.Category.query.count()
+        report = store.ImportReport(10)
+        good = store.parse_product_row(product('GOOD-1'), {'general': 1})
+        bad = dict(store.parse_product_row(product('BAD-1', category='Orphans', category_id=None), {'general': 1}), name=None)
+        categories = {}
+        store.write_product_batch({'GOOD-1': (1, good), 'BAD-1': (2, bad)}, report, categories)
+        assert report.inserted == 1
+        assert [line for line, message in report.errors] == [2]
+        assert store.Category.query.count() == categories_before
+        assert categories == {}
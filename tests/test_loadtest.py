@@ -0,0 +1,34 @@
+import loadtest
+import app as store
+
+
+def test_commands_are_only_on_the_load_test_app(tmp_path):
+    config = {'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'load.db'}", 'TEMPLATE_CACHE_DIR': None}
+    assert 'generate-data' not in store.create_app(config).cli.commands
+    assert {'generate-data', 'load-test'} <= set(loadtest.create_app(config).cli.commands)
+
+
+def test_small_generated_store_serves_the_mix_without_errors(tmp_path):
+    app = loadtest.create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{tmp_path / 'load.db'}",
+        'TEMPLATE_CACHE_DIR': None,
+        'WRITE_BEHIND_ENABLED': False,
+        'WRITE_JOURNAL_DIR': str(tmp_path / 'write_journal'),
+    })
+    volumes = {name: max(2, count // 2000) for name, count in loadtest.SYNTHETIC_VOLUMES.items()}
+    with app.app_context():
+        store.init_db()
+        loadtest.generate_dataset(volumes, seed=1, batch_size=500)
+        admin = store.User.query.filter_by(is_admin=True).one()
+        customers = store.User.query.filter_by(is_admin=False).order_by(store.User.id).limit(2).all()
+        ids = {'products': volumes['products'], 'categories': volumes['categories'], 'orders': volumes['orders']}
+        admin_session = loadtest.TestClientSession()
+        admin_session.login(admin)
+        sessions = []
+        for customer in customers:
+            sessions.append(loadtest.TestClientSession())
+            sessions[-1].login(customer)
+        store.db.session.remove()
+        result = loadtest.run_load_test(sessions, admin_session, ids, requests_per_worker=30, warmup=0, seed=1)
+    assert sum(route['requests'] for route in result['routes'].values()) >= 60
+    assert all(route['errors'] == 0 for route in result['routes'].values()), result['routes']
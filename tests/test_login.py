@@ -0,0 +1,28 @@
+import app as store
+
+
+def attempts(client, address, count):
+    statuses = []
+    for n in range(count):
+        response = client.post(
+            '/login', data={'username': f'nobody{n}', 'password': 'wrong'},
+            headers={'X-Forwarded-For': address},
+        )
+        statuses.append(response.status_code)
+    return statuses
+
+
+def test_forwarded_addresses_are_ignored_without_trusted_proxies(app):
+    app.config['LOGIN_RATE_LIMITS'] = {'ip': {'burst': 2, 'per_minute': 1}, 'username': {'burst': 5, 'per_minute': 5}}
+    client = app.test_client()
+    assert attempts(client, '203.0.113.1', 2)[-1] != 429
+    assert attempts(client, '203.0.113.2', 1) == [429]
+
+
+def test_clients_behind_a_trusted_proxy_get_their_own_limit(app):
+    app.config['LOGIN_RATE_LIMITS'] = {'ip': {'burst': 2, 'per_minute': 1}, 'username': {'burst': 5, 'per_minute': 5}}
+    app.config['TRUSTED_PROXIES'] = 1
+    store.trust_proxies(app)
+    client = app.test_client()
+    assert attempts(client, '203.0.113.1', 3)[-1] == 429
+    assert attempts(client, '203.0.113.2', 1) != [429]
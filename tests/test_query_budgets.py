@@ -0,0 +1,51 @@
+import uuid
+from datetime import datetime, timedelta
+
+import app as store
+
+
+def seed_orders_and_reviews():
+    users = store.User.query.order_by(store.User.id).all()
+    customer = next(user for user in users if not user.is_admin)
+    products = store.Product.query.order_by(store.Product.id).limit(5).all()
+    start = datetime.utcnow() - timedelta(days=1)
+    for n in range(6):
+        order = store.Order(user_id=customer.id, total_amount=0, created_at=start + timedelta(minutes=n))
+        order.items = [store.OrderItem(product_id=product.id, quantity=2, price=product.price) for product in products]
+        order.total_amount = sum(item.price * item.quantity for item in order.items)
+        store.db.session.add(order)
+    store.db.session.commit()
+    store.write_submissions([{
+        'id': uuid.uuid4().hex,
+        'kind': 'review',
+        'values': {'user_id': user.id, 'product_id': products[0].id, 'rating': 4, 'comment': f'Review {n}'},
+        'created_at': (start + timedelta(minutes=n)).isoformat(),
+    } for n, user in enumerate(users * 3)])
+    return customer.id, products[0].id, order.id
+
+
+def logged_in(app, user_id, is_admin=False):
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = user_id
+        client_session['is_admin'] = is_admin
+    return client
+
+
+def test_listings_stay_within_their_query_budgets(app):
+    budgets = app.config['QUERY_BUDGETS']
+    with app.app_context():
+        customer_id, product_id, order_id = seed_orders_and_reviews()
+        admin_id = store.User.query.filter_by(is_admin=True).first().id
+    customer = logged_in(app, customer_id)
+    admin = logged_in(app, admin_id, is_admin=True)
+    # TESTING is on, so a request over budget raises QueryBudgetExceeded
+    for client, path, endpoint in [
+        (customer, '/orders', 'orders'),
+        (admin, '/admin/orders', 'admin_orders'),
+        (admin, f'/admin/orders/{order_id}', 'admin_order_detail'),
+        (customer, f'/product/{product_id}', 'product_detail'),
+    ]:
+        response = client.get(path)
+        assert response.status_code == 200, path
+        assert int(response.headers['X-Query-Count']) <= budgets[endpoint], path
@@ -0,0 +1,15 @@
+import app as store
+
+
+def test_route_queries_use_an_index(app):
+    with app.app_context():
+        total, failures = store.query_plan_report()
+    assert total > len(store.QUERY_PLAN_ROUTES)
+    assert failures == []
+
+
+def test_scans_and_sorts_are_reported():
+    statement = 'SELECT * FROM product WHERE price > ? ORDER BY price'
+    plan = ['SCAN product', 'USE TEMP B-TREE FOR ORDER BY']
+    assert store.query_plan_problems(statement, plan) == plan
+    assert store.query_plan_problems(statement, ['SEARCH product USING INDEX ix_product_price (price>?)']) == []
@@ -0,0 +1,28 @@
+import app as store
+
+
+def reviewer(app):
+    client = app.test_client()
+    with client.session_transaction() as client_session:
+        client_session['user_id'] = 2
+    return client
+
+
+def test_invalid_reviews_are_rejected_before_queueing(app):
+    client = reviewer(app)
+    with app.app_context():
+        reviews_before = store.Review.query.count()
+    for form in (
+        {'product_id': 1, 'rating': 0},
+        {'product_id': 1, 'rating': 6},
+        {'product_id': 1, 'rating': 'five'},
+        {'product_id': 999999, 'rating': 5},
+        {'rating': 5},
+    ):
+        response = client.post('/add_review', data=dict(form, comment='x'))
+        assert response.status_code == 400, form
+        assert 'error' in response.get_json()
+    response = client.post('/add_review', data={'product_id': 1, 'rating': 5, 'comment': 'Great'})
+    assert response.get_json() == {'success': 'Review added successfully!'}
+    with app.app_context():
+        assert store.Review.query.count() == reviews_before + 1
@@ -0,0 +1,36 @@
+from sqlalchemy import text
+
+import app as store
+
+
+def update_trigger(name):
+    return store.db.session.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = :name"), {'name': name}
+    ).scalar()
+
+
+def test_migration_limits_update_triggers_to_indexed_columns(app):
+    with app.app_context():
+        # An index built before migration 3 reindexed on any column change
+        store.db.session.execute(text('DROP TRIGGER product_fts_au'))
+        store.db.session.execute(text(
+            "CREATE TRIGGER product_fts_au AFTER UPDATE ON product BEGIN "
+            "INSERT INTO product_fts(product_fts, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+            "INSERT INTO product_fts(rowid, name, description) VALUES (new.id, new.name, new.description); END"
+        ))
+        store.db.session.query(store.SchemaMigration).filter_by(version=3).delete()
+        store.db.session.commit()
+        store.migrate()
+        assert 'AFTER UPDATE OF name, description ON product' in update_trigger('product_fts_au')
+        assert 'AFTER UPDATE OF title, content, tags ON blog' in update_trigger('blog_fts_au')
+
+        product = store.db.session.get(store.Product, 1)
+        product.name = 'Zanzibar widget'
+        store.db.session.commit()
+        assert [p.id for p in store.search_query(store.Product, 'product_fts', 'zanzibar')] == [1]
+        # total_changes() counts rows written by triggers too
+        before = store.db.session.execute(text('SELECT total_changes()')).scalar()
+        store.db.session.execute(text('UPDATE product SET stock_quantity = stock_quantity + 1 WHERE id = 1'))
+        assert store.db.session.execute(text('SELECT total_changes()')).scalar() == before + 1
+        store.db.session.commit()
+        assert [p.id for p in store.search_query(store.Product, 'product_fts', 'zanzibar')] == [1]
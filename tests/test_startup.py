@@ -0,0 +1,76 @@
+import json
+import os
+import subprocess
+import sys
+
+import app as store
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The whole cold import measures about 0.5s here, of which Flask,
+# SQLAlchemy and the other libraries take all but 0.1s. The budgets leave
+# room for a slower machine but not for work moved back into import time.
+IMPORT_BUDGET = 1.0
+STORE_IMPORT_BUDGET = 0.3
+CREATE_APP_BUDGET = 0.1
+
+COLD_IMPORT = """
+import json, sys, time
+connects = []
+sys.addaudithook(lambda event, args: connects.append(str(args[0])) if event == 'sqlite3.connect' else None)
+started = time.perf_counter()
+import click, flask, flask_sqlalchemy, jinja2, sqlalchemy.dialects.postgresql, sqlalchemy.dialects.sqlite
+try:
+    import brotli
+except ImportError:
+    pass
+try:
+    import PIL.Image, PIL.ImageOps
+except ImportError:
+    pass
+libraries = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+created = time.perf_counter()
+print(json.dumps({
+    'libraries': libraries - started,
+    'store': imported - libraries,
+    'create_app': created - imported,
+    'connects': connects,
+}))
+"""
+
+
+def test_cold_start_opens_no_database(tmp_path):
+    database = tmp_path / 'cold.db'
+    env = dict(os.environ, DATABASE_URL=f'sqlite:///{database}')
+    env.pop('DATABASE_REPLICA_URL', None)
+    result = subprocess.run(
+        [sys.executable, '-c', COLD_IMPORT], cwd=ROOT, env=env,
+        capture_output=True, text=True, timeout=60, check=True,
+    )
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    assert report['connects'] == []
+    assert not database.exists()
+    assert report['libraries'] + report['store'] < IMPORT_BUDGET
+    assert report['store'] < STORE_IMPORT_BUDGET
+    assert report['create_app'] < CREATE_APP_BUDGET
+
+
+def test_init_db_backfills_counters_and_ratings(app):
+    with app.app_context():
+        store.db.session.execute(store.Review.__table__.insert(), [
+            {'user_id': 1, 'product_id': 1, 'rating': 4, 'comment': 'Good'},
+            {'user_id': 2, 'product_id': 1, 'rating': 2, 'comment': 'Poor'},
+        ])
+        store.StoreCounter.query.delete()
+        store.ProductRating.query.delete()
+        store.db.session.commit()
+
+        store.init_db()
+        counters = store.read_counters()
+        assert counters['products'] == store.Product.query.count()
+        assert counters['reviews'] == store.Review.query.count()
+        ratings = [review.rating for review in store.Review.query.filter_by(product_id=1)]
+        summary = store.db.session.get(store.ProductRating, 1)
+        assert (summary.rating_count, summary.rating_sum) == (len(ratings), sum(ratings))
@@ -0,0 +1,21 @@
+import gzip
+import os
+
+
+def test_precompressed_copy_older_than_its_source_is_not_served(app, tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'static_folder', str(tmp_path))
+    source = tmp_path / 'site.css'
+    source.write_text('body { color: red; }')
+    (tmp_path / 'site.css.gz').write_bytes(gzip.compress(b'body { color: red; }'))
+    client = app.test_client()
+
+    response = client.get('/static/site.css?v=1', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+
+    # Edited after the last compress-static
+    source.write_text('body { color: blue; }')
+    stale = os.path.getmtime(source) - 10
+    os.utime(tmp_path / 'site.css.gz', (stale, stale))
+    response = client.get('/static/site.css?v=2', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data(as_text=True) == 'body { color: blue; }'
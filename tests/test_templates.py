@@ -0,0 +1,18 @@
+import os
+
+import app as store
+
+
+def test_template_cache_dir_comes_from_the_app_config(app, tmp_path):
+    assert app.jinja_env.bytecode_cache is None
+    cached = store.create_app({'TEMPLATE_CACHE_DIR': str(tmp_path / 'compiled'), 'TEMPLATE_WARMUP': True})
+    assert cached.jinja_env.bytecode_cache.directory == str(tmp_path / 'compiled')
+    assert os.listdir(tmp_path / 'compiled')
+
+
+def test_rendering_writes_nothing_into_the_repository(app):
+    repo_cache = os.path.join(app.root_path, store.DefaultConfig.TEMPLATE_CACHE_DIR)
+    before = set(os.listdir(repo_cache)) if os.path.isdir(repo_cache) else set()
+    assert app.test_client().get('/').status_code == 200
+    after = set(os.listdir(repo_cache)) if os.path.isdir(repo_cache) else set()
+    assert after == before
@@ -0,0 +1,113 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+import app as store
+
+
+def contact(subject):
+    return {
+        'id': uuid.uuid4().hex,
+        'kind': 'contact',
+        'values': {'name': 'Ann', 'email': 'ann@example.com', 'subject': subject, 'message': 'Hello'},
+        'created_at': datetime.utcnow().isoformat(),
+    }
+
+
+def review(product_id, rating):
+    return {
+        'id': uuid.uuid4().hex,
+        'kind': 'review',
+        'values': {'user_id': 1, 'product_id': product_id, 'rating': rating, 'comment': 'Fine'},
+        'created_at': datetime.utcnow().isoformat(),
+    }
+
+
+def write_journal(path, items):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as journal:
+        for item in items:
+            journal.write(json.dumps(item) + '\n')
+
+
+def contacts(subject):
+    return store.Contact.query.filter_by(subject=subject).count()
+
+
+def rating_count(product_id):
+    summary = store.db.session.get(store.ProductRating, product_id)
+    return summary.rating_count if summary else 0
+
+
+def test_replay_skips_submissions_already_committed(app):
+    journal_dir = app.config['WRITE_JOURNAL_DIR']
+    with app.app_context():
+        ratings_before = rating_count(1)
+        committed = [contact('replayed'), review(1, 5)]
+        assert store.write_batch(committed)
+        # The process died after the commit but before deleting its journal
+        path = os.path.join(journal_dir, 'crashed.jsonl')
+        write_journal(path, committed + [contact('replayed')])
+        assert store.replay_journals(journal_dir, 100) == 3
+        assert contacts('replayed') == 2
+        assert rating_count(1) == ratings_before + 1
+        assert not os.path.exists(path)
+
+
+def test_committed_segments_are_deleted_while_the_queue_runs(app):
+    app.config.update(WRITE_BEHIND_ENABLED=True, WRITE_FLUSH_INTERVAL=0.01)
+    journal_dir = app.config['WRITE_JOURNAL_DIR']
+    with app.app_context():
+        write_queue = store.get_write_queue()
+    try:
+        with app.test_request_context():
+            for n in range(20):
+                store.submit_write('contact', name='Ann', email='ann@example.com', subject='queued', message=str(n))
+        deadline = time.monotonic() + 10
+        with app.app_context():
+            while contacts('queued') < 20 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            assert contacts('queued') == 20
+        time.sleep(0.1)
+        # Only the live segment is left, and nothing committed is in it
+        segments = [name for name in os.listdir(journal_dir) if name.endswith('.jsonl')]
+        assert segments == [os.path.basename(write_queue.segment.path)]
+        assert os.path.getsize(write_queue.segment.path) == 0
+    finally:
+        write_queue.close()
+    assert os.listdir(journal_dir) == []
+
+
+def test_permanent_errors_are_not_retried(app):
+    journal_dir = app.config['WRITE_JOURNAL_DIR']
+    path = os.path.join(journal_dir, 'stopped.jsonl')
+    write_journal(path, [contact('kept')])
+    with app.app_context():
+        store.db.session.execute(text('DROP TABLE contact'))
+        store.db.session.commit()
+        started = time.monotonic()
+        assert not store.write_batch([contact('lost')])
+        assert store.replay_journals(journal_dir, 100) == 0
+        assert time.monotonic() - started < 5
+    assert os.path.exists(path)
+
+
+def test_transient_errors_are_retried_a_limited_number_of_times(app, monkeypatch):
+    calls = []
+
+    def locked(items):
+        calls.append(items)
+        raise OperationalError('INSERT', {}, sqlite3.OperationalError('database is locked'))
+
+    monkeypatch.setattr(store, 'write_submissions', locked)
+    monkeypatch.setattr(store.time, 'sleep', lambda delay: None)
+    app.config['WRITE_RETRY_LIMIT'] = 3
+    with app.app_context():
+        assert not store.write_batch([contact('locked')])
+    assert len(calls) == 3